@@ -1,16 +1,46 @@
 from flask import Blueprint, render_template, request, jsonify
 from werkzeug.utils import secure_filename
-from threading import Thread
-from utils import background_upload_and_save
+from functools import partial
+from utils import process_note_upload, notify_upload_failure
+from job_queue import JobQueue
+from upload_stream import MultipartStream
+from drive_client import drive_client, DriveUploadInterrupted, DriveUploadFailed
+from note_index import Fingerprint, fingerprint_index
 import os
 import json
+import uuid
 from flexmessage import create_upload_success_flex
 from datetime import datetime
 import logging
 
 # 設定日誌
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+UPLOAD_SUCCESS_PAGE = '''
+<!doctype html>
+<html>
+<head>
+    <script>
+        alert("檔案上傳成功，筆記將於審核後上架，返回LINE頁面");
+        window.location.href = "https://line.me/R/ti/p/@625evpbz";
+    </script>
+</head>
+<body></body>
+</html>
+'''
+
+DUPLICATE_PAGE = '''
+<!doctype html>
+<html>
+<head>
+    <script>
+        alert("此檔案已上傳過，不需重複上傳，返回LINE頁面");
+        window.location.href = "https://line.me/R/ti/p/@625evpbz";
+    </script>
+</head>
+<body></body>
+</html>
+'''
 
 class UploadHandler:
     ALLOWED_EXTENSIONS = {"pdf", "png", "jpg", "jpeg"}
@@ -19,8 +49,19 @@ class UploadHandler:
         self.upload_folder = upload_folder
         self.line_bot_api = line_bot_api
         self.folder_id = folder_id
+        self.streaming = os.getenv("UPLOAD_STREAMING", "true").lower() in ("1", "true", "yes")
         os.makedirs(self.upload_folder, exist_ok=True)
 
+        # 持久化上傳工作佇列，重啟後會繼續處理未完成的工作
+        self.job_queue = JobQueue(
+            os.getenv("UPLOAD_QUEUE_DB", os.path.join(self.upload_folder, "jobs.db")),
+            handler=partial(process_note_upload, line_bot_api=line_bot_api),
+            workers=int(os.getenv("UPLOAD_WORKERS", "2")),
+            max_attempts=int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5")),
+            on_failure=partial(notify_upload_failure, line_bot_api=line_bot_api)
+        )
+        self.job_queue.start()
+
         # 建立 Blueprint
         self.blueprint = Blueprint("upload_handler", __name__, template_folder="templates")
         self.setup_routes()
@@ -34,14 +75,18 @@ class UploadHandler:
                 return "無法取得用戶 ID", 400
 
             if request.method == "POST":
+                # 獲取上傳時間
+                upload_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+                # 串流模式：檔案內容直接分段送往 Google Drive，不先寫入本地磁碟
+                if self.streaming and request.mimetype == "multipart/form-data":
+                    return self.handle_streaming_upload(user_id, upload_time)
+
                 file = request.files.get("file")
                 subject = request.form.get("subject")
                 grade = request.form.get("grade")
                 year = request.form.get("year")
                 price = request.form.get("price")
-                
-                # 獲取上傳時間
-                upload_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
                 # 驗證表單數據
                 if not subject or not grade or not year or not price:
@@ -50,39 +95,174 @@ class UploadHandler:
                 # 驗證文件格式
                 if file and self.allowed_file(file.filename):
                     filename = secure_filename(file.filename)
-                    file_path = os.path.join(self.upload_folder, filename)
+                    file_path = self.local_path(filename)
                     file.save(file_path)
 
-                    # 後台處理檔案上傳
-                    Thread(target=background_upload_and_save, args=(
-                        user_id, year, filename, file_path, subject, grade, price, upload_time, self.folder_id, self.line_bot_api
-                    )).start()
-
-                    # 發送 Flex Message 通知用戶
-                    flex_message = create_upload_success_flex(filename, year, subject, grade, price)
-
-                    try:
-                        self.line_bot_api.push_message(user_id, flex_message)
-                    except Exception as e:
-                        return jsonify({"status": "error", "message": f"通知發送失敗: {e}"}), 500
-
-                    return '''
-                    <!doctype html>
-                    <html>
-                    <head>
-                        <script>
-                            alert("檔案上傳成功，筆記將於審核後上架，返回LINE頁面");
-                            window.location.href = "https://line.me/R/ti/p/@625evpbz";
-                        </script>
-                    </head>
-                    <body></body>
-                    </html>
-                    '''
+                    # 相同內容的筆記已存在時不再上傳與審核
+                    fingerprint = Fingerprint.of_file(file_path)
+                    existing = fingerprint_index.lookup(fingerprint.sha256, fingerprint.size)
+                    if existing:
+                        os.remove(file_path)
+                        self.enqueue_duplicate(user_id, filename, existing)
+                        return DUPLICATE_PAGE
+
+                    self.enqueue_upload(user_id, filename, file_path, subject, grade, year, price, upload_time,
+                                        sha256=fingerprint.sha256, size=fingerprint.size)
+                    return UPLOAD_SUCCESS_PAGE
                 else:
                     return jsonify({"status": "error", "message": "不支持的文件格式！"}), 400
 
             return render_template("upload.html")
 
+        @self.blueprint.route("/upload/queue", methods=["GET"])
+        def upload_queue():
+            """回傳上傳工作佇列的深度與延遲"""
+            return jsonify(self.job_queue.stats())
+
+    def handle_streaming_upload(self, user_id, upload_time):
+        """邊接收邊上傳到 Google Drive，記憶體中最多保留一個分段
+
+        Drive 無法建立上傳 session 時改為寫入本地檔案，由背景工作上傳；
+        串流途中 Drive 中斷時，剩餘內容寫入本地檔案，由背景工作從中斷處續傳。
+        """
+        boundary = request.mimetype_params.get("boundary")
+        if not boundary:
+            return jsonify({"status": "error", "message": "不支持的請求格式！"}), 400
+
+        parser = MultipartStream(request.stream, boundary)
+        fields, original_name, mimetype = parser.read_fields()
+        subject, grade, year, price = (fields.get(k) for k in ("subject", "grade", "year", "price"))
+
+        # 驗證表單數據
+        if not subject or not grade or not year or not price:
+            parser.drain()
+            return jsonify({"status": "error", "message": "請填寫完整訊息！"}), 400
+
+        # 驗證文件格式
+        if not original_name or not self.allowed_file(original_name):
+            parser.drain()
+            return jsonify({"status": "error", "message": "不支持的文件格式！"}), 400
+
+        filename = secure_filename(original_name)
+        fingerprint = Fingerprint()
+        chunks = fingerprint.wrap(parser.iter_file())
+
+        # 瀏覽器已先計算指紋且與既有筆記相同時，只驗證內容，不傳送到 Drive
+        try:
+            claimed = fields.get("sha256"), int(fields.get("size") or -1)
+        except ValueError:
+            parser.drain()
+            return jsonify({"status": "error", "message": "檔案資訊格式錯誤，請重新上傳！"}), 400
+        existing = fingerprint_index.lookup(*claimed) if claimed[0] else None
+        if existing:
+            for _ in chunks:
+                pass
+            parser.drain()
+            if (fingerprint.sha256, fingerprint.size) != claimed:
+                return jsonify({"status": "error", "message": "檔案驗證失敗，請重新上傳！"}), 400
+            self.enqueue_duplicate(user_id, filename, existing)
+            return DUPLICATE_PAGE
+
+        extra = {}
+        try:
+            drive_upload = drive_client.start_resumable_upload(filename, self.folder_id, mimetype)
+        except Exception as e:
+            logger.warning(f"無法建立 Google Drive 上傳 session，改為本地暫存：{e}")
+            drive_upload = None
+
+        file_path = None
+        if drive_upload is not None:
+            try:
+                for chunk in chunks:
+                    drive_upload.write(chunk)
+            except DriveUploadInterrupted as e:
+                # 未確認的資料與剩餘內容寫入本地，由背景工作續傳
+                logger.warning(f"{e}，剩餘內容改為本地暫存")
+                file_path = self.local_path(filename)
+                with open(file_path, "wb") as f:
+                    f.write(drive_upload.buffer)
+                    for chunk in chunks:
+                        f.write(chunk)
+                extra["upload_session"] = {"uri": drive_upload.session_uri, "offset": drive_upload.offset}
+            except DriveUploadFailed as e:
+                parser.drain()
+                return self.drive_rejected(e)
+        else:
+            file_path = self.local_path(filename)
+            with open(file_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        parser.drain()
+
+        # 相同內容的筆記已存在時放棄上傳 session（Drive 不會建立檔案），也不再審核
+        existing = fingerprint_index.lookup(fingerprint.sha256, fingerprint.size)
+        if existing:
+            if drive_upload is not None:
+                drive_upload.cancel()
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+            self.enqueue_duplicate(user_id, filename, existing)
+            return DUPLICATE_PAGE
+
+        if drive_upload is not None and "upload_session" not in extra:
+            try:
+                extra["drive_file_id"] = drive_upload.finish()
+            except DriveUploadInterrupted as e:
+                # 最後一段無法送出時由背景工作續傳
+                logger.warning(f"{e}，最後一段改為本地暫存")
+                file_path = self.local_path(filename)
+                with open(file_path, "wb") as f:
+                    f.write(drive_upload.buffer)
+                extra["upload_session"] = {"uri": drive_upload.session_uri, "offset": drive_upload.offset}
+            except DriveUploadFailed as e:
+                return self.drive_rejected(e)
+
+        self.enqueue_upload(user_id, filename, file_path, subject, grade, year, price, upload_time,
+                            sha256=fingerprint.sha256, size=fingerprint.size, **extra)
+        return UPLOAD_SUCCESS_PAGE
+
+    def drive_rejected(self, error):
+        """Drive 拒絕上傳時放棄 session，回傳錯誤訊息讓用戶重新上傳"""
+        logger.error(f"{error}，放棄此次上傳")
+        error.upload.cancel()
+        return jsonify({"status": "error", "message": "檔案上傳到雲端失敗，請稍後重新上傳！"}), 502
+
+    def local_path(self, filename):
+        # 加上隨機前綴，避免佇列中同名檔案互相覆蓋
+        return os.path.join(self.upload_folder, f"{uuid.uuid4().hex[:8]}_{filename}")
+
+    def enqueue_duplicate(self, user_id, filename, existing):
+        """重複的檔案只排入通知工作；既有筆記屬於其他用戶時不保存其檔名與連結"""
+        own = existing.get("user_id") == user_id
+        duplicate_of = {"id": existing.get("id"), "own": own}
+        if own:
+            duplicate_of.update(file_name=existing.get("file_name"), file_url=existing.get("file_url"))
+        self.job_queue.enqueue({
+            "user_id": user_id,
+            "file_name": filename,
+            "file_path": None,
+            "duplicate_of": duplicate_of
+        })
+
+    def enqueue_upload(self, user_id, filename, file_path, subject, grade, year, price, upload_time, **extra):
+        """將上傳工作排入佇列，由背景工作執行緒處理"""
+        # 發送 Flex Message 通知用戶（由背景工作發送）
+        flex_message = create_upload_success_flex(filename, year, subject, grade, price)
+
+        self.job_queue.enqueue({
+            "user_id": user_id,
+            "year": year,
+            "file_name": filename,
+            "file_path": file_path,
+            "subject": subject,
+            "grade": grade,
+            "price": price,
+            "upload_time": upload_time,
+            "folder_id": self.folder_id,
+            "received_message": flex_message.as_json_dict(),
+            **extra
+        })
+
     def allowed_file(self, filename):
         """檢查檔案格式是否允許"""
         return "." in filename and filename.rsplit(".", 1)[1].lower() in self.ALLOWED_EXTENSIONS
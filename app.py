@@ -1,7 +1,9 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, has_request_context
 import json
-import openai
-from chat_history import save_chat_history, load_chat_history
+from chat_history import save_chat_history, load_chat_history, load_chat_summary
+from prompt_builder import build_prompt
+from response_pool import ResponsePool
+from chat_limiter import chat_limiter, ChatLimitExceeded
 
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
@@ -12,67 +14,82 @@ from linebot.models import (
 from Upload_Handler import UploadHandler
 from utils import check_environment_variables
 import os
-import firebase_admin
-from firebase_admin import credentials, firestore
-from threading import Thread
 from review_monitor import monitor_review_status  # 假設監聽邏輯放在 review_monitor.py
-from firebase_utils import db  # 引入 Firestore 客戶端
+from leader_election import LeaderElector, StorageLeaseStore
+from storage import get_store
+from repositories import note_repository, purchase_repository
+from webhook_dispatcher import WebhookDispatcher, reply_or_push
+from user_session import open_session
+from session_cache import session_cache
+from note_catalog import note_catalog
+from metrics import registry, stage, bind_state, Gauge
+from clients import openai_client, register, prewarm
+from router import StateMachine
+from wishlist import submit_wishlist, get_top_wishes
+from payment_proofs import PaymentProofIngestor
+from structured_logging import configure_logging, bind_correlation_id, new_correlation_id, current_correlation_id
+import logging
+
+# 設定日誌：JSON 格式，由背景執行緒輸出
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # 初始化環境變數檢查
 check_environment_variables()
 
-NOTES_PRICING = {
-    "A01": 150,
-    "A02": 150,
-    "A03": 150,
-    "A04": 30,
-    "A05": 150,
-    "A06": 150,
-    "A07": 150,
-    "A08": 150,
-    "A09": 150,
-    "A10": 100,
-    "A11": 150,
-    "A12": 150
-}
+# 已上架筆記的記憶體目錄，由 notes 集合的 listener 持續更新；預熱或第一次使用時才開始監聽
+NOTE_CATALOG_WAIT = float(os.getenv("NOTE_CATALOG_WAIT", "5"))
+
+def _start_note_catalog():
+    note_catalog.start_listener(note_repository)
+    return note_catalog
+
+note_catalog_client = register("note_catalog", _start_note_catalog)
 
+def get_note_catalog():
+    """取得筆記目錄；尚未載入完成時最多等待 NOTE_CATALOG_WAIT 秒"""
+    catalog = note_catalog_client.get()
+    catalog.wait_loaded(NOTE_CATALOG_WAIT)
+    return catalog
 
 # 初始化 Flask 和 LINE API
 app = Flask(__name__)
 line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'))
 handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))
 
-# 從環境變數中獲取 OpenAI API 金鑰
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# 非同步 webhook 模式：先回應 200，事件交由背景工作執行緒處理
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() in ("1", "true", "yes")
+webhook_dispatcher = WebhookDispatcher.from_env(handler, app=app)
+
+def get_request_host():
+    """取得對外 host；背景執行緒中使用收到 webhook 時的 host"""
+    if has_request_context():
+        return request.host
+    if webhook_dispatcher.current_host():
+        return webhook_dispatcher.current_host()
+    return os.getenv("APP_HOST", "")
+
 # 用戶狀態管理
 def get_user_state(user_id):
     try:
-        doc = db.collection("user_states").document(user_id).get()
-        if doc.exists:
-            return doc.to_dict().get("state", "default")
+        with open_session(user_id) as session:
+            return session.state
     except Exception as e:
-        print(f"Error getting user state: {e}")
+        logger.error(f"Error getting user state: {e}")
     return "default"
 
 def set_user_state(user_id, state):
     try:
-        db.collection("user_states").document(user_id).set({
-            "state": state,
-            "last_updated": firestore.SERVER_TIMESTAMP
-        }, merge=True)
+        # 狀態未改變時不會寫入儲存後端
+        with open_session(user_id) as session:
+            session.set_state(state)
     except Exception as e:
-        print(f"Error setting user state: {e}")
-
-# 更新生成學霸小E回應的函數
-def generate_E_response(user_id, user_message):
-    try:
-        # 加載用戶對話歷史
-        conversations = load_chat_history(user_id)
+        logger.error(f"Error setting user state: {e}")
 
-        # 始終確保系統角色在對話開頭
-        system_message = {
-            "role": "system",
-            "content": (
+# 學霸小E的系統提示，始終放在對話開頭
+XIAO_E_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
                 """你是喜歡吐槽別人的學霸小E，是幽默風趣勸學專家，針對不讀書的人，請嚴厲的指責、吐槽、批評。
                 如果別人問你學習建議，你可以接著詢問是關於哪一科目、或哪一領域的學習建議，再依此做出回應。
                 你必須給出具體、實用的建議，這些建議應包括可操作的步驟或真實可行的範例，幫助用戶真正解決問題。
@@ -90,24 +107,57 @@ def generate_E_response(user_id, user_message):
 
                 小E，做為Enote的吉祥物，你在聊天過程中適時向用戶推薦這些功能，但不要太多刻意，自然一點，幫助他們發揮 Enote 平台的最大價值！
                 """
-            )
-
-
-        }
-        if not conversations or conversations[0]["role"] != "system":
-            conversations.insert(0, system_message)
+    )
+}
 
-        # 添加用戶的最新訊息
-        conversations.append({"role": "user", "content": user_message})
+# 小E模式的快速回覆問題，這些問題的回應會預先生成
+XIAO_E_QUICK_PROMPTS = ["告訴我期末如何歐趴", "給我一點學習建議", "吐槽我為甚麼還沒開始讀書"]
 
-        # 呼叫 GPT API 生成回應
-        response = openai.ChatCompletion.create(
+def generate_canned_response(prompt):
+    """不帶個人對話歷史生成小E回應，用於預先生成回應池"""
+    with chat_limiter.slot(blocking=True):
+        response = openai_client.get().ChatCompletion.create(
             model="gpt-3.5-turbo",
-            messages=conversations,
+            messages=[XIAO_E_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
             max_tokens=180,
             temperature=0.85,
             top_p=0.9
         )
+    return response.choices[0].message['content'].strip()
+
+response_pool = ResponsePool.from_env(XIAO_E_QUICK_PROMPTS, generate_canned_response)
+
+# 超過 OpenAI 呼叫限制時立即回覆的降級訊息
+XIAO_E_BUSY_REPLIES = {
+    "user": "你傳太快了啦～讓小E喘口氣，等幾秒再跟我說 😅",
+    "busy": "小E正在回覆好多同學，稍等一下再傳訊息給我吧！📚"
+}
+
+# 更新生成學霸小E回應的函數
+def generate_E_response(user_id, user_message):
+    try:
+        # 快速回覆問題優先使用預先生成的回應，不需呼叫 OpenAI
+        pooled = response_pool.get(user_message)
+        if pooled is not None:
+            save_chat_history(user_id, "user", user_message)
+            save_chat_history(user_id, "assistant", pooled)
+            return pooled
+
+        # 加載用戶對話歷史
+        conversations = load_chat_history(user_id)
+
+        # 在 token 上限內組合系統提示、對話摘要、最近對話與用戶的最新訊息
+        messages = build_prompt(XIAO_E_SYSTEM_MESSAGE, conversations, user_message, summary=load_chat_summary(user_id))
+
+        # 呼叫 GPT API 生成回應（受個人頻率與全域並行數限制）
+        with chat_limiter.slot(user_id), stage("openai"):
+            response = openai_client.get().ChatCompletion.create(
+                model="gpt-3.5-turbo",
+                messages=messages,
+                max_tokens=180,
+                temperature=0.85,
+                top_p=0.9
+            )
 
         # GPT 回應
         assistant_message = response.choices[0].message['content'].strip()
@@ -117,8 +167,10 @@ def generate_E_response(user_id, user_message):
         save_chat_history(user_id, "assistant", assistant_message)
 
         return assistant_message
+    except ChatLimitExceeded as e:
+        return XIAO_E_BUSY_REPLIES[e.reason]
     except Exception as e:
-        print(f"Error generating response: {e}")
+        logger.error(f"Error generating response: {e}")
         return "抱歉，小E現在有點忙，稍後再試吧！"
 
 # 註冊 UploadHandler
@@ -126,174 +178,326 @@ FOLDER_ID = "1h7DL1gRlB96Dpxmad0-gMvSDdVjm57vn"
 upload_handler = UploadHandler(upload_folder="uploads", line_bot_api=line_bot_api, folder_id=FOLDER_ID)
 app.register_blueprint(upload_handler.blueprint)
 
+# 付款截圖由背景工作保存到 Google Drive 並附加到待付款的購買
+payment_proofs = PaymentProofIngestor(line_bot_api, folder_id=os.getenv("PAYMENT_PROOF_FOLDER_ID", FOLDER_ID))
+
+@app.before_request
+def bind_request_correlation_id():
+    # 沿用上游的 X-Request-Id，沒有時產生新的，串起背景處理的日誌
+    bind_correlation_id(request.headers.get("X-Request-Id") or new_correlation_id())
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers["X-Request-Id"] = current_correlation_id()
+    return response
+
+@app.teardown_request
+def unbind_request_correlation_id(exc):
+    bind_correlation_id(None)
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers.get('X-Line-Signature', None)
     body = request.get_data(as_text=True)
 
-    app.logger.info(f"Request body: {body}")
+    # 請求內容量大且含用戶訊息：只抽樣記錄，輸出時遮蔽訊息文字與 token
+    logger.info("收到 webhook 請求", extra={"sample": "request_body", "body": body})
     if not signature:
-        app.logger.error("缺少 X-Line-Signature")
+        logger.error("缺少 X-Line-Signature")
         abort(400)
 
     try:
-        handler.handle(body, signature)
+        if WEBHOOK_ASYNC:
+            accepted, dropped = webhook_dispatcher.submit(body, signature, host=request.host)
+        else:
+            dropped = webhook_dispatcher.handle(body, signature, host=request.host)
+        if dropped:
+            # 佇列已滿，回傳 503 讓 LINE 重新傳送（已處理的事件由去重略過）
+            return 'Service Unavailable', 503
     except InvalidSignatureError:
-        app.logger.error("簽名驗證失敗")
+        logger.error("簽名驗證失敗")
         abort(400)
     return 'OK'
 
-# 快速回覆選項生成
+@app.route("/callback/queue", methods=['GET'])
+def callback_queue():
+    """回傳 webhook 佇列狀態"""
+    if not WEBHOOK_ASYNC:
+        return jsonify({"mode": "sync"})
+    return jsonify({"mode": "async", **webhook_dispatcher.stats()})
+
+@app.route("/cache/stats", methods=['GET'])
+def cache_stats():
+    """回傳用戶資料快取、預先生成回應池與 OpenAI 呼叫限制的統計"""
+    return jsonify({"sessions": session_cache.stats(), "responses": response_pool.stats(),
+                    "openai": chat_limiter.stats()})
+
+registry.register(Gauge("linebot_webhook_queue_depth", "webhook 佇列中等待處理的事件數", (),
+                        lambda: {(): webhook_dispatcher.depth()}))
+registry.register(Gauge("linebot_openai_active", "進行中的 OpenAI 請求數", (),
+                        lambda: {(): chat_limiter.active}))
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Prometheus 格式的各階段耗時與事件計數"""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# 快速回覆選項，每個狀態只建立一次
+DEFAULT_QUICK_REPLY = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="找學霸小E談談心！", text="跟小E對話")),
+    QuickReplyButton(action=MessageAction(label="上傳筆記", text="我要上傳筆記")),
+    QuickReplyButton(action=MessageAction(label="找筆記", text="找筆記")),
+    QuickReplyButton(action=MessageAction(label="許願池", text="筆記許願池")),
+    QuickReplyButton(action=MessageAction(label="了解Enote", text="介紹Enote"))
+])
+CHAT_QUICK_REPLY = QuickReply(items=[
+    *[QuickReplyButton(action=MessageAction(label=prompt, text=prompt)) for prompt in XIAO_E_QUICK_PROMPTS],
+    QuickReplyButton(action=MessageAction(label="許願池", text="筆記許願池")),
+    QuickReplyButton(action=MessageAction(label="退出小E談話模式", text="退出小E模式"))
+])
+WISHLIST_QUICK_REPLY = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="取消許願", text="取消"))
+])
+
+# 用戶狀態與指令表；新增狀態時註冊指令即可，不必修改 dispatch_text_message
+text_router = StateMachine("default")
+default_state = text_router.state("default", DEFAULT_QUICK_REPLY)
+chat_state = text_router.state("chat_with_xiaoE", CHAT_QUICK_REPLY)
+wishlist_state = text_router.state("wishlist", WISHLIST_QUICK_REPLY)
+
 def get_quick_reply(user_state):
-    default_quick_reply = [
-        QuickReplyButton(action=MessageAction(label="找學霸小E談談心！", text="跟小E對話")),
-        QuickReplyButton(action=MessageAction(label="上傳筆記", text="我要上傳筆記")),
-        QuickReplyButton(action=MessageAction(label="找筆記", text="找筆記")),
-        QuickReplyButton(action=MessageAction(label="許願池", text="筆記許願池")),
-        QuickReplyButton(action=MessageAction(label="了解Enote", text="介紹Enote"))
-    ]
-    chat_quick_reply = [
-        QuickReplyButton(action=MessageAction(label="告訴我期末如何歐趴", text="告訴我期末如何歐趴")),
-        QuickReplyButton(action=MessageAction(label="給我一點學習建議", text="給我一點學習建議")),
-        QuickReplyButton(action=MessageAction(label="吐槽我為甚麼還沒開始讀書", text="吐槽我為甚麼還沒開始讀書")),
-        QuickReplyButton(action=MessageAction(label="許願池", text="筆記許願池")),
-        QuickReplyButton(action=MessageAction(label="退出小E談話模式", text="退出小E模式"))
-    ]
-    return QuickReply(items=chat_quick_reply if user_state == "chat_with_xiaoE" else default_quick_reply)
+    return text_router.quick_reply(user_state)
+
+# 筆記搜尋結果
+def create_note_search_reply(query_text):
+    if not query_text:
+        subjects = get_note_catalog().facets("subject")[:12]
+        return TextSendMessage(
+            text="🔍 請輸入「找筆記 關鍵字」搜尋筆記，例如：找筆記 微積分 大一",
+            quick_reply=QuickReply(items=[
+                QuickReplyButton(action=MessageAction(label=subject[:20], text=f"找筆記 {subject}"))
+                for subject in subjects
+            ]) if subjects else None
+        )
+
+    catalog = get_note_catalog()
+    query, filters = catalog.parse_query(query_text)
+    notes = [note for note in catalog.search(query, **filters, limit=5) if note.code and note.price is not None]
+    if not notes:
+        return TextSendMessage(
+            text="🌟 目前找不到符合的筆記，可以到許願池許願喔！",
+            quick_reply=get_quick_reply("default")
+        )
+    lines = [f"{note.code}｜{note.subject} {note.grade} {note.year}｜{note.file_name}｜{note.price} 元" for note in notes]
+    return TextSendMessage(
+        text="🔍 找到以下筆記：\n\n" + "\n".join(lines),
+        quick_reply=QuickReply(items=[
+            QuickReplyButton(action=MessageAction(label=f"購買筆記 {note.code}", text=f"購買筆記 {note.code}"))
+            for note in notes
+        ])
+    )
+
+# 預設狀態
+ENTER_CHAT_REPLY = TextSendMessage(text="你好，我是學霸小E，歡迎跟我聊天！", quick_reply=CHAT_QUICK_REPLY)
+PAYMENT_OPTIONS_REPLY = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="LINE Pay", text="選擇 LINE Pay")),
+    QuickReplyButton(action=MessageAction(label="郵局匯款", text="選擇 郵局匯款"))
+])
+NOTE_NOT_FOUND_REPLY = TextSendMessage(text="🌟 未找到該筆記編號，請確認後重新輸入。")
+NOTE_CODE_REQUIRED_REPLY = TextSendMessage(text="🌟 請提供有效的筆記編號，例如：購買筆記 A01。")
+LINEPAY_TEXT_REPLY = TextSendMessage(
+    text=("✨ 感謝您的支持！\n\n"
+          "📷 請掃描以下的 QR Code 完成付款：\n\n"
+          "📤 完成付款後，請回傳付款截圖，我們將在確認款項後提供限時有效的下載連結給您！\n\n"
+          "🌟 感謝您的支持與信任，期待您的購買！ 🛍️"),
+    quick_reply=DEFAULT_QUICK_REPLY
+)
+POST_OFFICE_REPLY = TextSendMessage(
+    text=("✨ 感謝您的支持！\n\n"
+          "🏦郵局匯款\n\n"
+          "銀行代碼：700\n"
+          "帳號：0000023980362050\n\n"
+          "📤 完成匯款後，請回傳付款截圖，我們將在確認款項後提供限時有效的下載連結給您！\n\n"
+          "🌟 感謝您的支持，祝期末HIGH PASS！ 🎉"),
+    quick_reply=DEFAULT_QUICK_REPLY
+)
+DEFAULT_REPLY = TextSendMessage(text=" ", quick_reply=DEFAULT_QUICK_REPLY)
+
+@default_state.command("跟小E對話")
+def enter_chat(ctx):
+    ctx.goto("chat_with_xiaoE")
+    response_pool.warm()
+    return ENTER_CHAT_REPLY
+
+@default_state.command("我要上傳筆記")
+def upload_link(ctx):
+    quick_reply = QuickReply(items=[
+        QuickReplyButton(action=URIAction(label="點擊上傳檔案", uri=f"https://{get_request_host()}/upload?user_id={ctx.user_id}")),
+        QuickReplyButton(action=MessageAction(label="找筆記", text="找筆記"))
+    ])
+    return TextSendMessage(text="請點擊下方按鈕上傳檔案：", quick_reply=quick_reply)
+
+@default_state.pattern(r"購買筆記\s*([A-Za-z]\d{2,})")
+def buy_note(ctx):
+    note = get_note_catalog().get(ctx.match.group(1))
+    if note is None:
+        return NOTE_NOT_FOUND_REPLY
+    try:
+        # 收到付款截圖時附加到此待付款紀錄
+        purchase_repository.create_pending(ctx.user_id, note.code, note.price)
+    except Exception as e:
+        logger.error(f"建立待付款紀錄失敗：{e}")
+    return TextSendMessage(
+        text=f"您選擇購買筆記 {note.code}，價格為 {note.price} 元。請選擇您的付款方式：",
+        quick_reply=PAYMENT_OPTIONS_REPLY
+    )
+
+@default_state.prefix("購買筆記")
+def buy_note_without_code(ctx):
+    return NOTE_CODE_REQUIRED_REPLY
+
+@default_state.prefix("找筆記")
+def search_notes(ctx):
+    return create_note_search_reply(ctx.text[len("找筆記"):].strip())
+
+@default_state.command("選擇 LINE Pay")
+def linepay(ctx):
+    linepay_image_url = f"https://{get_request_host()}/static/images/linepay_qrcode.jpg"
+    return [LINEPAY_TEXT_REPLY, ImageSendMessage(original_content_url=linepay_image_url,
+                                                 preview_image_url=linepay_image_url)]
+
+default_state.reply("選擇 郵局匯款", POST_OFFICE_REPLY)
+default_state.fallback(lambda ctx: DEFAULT_REPLY)
+
+# 學霸小E模式
+EXIT_CHAT_REPLY = TextSendMessage(text="已退出學霸小E模式，趕快去讀書啦！", quick_reply=DEFAULT_QUICK_REPLY)
+
+chat_state.reply("退出小E模式", EXIT_CHAT_REPLY, next_state="default")
+# 小E模式中的功能指令離開小E模式，交由預設狀態處理
+chat_state.forward(chat_state.prefix("找筆記"), to="default")
+chat_state.forward(chat_state.command("筆記許願池"), to="default")
+chat_state.forward(chat_state.contains("購買筆記"), to="default")
+
+@chat_state.contains("上傳筆記")
+def chat_upload_link(ctx):
+    ctx.goto("default")
+    return upload_link(ctx)
+
+def is_mergeable_chat(event):
+    """同樣會交給小E、可合併成一次 OpenAI 呼叫的文字訊息（指令與預先生成回應的快速問題除外）"""
+    if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessage):
+        return False
+    text = event.message.text.strip()
+    return bool(text) and text not in XIAO_E_QUICK_PROMPTS and not chat_state.handles(text)
+
+@chat_state.fallback
+def chat_with_xiao_e(ctx):
+    text = ctx.text
+    if text not in XIAO_E_QUICK_PROMPTS:
+        # 用戶連續傳送、仍在佇列中的訊息合併成一次 OpenAI 呼叫，只回覆一次
+        following = webhook_dispatcher.take_following(ctx.event, is_mergeable_chat)
+        text = "\n".join([text] + [event.message.text.strip() for event in following])
+    reply_content = generate_E_response(ctx.user_id, text)
+    return TextSendMessage(text=reply_content, quick_reply=CHAT_QUICK_REPLY)
+
+# 筆記許願池
+WISHLIST_CANCEL_REPLY = TextSendMessage(text="已取消許願，需要時再來許願池找我們喔！", quick_reply=DEFAULT_QUICK_REPLY)
+WISHLIST_FAILED_REPLY = TextSendMessage(text="❌ 許願失敗，請稍後再試。", quick_reply=DEFAULT_QUICK_REPLY)
+WISHLIST_USAGE_REPLY = TextSendMessage(
+    text="請輸入想要的課程與說明，例如：\n微積分 王老師的期中考範圍\n\n不想許願了請點選「取消許願」。",
+    quick_reply=WISHLIST_QUICK_REPLY
+)
+
+@default_state.command("筆記許願池")
+def open_wishlist(ctx):
+    ctx.goto("wishlist")
+    text = ("🌠 歡迎來到筆記許願池！\n\n"
+            "請輸入想要的課程與說明，例如：\n微積分 王老師的期中考範圍\n\n"
+            "📢 筆記上架時我們會通知您！")
+    top = [wish for wish in get_top_wishes(3) if wish["count"] > 0]
+    if top:
+        text += "\n\n🔥 大家最想要：\n" + "\n".join(f"{wish['course']}（{wish['count']} 人許願）" for wish in top)
+    return TextSendMessage(text=text, quick_reply=WISHLIST_QUICK_REPLY)
+
+wishlist_state.reply("取消", WISHLIST_CANCEL_REPLY, next_state="default")
+# 許願時點選其他功能，直接交由預設狀態處理
+wishlist_state.forward(wishlist_state.command("跟小E對話", "我要上傳筆記", "筆記許願池"), to="default")
+wishlist_state.forward(wishlist_state.prefix("找筆記"), to="default")
+wishlist_state.forward(wishlist_state.contains("購買筆記"), to="default")
+
+@wishlist_state.fallback
+def submit_wish(ctx):
+    course, _, description = ctx.text.replace("\u3000", " ").strip().partition(" ")
+    # 沒有課程名稱或是其他功能的指令時不寫入，留在許願池並提示格式
+    if not course or default_state.handles(ctx.text):
+        return WISHLIST_USAGE_REPLY
+    ctx.goto("default")
+    if not submit_wishlist(ctx.user_id, course, description.strip()):
+        return WISHLIST_FAILED_REPLY
+    return TextSendMessage(
+        text=f"✨ 已收到您對「{course}」的許願！筆記上架時會第一時間通知您 📚",
+        quick_reply=DEFAULT_QUICK_REPLY
+    )
 
 # 處理用戶訊息邏輯
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     user_id = getattr(event.source, 'user_id', None)
     if not user_id:
-        line_bot_api.reply_message(
-            event.reply_token,
+        reply_or_push(
+            line_bot_api, event,
             TextSendMessage(text="無法獲取用戶 ID，請確保您已添加好友。")
         )
         return
 
+    # 整個事件只讀取一次用戶資料，結束時一次寫回
+    with open_session(user_id):
+        dispatch_text_message(event, user_id)
+
+def dispatch_text_message(event, user_id):
     message_text = event.message.text.strip()
     user_state = get_user_state(user_id)
+    bind_state(user_state)
 
-    if user_state == "default":
-        if message_text == "跟小E對話":
-            set_user_state(user_id, "chat_with_xiaoE")
-            reply_message = TextSendMessage(
-                text="你好，我是學霸小E，歡迎跟我聊天！",
-                quick_reply=get_quick_reply("chat_with_xiaoE")
-            )
-
-        elif message_text == "我要上傳筆記":
-            quick_reply = QuickReply(items=[
-                QuickReplyButton(action=URIAction(label="點擊上傳檔案", uri=f"https://{request.host}/upload?user_id={user_id}")),
-                QuickReplyButton(action=MessageAction(label="找筆記", text="找筆記"))
-
-            ])
-            reply_message = TextSendMessage(
-                text="請點擊下方按鈕上傳檔案：", quick_reply=quick_reply
-            )
-        elif message_text.startswith("購買筆記"):
-            import re
-            match = re.match(r"購買筆記\s*(A\d{2})", message_text)
-            if match:
-                note_code = match.group(1)
-                if note_code in NOTES_PRICING:
-                    price = NOTES_PRICING[note_code]
-                    quick_reply = QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label="LINE Pay", text="選擇 LINE Pay")),
-                        QuickReplyButton(action=MessageAction(label="郵局匯款", text="選擇 郵局匯款"))
-                    ])
-                    reply_message = TextSendMessage(
-                        text=f"您選擇購買筆記 {note_code}，價格為 {price} 元。請選擇您的付款方式：",
-                        quick_reply=quick_reply
-                    )
-                else:
-                    reply_message = TextSendMessage(
-                        text="🌟 未找到該筆記編號，請確認後重新輸入。"
-                    )
-            else:
-                reply_message = TextSendMessage(
-                    text="🌟 請提供有效的筆記編號，例如：購買筆記 A01。"
-                )
-        elif message_text == "選擇 LINE Pay":
-            linepay_image_url = f"https://{request.host}/static/images/linepay_qrcode.jpg"
-            text_message = TextSendMessage(
-                text=("✨ 感謝您的支持！\n\n"
-                      "📷 請掃描以下的 QR Code 完成付款：\n\n"
-                      "📤 完成付款後，請回傳付款截圖，我們將在確認款項後提供限時有效的下載連結給您！\n\n"
-                      "🌟 感謝您的支持與信任，期待您的購買！ 🛍️"),
-                quick_reply=get_quick_reply(user_state)
-            )
-            image_message = ImageSendMessage(
-                original_content_url=linepay_image_url,
-                preview_image_url=linepay_image_url
-            )
-            line_bot_api.reply_message(event.reply_token, [text_message, image_message])
-            return
-        elif message_text == "選擇 郵局匯款":
-            reply_message = TextSendMessage(
-                text=("✨ 感謝您的支持！\n\n"
-                      "🏦郵局匯款\n\n"
-                      "銀行代碼：700\n"
-                      "帳號：0000023980362050\n\n"
-                      "📤 完成匯款後，請回傳付款截圖，我們將在確認款項後提供限時有效的下載連結給您！\n\n"
-                      "🌟 感謝您的支持，祝期末HIGH PASS！ 🎉"),
-                quick_reply=get_quick_reply(user_state)
-            )
-        else:
-            reply_message = TextSendMessage(
-                text=" ",
-                quick_reply=get_quick_reply("default")
-            )
-        line_bot_api.reply_message(event.reply_token, reply_message)
-
-    
+    ctx = text_router.dispatch(event, user_id, message_text, user_state)
+    if ctx.next_state != user_state:
+        set_user_state(user_id, ctx.next_state)
+    if ctx.reply is not None:
+        reply_or_push(line_bot_api, event, ctx.reply)
 
-    elif user_state == "chat_with_xiaoE":
-        if message_text == "退出小E模式":
-            set_user_state(user_id, "default")
-            reply_message = TextSendMessage(
-                text="已退出學霸小E模式，趕快去讀書啦！",
-                quick_reply=get_quick_reply("default")
-            )
+@handler.add(MessageEvent, message=ImageMessage) 
+def handle_image_message(event):
+    user_id = getattr(event.source, 'user_id', None)
+    if user_id:
+        # 只排入工作，下載、上傳與圖片分析都在背景執行
+        payment_proofs.enqueue(user_id, event.message.id)
+    confirmation_message = TextSendMessage(
+        text="✅ 已收到您的付款證明。我們將在確認款項後提供下載連結！"
+    )
+    reply_or_push(line_bot_api, event, confirmation_message)
 
-        elif message_text == "找筆記":
-            set_user_state(user_id, "default")
-            quick_reply=get_quick_reply("default")
+def start_singleton_jobs():
+    """以租約選出唯一的行程執行審核狀態監聽，gunicorn 多 worker 或多節點時只會有一個在執行"""
+    monitors = []
 
-        elif message_text == "筆記許願池":
-            set_user_state(user_id, "default")
-            quick_reply=get_quick_reply("default")
+    def on_elected():
+        monitors.append(monitor_review_status(line_bot_api))
 
- 
-        elif "購買筆記" in message_text:
-            set_user_state(user_id, "default")
-            quick_reply=get_quick_reply("default")
+    def on_revoked():
+        while monitors:
+            monitors.pop().stop()
 
-        elif "上傳筆記" in message_text:
-            set_user_state(user_id, "default")
-            quick_reply=get_quick_reply("default")
+    return LeaderElector.from_env("review_monitor", StorageLeaseStore(get_store()), on_elected, on_revoked).start()
 
-        else:
-            reply_content = generate_E_response(user_id, message_text)
-            reply_message = TextSendMessage(
-                text=reply_content, quick_reply=get_quick_reply("chat_with_xiaoE")
-            )
-        line_bot_api.reply_message(event.reply_token, reply_message)
+# 每個 worker 都參與選舉；設 SINGLETON_JOBS=false 可停用背景工作
+SINGLETON_JOBS = os.getenv("SINGLETON_JOBS", "true").lower() in ("1", "true", "yes")
+singleton_elector = start_singleton_jobs() if SINGLETON_JOBS else None
 
-@handler.add(MessageEvent, message=ImageMessage) 
-def handle_image_message(event):
-    reply_token = event.reply_token
-    confirmation_message = TextSendMessage(
-        text="✅ 已收到您的付款證明。我們將在確認款項後提供下載連結！"
-    )
-    line_bot_api.reply_message(reply_token, confirmation_message)
+# 背景預熱儲存後端、OpenAI、Drive 與筆記目錄；PREWARM_CLIENTS 可指定要預熱的項目或設為空字串停用
+prewarm()
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
 
-    # 啟動 Firebase 監聽器
-    Thread(target=monitor_review_status, args=(line_bot_api,)).start()
-
     # 啟動 Flask 應用
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,336 @@
+"""壓力測試用的本地替身：LINE API、OpenAI、Firestore 與 Google Drive
+
+每個外部呼叫都會依 Latency 設定等待，以模擬網路延遲；不會連線到任何外部服務。
+"""
+import json
+import time
+import uuid
+import random
+import itertools
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+from google.api_core.exceptions import Conflict, FailedPrecondition
+
+
+class Latency:
+    """各外部服務的模擬延遲（秒），jitter 為隨機增減的比例"""
+
+    def __init__(self, delays=None, jitter=0.2):
+        self.delays = dict(delays or {})
+        self.jitter = jitter
+
+    def wait(self, service):
+        delay = self.delays.get(service, 0)
+        if delay > 0:
+            time.sleep(delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+# ---------------------------------------------------------------- Firestore
+
+_clock = itertools.count()
+_epoch = datetime.now(timezone.utc)
+
+
+def _next_update_time():
+    # 每次寫入的 update_time 都不同，版本前置條件才能正確判斷
+    return _epoch + timedelta(microseconds=next(_clock))
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+        self.read_time = datetime.now(timezone.utc)
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection, doc_id):
+        self._db = db
+        self.parent = collection
+        self.id = doc_id
+        self.path = f"{collection.id}/{doc_id}"
+
+    def get(self, transaction=None, field_paths=None):
+        self._db.latency.wait("firestore")
+        return self._db._snapshot(self)
+
+    def set(self, data, merge=False):
+        self._db.latency.wait("firestore")
+        return self._db._write(self, "set", data, merge=merge)
+
+    def create(self, data):
+        self._db.latency.wait("firestore")
+        return self._db._write(self, "create", data)
+
+    def update(self, data, option=None):
+        self._db.latency.wait("firestore")
+        return self._db._write(self, "update", data, option=option)
+
+    def delete(self, option=None):
+        self._db.latency.wait("firestore")
+        return self._db._write(self, "delete", None)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), limit=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._limit = limit
+
+    def where(self, field, op, value):
+        return FakeQuery(self._collection, self._filters + [(field, op, value)], self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, count)
+
+    def order_by(self, field, direction=None):
+        return self
+
+    def select(self, field_paths):
+        return self
+
+    def _matches(self, data):
+        for field, op, value in self._filters:
+            actual = data.get(field)
+            if op == "==" and actual != value:
+                return False
+            if op == "in" and actual not in value:
+                return False
+            if op == ">=" and (actual is None or actual < value):
+                return False
+        return True
+
+    def stream(self):
+        self._collection._db.latency.wait("firestore")
+        db = self._collection._db
+        with db._lock:
+            docs = [(doc_id, data, version) for (collection, doc_id), (data, version) in db._docs.items()
+                    if collection == self._collection.id and self._matches(data)]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter([FakeSnapshot(self._collection.document(doc_id), data, version) for doc_id, data, version in docs])
+
+    def on_snapshot(self, callback):
+        """立即以目前符合的文件呼叫一次 callback；之後的變更不會推送"""
+        docs = list(self.stream())
+        changes = [SimpleNamespace(type=SimpleNamespace(name="ADDED"), document=doc) for doc in docs]
+        callback(docs, changes, datetime.now(timezone.utc))
+        return SimpleNamespace(unsubscribe=lambda: None)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        self._db = db
+        self.id = name
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self._db, self, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        ref = self.document()
+        result = ref.create(data)
+        return result.update_time, ref
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, "set", data, {"merge": merge}))
+
+    def create(self, ref, data):
+        self._writes.append((ref, "create", data, {}))
+
+    def update(self, ref, data, option=None):
+        self._writes.append((ref, "update", data, {"option": option}))
+
+    def delete(self, ref, option=None):
+        self._writes.append((ref, "delete", None, {}))
+
+    def commit(self):
+        self._db.latency.wait("firestore")
+        with self._db._lock:
+            for ref, kind, data, kwargs in self._writes:
+                self._db._check(ref, kind, **kwargs)
+            return [self._db._apply(ref, kind, data, **kwargs) for ref, kind, data, kwargs in self._writes]
+
+
+class FakeFirestore:
+    """記憶體中的 Firestore，支援 batch、版本前置條件與簡單的等值查詢"""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self._docs = {}
+        self._lock = threading.RLock()
+        self.writes = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self.latency.wait("firestore")
+        return [self._snapshot(ref) for ref in references]
+
+    def write_option(self, last_update_time=None, exists=None):
+        return SimpleNamespace(last_update_time=last_update_time, exists=exists)
+
+    def seed(self, collection, doc_id, data):
+        """不經延遲直接寫入初始資料"""
+        with self._lock:
+            self._docs[(collection, doc_id)] = (dict(data), _next_update_time())
+
+    def _snapshot(self, ref):
+        with self._lock:
+            data, version = self._docs.get((ref.parent.id, ref.id), (None, None))
+        return FakeSnapshot(ref, data, version)
+
+    def _write(self, ref, kind, data, **kwargs):
+        with self._lock:
+            self._check(ref, kind, **kwargs)
+            return self._apply(ref, kind, data, **kwargs)
+
+    def _check(self, ref, kind, option=None, merge=False):
+        current = self._docs.get((ref.parent.id, ref.id))
+        if kind == "create" and current is not None:
+            raise Conflict(f"文件已存在：{ref.path}")
+        if kind == "update" and current is None:
+            raise FailedPrecondition(f"文件不存在：{ref.path}")
+        if option is not None and option.last_update_time is not None and current[1] != option.last_update_time:
+            raise FailedPrecondition(f"版本不符：{ref.path}")
+
+    def _apply(self, ref, kind, data, option=None, merge=False):
+        key = (ref.parent.id, ref.id)
+        update_time = _next_update_time()
+        if kind == "delete":
+            self._docs.pop(key, None)
+        elif kind in ("update",) or merge:
+            current = dict(self._docs.get(key, ({}, None))[0])
+            current.update(data)
+            self._docs[key] = (current, update_time)
+        else:
+            self._docs[key] = (dict(data), update_time)
+        self.writes += 1
+        return SimpleNamespace(update_time=update_time)
+
+
+# ---------------------------------------------------------------- LINE
+
+class FakeLineBotApi:
+    """取代 linebot.LineBotApi；訊息仍會序列化以計入實際的 CPU 成本"""
+
+    latency = Latency()
+
+    def __init__(self, channel_access_token=None, *args, **kwargs):
+        self.replies = 0
+        self.pushes = 0
+        self._lock = threading.Lock()
+
+    def _send(self, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        json.dumps([m.as_json_dict() for m in messages], ensure_ascii=False)
+        self.latency.wait("line")
+
+    def reply_message(self, reply_token, messages, notification_disabled=False, timeout=None):
+        self._send(messages)
+        with self._lock:
+            self.replies += 1
+
+    def push_message(self, to, messages, retry_key=None, notification_disabled=False, timeout=None):
+        self._send(messages)
+        with self._lock:
+            self.pushes += 1
+
+    def multicast(self, to, messages, retry_key=None, notification_disabled=False, timeout=None):
+        self._send(messages)
+        with self._lock:
+            self.pushes += 1
+
+
+# ---------------------------------------------------------------- OpenAI
+
+class FakeChatCompletion:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def create(self, model=None, messages=None, **kwargs):
+        self.latency.wait("openai")
+        with self._lock:
+            self.calls += 1
+        content = "期末歐趴的秘訣就是現在開始讀書！先把考古題寫一遍，不會的地方標起來問同學 📚"
+        return SimpleNamespace(choices=[SimpleNamespace(message={"role": "assistant", "content": content})])
+
+
+# ---------------------------------------------------------------- Google Drive
+
+class FakeDriveHttp:
+    """模擬 resumable upload 協定的 HTTP 端點，讓 ResumableUpload 的實際程式碼路徑被測量"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.latency.wait("drive")
+        headers = headers or {}
+        if method == "POST":
+            session_uri = f"https://fake-drive.local/upload/{uuid.uuid4().hex}"
+            with self._lock:
+                self._sessions[session_uri] = 0
+            return httplib2.Response({"status": "200", "location": session_uri}), b""
+        if method == "DELETE":
+            with self._lock:
+                self._sessions.pop(uri, None)
+            return httplib2.Response({"status": "204"}), b""
+
+        content_range = headers.get("Content-Range", "bytes */*")
+        span, total = content_range[len("bytes "):].split("/")
+        with self._lock:
+            received = self._sessions.get(uri, 0)
+            if span != "*":
+                received = int(span.split("-")[1]) + 1
+                self._sessions[uri] = received
+        if total != "*" and received == int(total):
+            return httplib2.Response({"status": "200"}), json.dumps({"id": uuid.uuid4().hex[:28]}).encode()
+        response = {"status": "308"}
+        if received:
+            response["range"] = f"bytes=0-{received - 1}"
+        return httplib2.Response(response), b""
+
+
+def install_drive_fakes(client, latency):
+    """將 DriveClient 的 HTTP 與 service 呼叫換成本地替身"""
+    http = FakeDriveHttp(latency)
+    type(client).http = property(lambda self: http)
+
+    def upload_file(file_path, file_name, folder_id, chunk_size=None):
+        latency.wait("drive")
+        return uuid.uuid4().hex[:28]
+
+    def make_public(file_id):
+        latency.wait("drive")
+
+    client.upload_file = upload_file
+    client.make_public = make_public
+    return http
@@ -0,0 +1,135 @@
+"""app 的 import 時間分析與預算檢查
+
+在乾淨的子行程中 import app（憑證為假值，預設不啟動背景工作與預熱），
+以 python -X importtime 的結果回報各模組的 import 時間，並檢查：
+- import app 的時間（多次執行取中位數）不超過 --budget 秒
+- --forbid 列出的重量級套件沒有在 import 時被載入（應於第一次使用時才載入）
+任一項不符時以非零狀態結束，可放在 CI 中防止冷啟動退步。
+
+用法：
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget 1.5 --runs 5
+    python benchmarks/import_time.py --top 30 --env STORAGE_BACKEND=sqlite
+    python benchmarks/import_time.py --forbid openai firebase_admin googleapiclient grpc
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# 應於第一次使用時才載入的套件
+HEAVY_MODULES = ["openai", "firebase_admin", "google.cloud.firestore", "googleapiclient", "httplib2", "PIL"]
+
+# 子行程中執行：量測 import app 的時間並回報已載入的重量級套件
+PROBE = """
+import sys, json, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def child_env(overrides):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "CHANNEL_SECRET": "import-time",
+        "CHANNEL_ACCESS_TOKEN": "import-time",
+        "FIREBASE_CREDENTIALS": "{}",
+        "GOOGLE_DRIVE_CREDENTIALS": "{}",
+        "OPENAI_API_KEY": "import-time",
+        "SINGLETON_JOBS": "false",
+        "PREWARM_CLIENTS": "",
+    })
+    for item in overrides:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def run_probe(env, forbid, importtime=False):
+    """在暫存目錄中 import app，回傳 (量測結果, importtime 輸出)"""
+    workdir = tempfile.mkdtemp(prefix="enote-import-")
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ["-X", "importtime"]
+    cmd += ["-c", PROBE % (forbid,)]
+    proc = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"import app 失敗（狀態 {proc.returncode}）")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return result, proc.stderr
+
+
+def parse_importtime(output):
+    """解析 -X importtime 的輸出，回傳 [(模組, 自身微秒, 累計微秒, 巢狀深度)]"""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def report(rows, top):
+    """列出自身時間合計最長的套件，以及累計時間最長的模組"""
+    # 以各模組自身時間加總，套件之間不會重複計算
+    packages = {}
+    for name, self_us, _, _ in rows:
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0) + self_us
+    total = sum(packages.values())
+    print(f"{'package':<36} {'self ms':>9} {'share':>7}")
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"{name:<36} {us / 1000:>9.1f} {us / total:>7.1%}")
+
+    print(f"\n{'module':<52} {'self ms':>9} {'cumulative ms':>14}")
+    for name, self_us, cumulative_us, _ in sorted(rows, key=lambda row: -row[2])[:top]:
+        print(f"{name:<52} {self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET", "1.0")),
+                        help="import app 的時間上限（秒）")
+    parser.add_argument("--runs", type=int, default=3, help="量測次數，取中位數")
+    parser.add_argument("--top", type=int, default=15, help="列出最慢的項目數")
+    parser.add_argument("--forbid", nargs="*", default=HEAVY_MODULES, help="import 時不得載入的套件")
+    parser.add_argument("--env", action="append", default=[], help="子行程的環境變數 KEY=VALUE")
+    parser.add_argument("--no-profile", action="store_true", help="只檢查預算，不列出各模組時間")
+    args = parser.parse_args()
+
+    env = child_env(args.env)
+    if not args.no_profile:
+        _, output = run_probe(env, args.forbid, importtime=True)
+        report(parse_importtime(output), args.top)
+
+    results = [run_probe(env, args.forbid)[0] for _ in range(args.runs)]
+    seconds = statistics.median(r["seconds"] for r in results)
+    loaded = sorted({m for r in results for m in r["loaded"]})
+    print(f"\nimport app：中位數 {seconds:.3f} 秒（{args.runs} 次，預算 {args.budget:.3f} 秒）")
+
+    failed = False
+    if seconds > args.budget:
+        print(f"❌ 超過 import 時間預算 {seconds - args.budget:.3f} 秒")
+        failed = True
+    if loaded:
+        print(f"❌ import 時載入了應延遲載入的套件：{', '.join(loaded)}")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("✅ 符合 import 時間預算")
+
+
+if __name__ == "__main__":
+    main()
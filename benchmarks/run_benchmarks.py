@@ -0,0 +1,379 @@
+"""webhook 與上傳路徑的離線壓力測試
+
+以本地替身取代 LINE API、OpenAI、Firestore 與 Google Drive（延遲可設定），
+在行程內以 Flask test client 並行送出帶正確簽名的 webhook 與 multipart 上傳請求，
+回報吞吐量、p50/p95/p99 延遲與記憶體用量，並可儲存基準線比較退步幅度。
+
+用法：
+    python benchmarks/run_benchmarks.py --requests 200 --concurrency 8
+    python benchmarks/run_benchmarks.py --openai-latency 1.5 --save-baseline main
+    python benchmarks/run_benchmarks.py --compare main --threshold 0.2
+    python benchmarks/run_benchmarks.py --scenario upload --upload-sizes 64K,1M,8M
+    python benchmarks/run_benchmarks.py --env WEBHOOK_ASYNC=true
+    python benchmarks/run_benchmarks.py --branches chat_openai --batch-size 10 --env WEBHOOK_SHARDS=16
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import base64
+import hashlib
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import contextlib
+from types import ModuleType
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+CHANNEL_SECRET = "benchmark-channel-secret"
+
+# handle_text_message 的各個分支：(名稱, 用戶狀態, 訊息)
+WEBHOOK_BRANCHES = [
+    ("enter_chat", "default", "跟小E對話"),
+    ("upload_link", "default", "我要上傳筆記"),
+    ("buy_note", "default", "購買筆記 A01"),
+    ("buy_invalid", "default", "購買筆記"),
+    ("search_notes", "default", "找筆記 微積分"),
+    ("linepay", "default", "選擇 LINE Pay"),
+    ("post_office", "default", "選擇 郵局匯款"),
+    ("default_other", "default", "你好"),
+    ("chat_quick_prompt", "chat_with_xiaoE", "告訴我期末如何歐趴"),
+    ("chat_openai", "chat_with_xiaoE", "明天要考統計學了怎麼辦"),
+    ("chat_exit", "chat_with_xiaoE", "退出小E模式"),
+    ("chat_search", "chat_with_xiaoE", "找筆記"),
+    ("chat_wishlist", "chat_with_xiaoE", "筆記許願池"),
+    ("chat_buy", "chat_with_xiaoE", "購買筆記 A01"),
+    ("chat_upload", "chat_with_xiaoE", "我要上傳筆記"),
+    ("wishlist_open", "default", "筆記許願池"),
+    ("wishlist_submit", "wishlist", "微積分 期中考範圍"),
+    ("wishlist_cancel", "wishlist", "取消"),
+]
+
+SEED_NOTES = [
+    {"code": "A01", "subject": "微積分", "grade": "大一", "year": "112", "file_name": "微積分期末重點整理.pdf", "price": 150, "approved_price": 150},
+    {"code": "A02", "subject": "普通物理", "grade": "大一", "year": "112", "file_name": "普物筆記.pdf", "price": 150, "approved_price": 150},
+    {"code": "A03", "subject": "統計學", "grade": "大二", "year": "111", "file_name": "統計學考古題詳解.pdf", "price": 100, "approved_price": 100},
+]
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    units = {"K": 1024, "M": 1024 * 1024}
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def max_rss_mb():
+    # Linux 以 KB 回報，macOS 以 bytes 回報
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+class Bench:
+    """安裝替身後載入 app，並執行各個情境"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="enote-bench-")
+        os.environ.update({
+            "CHANNEL_SECRET": CHANNEL_SECRET,
+            "CHANNEL_ACCESS_TOKEN": "benchmark-token",
+            "FIREBASE_CREDENTIALS": "{}",
+            "GOOGLE_DRIVE_CREDENTIALS": "{}",
+            "OPENAI_API_KEY": "benchmark",
+            "SINGLETON_JOBS": "false",
+            "UPLOAD_QUEUE_DB": os.path.join(self.workdir, "jobs.db"),
+            "PAYMENT_QUEUE_DB": os.path.join(self.workdir, "payments.db"),
+            "SQLITE_STORAGE_PATH": os.path.join(self.workdir, "enote.db"),
+        })
+        for item in args.env:
+            key, _, value = item.partition("=")
+            os.environ[key] = value
+        self._install_fakes()
+
+    def _install_fakes(self):
+        sys.path.insert(0, REPO_ROOT)
+        import fakes
+        latency = fakes.Latency({
+            "firestore": self.args.firestore_latency,
+            "openai": self.args.openai_latency,
+            "line": self.args.line_latency,
+            "drive": self.args.drive_latency,
+        }, jitter=self.args.jitter)
+        self.db = fakes.FakeFirestore(latency)
+
+        # firebase_utils 在 import 時需要真實憑證，改為提供替身 db
+        firebase_utils = ModuleType("firebase_utils")
+        firebase_utils.db = self.db
+        firebase_utils.initialize_firebase = lambda: None
+        sys.modules["firebase_utils"] = firebase_utils
+        from firebase_admin import firestore
+        firestore.client = lambda *args, **kwargs: self.db
+
+        import linebot
+        fakes.FakeLineBotApi.latency = latency
+        linebot.LineBotApi = fakes.FakeLineBotApi
+
+        import openai
+        self.chat_completion = fakes.FakeChatCompletion(latency)
+        openai.ChatCompletion.create = self.chat_completion.create
+
+        import drive_client
+        fakes.install_drive_fakes(drive_client.drive_client, latency)
+
+        for i, note in enumerate(SEED_NOTES):
+            self.seed("notes", f"seed{i}", {**note, "status": "上架成功", "user_id": "Useed"})
+
+        # app 以相對路徑建立 uploads 資料夾
+        os.chdir(self.workdir)
+        with self.quiet():
+            import app
+        self.app_module = app
+        self.app = app.app
+        app.app.logger.setLevel("WARNING")
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+
+    def seed(self, collection, doc_id, data):
+        """寫入初始資料；Firestore 後端直接寫入替身以略過延遲"""
+        import storage
+        store = storage.get_store()
+        if isinstance(store, storage.FirestoreStore):
+            self.db.seed(collection, doc_id, data)
+        else:
+            batch = store.batch()
+            batch.set(collection, doc_id, data)
+            batch.commit()
+
+    @contextlib.contextmanager
+    def quiet(self):
+        if self.args.verbose:
+            yield
+            return
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            yield
+
+    # ------------------------------------------------------------ 請求產生
+
+    @staticmethod
+    def signed_webhook(user_ids, text):
+        """同一個 webhook 中每位用戶各一則訊息事件"""
+        body = json.dumps({
+            "destination": "Ubenchmarkbot",
+            "events": [{
+                "type": "message",
+                "mode": "active",
+                "timestamp": int(time.time() * 1000),
+                "source": {"type": "user", "userId": user_id},
+                "webhookEventId": uuid.uuid4().hex.upper()[:26],
+                "deliveryContext": {"isRedelivery": False},
+                "replyToken": uuid.uuid4().hex,
+                "message": {"type": "text", "id": str(uuid.uuid4().int)[:18], "quoteToken": uuid.uuid4().hex,
+                            "text": text},
+            } for user_id in user_ids],
+        }, ensure_ascii=False)
+        digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+        return body, base64.b64encode(digest).decode()
+
+    @staticmethod
+    def multipart_upload(size):
+        boundary = uuid.uuid4().hex
+        fields = {"subject": "微積分", "grade": "大一", "year": "112", "price": "150"}
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+                 for k, v in fields.items()]
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="note.pdf"\r\n'
+                     f'Content-Type: application/pdf\r\n\r\n'.encode())
+        # 內容隨機，避免被當成重複上傳
+        parts.append(os.urandom(size))
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+        return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+    # ------------------------------------------------------------ 執行
+
+    def run(self, name, requests, send, drain=None, failures=None):
+        """並行送出 requests 中的每個請求，回傳統計結果
+
+        failures 為回傳累計失敗數的函數，用於計入 HTTP 已回應 200 但背景處理失敗的事件。
+        """
+        latencies, errors = [], 0
+        failed_before = failures() if failures else 0
+        if self.args.trace_memory:
+            tracemalloc.start()
+
+        def timed(item):
+            client = self.app.test_client()
+            started = time.perf_counter()
+            status = send(client, item)
+            return time.perf_counter() - started, status
+
+        with self.quiet():
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+                for elapsed, status in executor.map(timed, requests):
+                    latencies.append(elapsed)
+                    errors += status >= 400
+            responded = time.perf_counter() - started
+            if drain is not None:
+                drain()
+            completed = time.perf_counter() - started
+        if failures:
+            errors += failures() - failed_before
+
+        peak = None
+        if self.args.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        latencies.sort()
+        return {
+            "scenario": name,
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / completed if completed else 0.0,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+            "drain_seconds": completed - responded,
+            "max_rss_mb": max_rss_mb(),
+            "peak_traced_mb": peak,
+        }
+
+    def webhook_scenarios(self):
+        dispatcher = self.app_module.webhook_dispatcher
+
+        def send(client, item):
+            body, signature = item
+            return client.post("/callback", data=body.encode(), headers={
+                "X-Line-Signature": signature, "Content-Type": "application/json"}).status_code
+
+        for name, state, text in WEBHOOK_BRANCHES:
+            if self.args.branches and name not in self.args.branches:
+                continue
+            requests = []
+            for i in range(self.args.requests):
+                # 每個事件使用不同用戶，狀態轉換不會影響其他請求
+                user_ids = [f"U{name}{uuid.uuid4().hex[:12]}" for _ in range(self.args.batch_size)]
+                for user_id in user_ids:
+                    self.seed("user_states", user_id, {"state": state})
+                requests.append(self.signed_webhook(user_ids, text))
+            # 同步模式超過 WEBHOOK_EVENT_TIMEOUT 的事件也在背景完成，兩種模式都等待佇列清空
+            yield self.run(f"webhook:{name}", requests, send, drain=dispatcher.join,
+                           failures=lambda: dispatcher.failed)
+
+    def upload_scenarios(self):
+        handler = self.app_module.upload_handler
+
+        def send(client, item):
+            body, content_type = item
+            return client.post("/upload?user_id=Ubenchmark", data=body,
+                               headers={"Content-Type": content_type}).status_code
+
+        def drain():
+            # 等待背景上傳工作全部完成
+            while True:
+                stats = handler.job_queue.stats()
+                if not stats["depth"] and not stats["running"]:
+                    return
+                time.sleep(0.05)
+
+        for size_text in self.args.upload_sizes.split(","):
+            size = parse_size(size_text)
+            requests = [self.multipart_upload(size) for _ in range(self.args.requests)]
+            yield self.run(f"upload:{size_text.strip()}", requests, send, drain=drain)
+
+
+def format_result(result):
+    return (f"{result['scenario']:<28} {result['requests']:>6} {result['errors']:>6} "
+            f"{result['throughput']:>9.1f} {result['p50'] * 1000:>8.1f} {result['p95'] * 1000:>8.1f} "
+            f"{result['p99'] * 1000:>8.1f} {result['drain_seconds']:>8.2f} {result['max_rss_mb']:>8.1f}")
+
+
+def compare(results, baseline, threshold):
+    """與基準線比較，p95 變慢或吞吐量下降超過 threshold 視為退步"""
+    previous = {r["scenario"]: r for r in baseline["results"]}
+    regressions = []
+    print(f"\n與基準線 {baseline['name']} 比較（門檻 {threshold:.0%}）")
+    for result in results:
+        old = previous.get(result["scenario"])
+        if old is None:
+            continue
+        p95_change = (result["p95"] - old["p95"]) / old["p95"] if old["p95"] else 0.0
+        tput_change = (result["throughput"] - old["throughput"]) / old["throughput"] if old["throughput"] else 0.0
+        regressed = p95_change > threshold or tput_change < -threshold
+        print(f"{result['scenario']:<28} p95 {p95_change:+7.1%}  吞吐量 {tput_change:+7.1%}"
+              f"{'  ← 退步' if regressed else ''}")
+        if regressed:
+            regressions.append(result["scenario"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["all", "webhook", "upload"], default="all")
+    parser.add_argument("--branches", nargs="*", help="只執行指定的 webhook 分支")
+    parser.add_argument("--requests", type=int, default=100, help="每個情境的請求數")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1, help="每個 webhook 請求包含的事件數（不同用戶）")
+    parser.add_argument("--upload-sizes", default="64K,1M,8M")
+    parser.add_argument("--firestore-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--drive-latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--env", action="append", default=[], help="載入 app 前設定的環境變數 KEY=VALUE")
+    parser.add_argument("--trace-memory", action="store_true", help="以 tracemalloc 記錄峰值記憶體（較慢）")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true", help="顯示 app 的輸出")
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    print(f"{'scenario':<28} {'reqs':>6} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'drain s':>8} {'rss MB':>8}")
+    results = []
+    scenarios = []
+    if args.scenario in ("all", "webhook"):
+        scenarios.append(bench.webhook_scenarios())
+    if args.scenario in ("all", "upload"):
+        scenarios.append(bench.upload_scenarios())
+    for scenario in scenarios:
+        for result in scenario:
+            print(format_result(result), flush=True)
+            results.append(result)
+
+    # 只比較影響結果的設定；情境篩選不同時仍可比較共同的情境
+    config = {k: v for k, v in vars(args).items()
+              if k not in ("scenario", "branches", "upload_sizes", "save_baseline", "compare", "verbose")}
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"name": args.save_baseline, "created_at": time.time(), "config": config,
+                       "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n基準線已儲存：{path}")
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print("⚠️ 基準線的設定與本次不同，比較結果僅供參考")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+    # 背景執行緒（上傳佇列、listener）不會自行結束
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,53 @@
-from firebase_admin import firestore
-from datetime import datetime
-from firebase_utils import db  # 引入 Firestore 客戶端
+import logging
+from user_session import open_session
+from prompt_builder import HISTORY_TOKEN_BUDGET, fit_to_budget
+from conversation_summary import summarizer
+
+# 設定日誌
+logger = logging.getLogger(__name__)
 
 
 MAX_HISTORY_LENGTH = 10  # 最大對話歷史長度
 
 def save_chat_history(user_id, role, content):
-    """將對話存入 Firebase"""
+    """將對話存入 Firebase；事件處理中先寫入 session，事件結束時統一寫回
+
+    被修剪掉的舊訊息會交給背景工作合併進對話摘要。
+    """
     try:
-        doc_ref = db.collection('chat_history').document(user_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            # 如果有歷史對話，追加到陣列
-            conversations = doc.to_dict().get('conversations', [])
-            conversations.append({"role": role, "content": content})
-            conversations = trim_chat_history(conversations)  # 修剪歷史
-            doc_ref.update({
-                "conversations": conversations,
-                "last_updated": datetime.utcnow()
-            })
-        else:
-            # 如果是新用戶，創建新的對話記錄
-            doc_ref.set({
-                "conversations": [{"role": role, "content": content}],
-                "last_updated": datetime.utcnow()
-            })
+        with open_session(user_id) as session:
+            message = {"role": role, "content": content}
+            _, dropped = split_chat_history(session.conversations + [message])
+            session.append_message(message, trim=trim_chat_history)
+        summarizer.schedule(user_id, dropped)
         return True
     except Exception as e:
-        print(f"Error saving chat history: {e}")
+        logger.error(f"Error saving chat history: {e}")
         return False
 
 def load_chat_history(user_id):
-    """從 Firebase 加載用戶對話歷史"""
+    """從 Firebase 加載用戶對話歷史（優先使用 session 與快取中的資料）"""
     try:
-        doc_ref = db.collection('chat_history').document(user_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict().get('conversations', [])
-        return []
+        with open_session(user_id) as session:
+            return list(session.conversations)
     except Exception as e:
-        print(f"Error loading chat history: {e}")
+        logger.error(f"Error loading chat history: {e}")
         return []
 
+def load_chat_summary(user_id):
+    """取得用戶較早對話的滾動摘要"""
+    try:
+        with open_session(user_id) as session:
+            return session.summary
+    except Exception as e:
+        logger.error(f"Error loading chat summary: {e}")
+        return ""
+
+def split_chat_history(conversations):
+    """依訊息數與 token 上限切分對話，回傳 (保留的訊息, 移出的舊訊息)"""
+    kept, dropped = fit_to_budget(conversations[-MAX_HISTORY_LENGTH:], HISTORY_TOKEN_BUDGET)
+    return kept, conversations[:-MAX_HISTORY_LENGTH] + dropped
+
 def trim_chat_history(conversations):
-    """修剪對話歷史，保留最近的對話"""
-    if len(conversations) > MAX_HISTORY_LENGTH:
-        return conversations[-MAX_HISTORY_LENGTH:]
-    return conversations
+    """修剪對話歷史，保留最近且不超過 token 上限的對話"""
+    return split_chat_history(conversations)[0]
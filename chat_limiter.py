@@ -0,0 +1,91 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from push_dispatcher import TokenBucket
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class ChatLimitExceeded(Exception):
+    """超過 OpenAI 呼叫限制；reason 為 "user"（個人頻率）或 "busy"（全域並行數已滿）"""
+
+    def __init__(self, reason):
+        super().__init__(f"OpenAI 呼叫超過限制：{reason}")
+        self.reason = reason
+
+
+class ChatLimiter:
+    """小E對話的 OpenAI 呼叫控制
+
+    每位用戶有各自的令牌桶，全域以 semaphore 限制同時進行的 OpenAI 請求數，
+    超過限制時立即拋出 ChatLimitExceeded，讓呼叫端改回覆降級訊息而不排隊等待。
+    """
+
+    def __init__(self, max_concurrent=4, acquire_timeout=0.5, user_rate=0.2, user_burst=3,
+                 max_users=10000):
+        self.acquire_timeout = acquire_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.rejected_user = 0
+        self.rejected_busy = 0
+        self.active = 0
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """依環境變數建立限制器"""
+        return cls(
+            max_concurrent=int(os.getenv("OPENAI_MAX_CONCURRENCY", "4")),
+            acquire_timeout=float(os.getenv("OPENAI_ACQUIRE_TIMEOUT", "0.5")),
+            user_rate=float(os.getenv("CHAT_USER_RATE", "0.2")),
+            user_burst=int(os.getenv("CHAT_USER_BURST", "3")),
+        )
+
+    def _bucket(self, user_id):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                if len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(user_id)
+            return bucket
+
+    @contextmanager
+    def slot(self, user_id=None, blocking=False):
+        """取得一個 OpenAI 呼叫名額；user_id 為 None 時只受全域並行數限制
+
+        blocking=True 時等待名額（背景工作使用），否則最多等待 acquire_timeout 秒。
+        """
+        if user_id is not None and not self._bucket(user_id).try_acquire():
+            self.rejected_user += 1
+            raise ChatLimitExceeded("user")
+        if not self._semaphore.acquire(timeout=None if blocking else self.acquire_timeout):
+            self.rejected_busy += 1
+            raise ChatLimitExceeded("busy")
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "rejected_user": self.rejected_user,
+            "rejected_busy": self.rejected_busy,
+        }
+
+
+chat_limiter = ChatLimiter.from_env()
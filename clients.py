@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import threading
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class LazyClient:
+    """第一次使用時才建立的客戶端
+
+    Firestore、Google Drive 與 OpenAI 的套件載入與連線建立都很耗時，放在 import 時會拖慢冷啟動；
+    同時間的多個呼叫只會建立一次，建立失敗時下次呼叫會重試。
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    logger.info(f"{self.name} 已初始化（{time.perf_counter() - started:.2f} 秒）")
+        return self._client
+
+
+_clients = {}
+
+
+def register(name, factory):
+    """註冊延遲建立的客戶端，預熱時依註冊順序初始化"""
+    client = _clients[name] = LazyClient(name, factory)
+    return client
+
+
+def _create_storage():
+    from storage import get_store, FirestoreStore
+    store = get_store()
+    if isinstance(store, FirestoreStore):
+        store.db  # 載入 firebase_admin 並初始化 Firestore 客戶端
+    return store
+
+
+def _create_openai():
+    import openai
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+
+def _create_drive():
+    from drive_client import drive_client
+    drive_client.prewarm()
+    return drive_client
+
+
+storage_client = register("storage", _create_storage)
+openai_client = register("openai", _create_openai)
+drive_client = register("drive", _create_drive)
+
+
+def prewarm(names=None):
+    """在背景執行緒依序初始化客戶端，讓第一個請求不必等待
+
+    names 未指定時讀取 PREWARM_CLIENTS（以逗號分隔，預設全部；設為空字串則不預熱）。
+    回傳背景執行緒，沒有需要預熱的客戶端時回傳 None。
+    """
+    if names is None:
+        names = [n.strip() for n in os.getenv("PREWARM_CLIENTS", ",".join(_clients)).split(",") if n.strip()]
+    clients = [_clients[name] for name in _clients if name in names]
+    if not clients:
+        return None
+
+    def run():
+        for client in clients:
+            try:
+                client.get()
+            except Exception as e:
+                logger.warning(f"預熱 {client.name} 失敗，將於第一次使用時重試：{e}")
+
+    thread = threading.Thread(target=run, name="client-prewarm", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,73 @@
+import os
+import queue
+import logging
+import threading
+from clients import openai_client
+from chat_limiter import chat_limiter
+from user_session import open_session
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "200"))
+
+SUMMARY_PROMPT = (
+    "請將以下學霸小E與用戶的對話，合併進既有摘要，整理成 150 字以內的繁體中文摘要。"
+    "保留用戶的科目、考試、學習困難與偏好等後續對話需要的資訊，省略寒暄。"
+)
+
+
+class ConversationSummarizer:
+    """背景將移出對話視窗的舊訊息合併成每位用戶的滾動摘要"""
+
+    def __init__(self, queue_size=500):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def schedule(self, user_id, messages):
+        """排入摘要工作；佇列已滿時略過（摘要為盡力而為）"""
+        if not messages:
+            return
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((user_id, list(messages)))
+        except queue.Full:
+            logger.warning(f"摘要佇列已滿，略過用戶 {user_id} 的摘要")
+
+    def summarize(self, user_id, messages):
+        """以 GPT 合併舊摘要與移出的訊息，並寫回用戶的對話紀錄"""
+        with open_session(user_id) as session:
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+            # 與聊天共用 OpenAI 並行名額，背景摘要等待名額而不被拒絕
+            with chat_limiter.slot(blocking=True):
+                response = openai_client.get().ChatCompletion.create(
+                    model="gpt-3.5-turbo",
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": f"既有摘要：{session.summary or '（無）'}\n\n對話：\n{transcript}"}
+                    ],
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    temperature=0.3
+                )
+            session.set_summary(response.choices[0].message['content'].strip())
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="summary-worker", daemon=True)
+                self._thread.start()
+
+    def _worker(self):
+        # 單一工作執行緒，確保同一用戶的摘要依序更新
+        while True:
+            user_id, messages = self.queue.get()
+            try:
+                self.summarize(user_id, messages)
+            except Exception as e:
+                logger.error(f"對話摘要失敗：{e}")
+            finally:
+                self.queue.task_done()
+
+
+summarizer = ConversationSummarizer()
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import random
+import socket
+import logging
+import threading
+from concurrent.futures import Future
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+# 分段上傳大小須為 256KB 的倍數
+DRIVE_UPLOAD_CHUNK_SIZE = int(os.getenv("DRIVE_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+DRIVE_UPLOAD_RETRIES = int(os.getenv("DRIVE_UPLOAD_RETRIES", "5"))
+DRIVE_HTTP_TIMEOUT = float(os.getenv("DRIVE_HTTP_TIMEOUT", "60"))
+DRIVE_PERMISSION_BATCH_WINDOW = float(os.getenv("DRIVE_PERMISSION_BATCH_WINDOW", "0.2"))
+# 串流上傳時記憶體中最多保留的分段大小（256KB 的倍數）
+DRIVE_STREAM_CHUNK_SIZE = int(os.getenv("DRIVE_STREAM_CHUNK_SIZE", str(2 * 1024 * 1024)))
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id"
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def _retryable_errors():
+    """可重試的連線例外；googleapiclient 與 httplib2 在第一次上傳時才載入"""
+    import httplib2
+    from googleapiclient.errors import HttpError
+    return HttpError, (HttpError, OSError, socket.timeout, httplib2.HttpLib2Error)
+
+
+class DriveUploadInterrupted(Exception):
+    """串流上傳重試後仍失敗；session 仍可於稍後續傳"""
+
+    def __init__(self, upload, error):
+        super().__init__(f"Google Drive 串流上傳中斷：{error}")
+        self.upload = upload
+
+
+class DriveUploadFailed(Exception):
+    """Drive 以不可重試的狀態碼拒絕串流上傳（例如權限或配額），session 無法續傳"""
+
+    def __init__(self, upload, error):
+        super().__init__(f"Google Drive 拒絕串流上傳：{error}")
+        self.upload = upload
+        self.error = error
+
+
+class DriveClient:
+    """長期重用的 Google Drive 客戶端
+
+    憑證與 discovery 只建立一次；googleapiclient 的 httplib2 連線不是執行緒安全的，
+    因此每個執行緒各自持有一個已授權的 HTTP 連線，於 execute / next_chunk 時傳入。
+    Google 相關套件載入耗時，於第一次使用時才 import，不影響啟動時間。
+    """
+
+    def __init__(self, credentials_info=None):
+        self._credentials_info = credentials_info
+        self._credentials = None
+        self._service = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._permissions = PermissionBatcher(self)
+
+    @property
+    def credentials(self):
+        """快取的服務帳戶憑證，過期時自動更新"""
+        from google.auth import credentials as google_credentials
+        from google.auth.transport.requests import Request
+        from google.oauth2 import service_account
+        with self._lock:
+            if self._credentials is None:
+                info = self._credentials_info or json.loads(os.getenv("GOOGLE_DRIVE_CREDENTIALS"))
+                creds = service_account.Credentials.from_service_account_info(info)
+                self._credentials = google_credentials.with_scopes_if_required(creds, DRIVE_SCOPES)
+            if not self._credentials.valid:
+                self._credentials.refresh(Request())
+            return self._credentials
+
+    @property
+    def service(self):
+        """共用的 Drive v3 service（只負責建立請求）"""
+        if self._service is None:
+            import httplib2
+            from googleapiclient.discovery import build
+            with self._lock:
+                if self._service is None:
+                    self._service = build("drive", "v3", http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT),
+                                          cache_discovery=False)
+        return self._service
+
+    @property
+    def http(self):
+        """目前執行緒專用的已授權 HTTP 連線"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import httplib2
+            import google_auth_httplib2
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+            self._local.http = http
+        return http
+
+    def prewarm(self):
+        """預先載入 Google 套件並建立 service 與已授權的連線"""
+        self.service
+        self.http
+
+    def upload_file(self, file_path, file_name, folder_id, chunk_size=None):
+        """以可續傳方式分段上傳檔案，單段失敗時以指數退避重試；回傳檔案 ID"""
+        from googleapiclient.http import MediaFileUpload
+        self.credentials  # 確保憑證有效
+        media = MediaFileUpload(file_path, chunksize=chunk_size or DRIVE_UPLOAD_CHUNK_SIZE, resumable=True)
+        request = self.service.files().create(
+            body={"name": file_name, "parents": [folder_id]}, media_body=media, fields="id")
+        return self._upload_chunks(request)["id"]
+
+    def _upload_chunks(self, request):
+        HttpError, retryable = _retryable_errors()
+        response = None
+        attempt = 0
+        while response is None:
+            try:
+                status, response = request.next_chunk(http=self.http)
+                attempt = 0
+                if status:
+                    logger.debug(f"Google Drive 上傳進度：{int(status.progress() * 100)}%")
+            except retryable as e:
+                if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUS:
+                    raise
+                attempt += 1
+                if attempt > DRIVE_UPLOAD_RETRIES:
+                    raise
+                delay = min(2 ** (attempt - 1), 32) + random.random()
+                logger.warning(f"Google Drive 分段上傳中斷，{delay:.1f} 秒後續傳（第 {attempt} 次）：{e}")
+                time.sleep(delay)
+        return response
+
+    def start_resumable_upload(self, file_name, folder_id, mimetype=None, chunk_size=None):
+        """建立 resumable upload session，回傳可分段寫入的 ResumableUpload"""
+        headers = {"Content-Type": "application/json; charset=UTF-8"}
+        if mimetype:
+            headers["X-Upload-Content-Type"] = mimetype
+        resp, content = self.http.request(
+            DRIVE_UPLOAD_URL, method="POST", headers=headers,
+            body=json.dumps({"name": file_name, "parents": [folder_id]}))
+        if resp.status != 200 or "location" not in resp:
+            from googleapiclient.errors import HttpError
+            raise HttpError(resp, content, uri=DRIVE_UPLOAD_URL)
+        return ResumableUpload(self, resp["location"], chunk_size or DRIVE_STREAM_CHUNK_SIZE)
+
+    def resume_upload(self, session_uri, offset, file_path, chunk_size=None):
+        """從本地暫存檔續傳中斷的 session，檔案內容由 offset 位元組開始；回傳檔案 ID"""
+        upload = ResumableUpload(self, session_uri, chunk_size or DRIVE_STREAM_CHUNK_SIZE, offset)
+        file_id = upload.query_offset()
+        if file_id:
+            return file_id
+        with open(file_path, "rb") as f:
+            f.seek(upload.offset - offset)
+            for block in iter(lambda: f.read(upload.chunk_size), b""):
+                upload.write(block)
+        return upload.finish()
+
+    def make_public(self, file_id):
+        """將檔案設為公開可讀；同時間多個檔案的請求會合併成一次 batch"""
+        self._permissions.grant(file_id).result(timeout=DRIVE_HTTP_TIMEOUT * 2)
+
+
+class ResumableUpload:
+    """以 resumable upload 協定分段串流上傳，記憶體中最多保留約一個分段的資料
+
+    offset 為 Drive 已確認收到的位元組數，buffer 為尚未確認的資料。
+    """
+
+    def __init__(self, client, session_uri, chunk_size, offset=0):
+        self.client = client
+        self.session_uri = session_uri
+        self.chunk_size = chunk_size
+        self.offset = offset
+        self.buffer = bytearray()
+        self.stalled = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._send(final=False)
+
+    def finish(self):
+        """送出最後一段並回傳檔案 ID"""
+        while True:
+            file_id = self._send(final=True)
+            if file_id:
+                return file_id
+
+    def cancel(self):
+        """放棄此上傳 session，Drive 不會建立檔案"""
+        try:
+            self.client.http.request(self.session_uri, method="DELETE")
+        except Exception as e:
+            logger.warning(f"取消上傳 session 失敗：{e}")
+        self.buffer.clear()
+
+    def query_offset(self):
+        """查詢 Drive 已收到的位元組數；上傳已完成時回傳檔案 ID"""
+        resp, content = self.client.http.request(
+            self.session_uri, method="PUT", headers={"Content-Range": "bytes */*", "Content-Length": "0"})
+        return self._handle_response(resp, content)
+
+    def _send(self, final):
+        HttpError, retryable = _retryable_errors()
+        attempt = 0
+        while True:
+            chunk = bytes(self.buffer[:self.chunk_size] if not final else self.buffer)
+            total = str(self.offset + len(chunk)) if final else "*"
+            if chunk:
+                content_range = f"bytes {self.offset}-{self.offset + len(chunk) - 1}/{total}"
+            else:
+                content_range = f"bytes */{total}"
+            try:
+                resp, content = self.client.http.request(
+                    self.session_uri, method="PUT", body=chunk,
+                    headers={"Content-Range": content_range, "Content-Length": str(len(chunk))})
+                if resp.status in RETRYABLE_STATUS:
+                    raise HttpError(resp, content, uri=self.session_uri)
+                offset = self.offset
+                file_id = self._handle_response(resp, content)
+            except retryable as e:
+                if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUS:
+                    raise DriveUploadFailed(self, e) from e
+                attempt += 1
+                if attempt > DRIVE_UPLOAD_RETRIES:
+                    raise DriveUploadInterrupted(self, e)
+                delay = min(2 ** (attempt - 1), 32) + random.random()
+                logger.warning(f"Google Drive 串流分段失敗，{delay:.1f} 秒後重試（第 {attempt} 次）：{e}")
+                time.sleep(delay)
+                try:
+                    file_id = self.query_offset()
+                    if file_id:
+                        return file_id
+                except Exception as query_error:
+                    logger.warning(f"查詢上傳進度失敗：{query_error}")
+                continue
+
+            if file_id or self.offset > offset:
+                self.stalled = 0
+                return file_id
+            # 308 但 Drive 沒有保存任何新資料，重送同一段也計入重試次數，避免無限重送
+            self.stalled += 1
+            if self.stalled > DRIVE_UPLOAD_RETRIES:
+                raise DriveUploadInterrupted(self, f"連續 {self.stalled} 次分段沒有進度")
+            delay = min(2 ** (self.stalled - 1), 32) + random.random()
+            logger.warning(f"Google Drive 未保存分段，{delay:.1f} 秒後重送（第 {self.stalled} 次）")
+            time.sleep(delay)
+            return None
+
+    def _handle_response(self, resp, content):
+        if resp.status in (200, 201):
+            self.offset += len(self.buffer)
+            self.buffer.clear()
+            return json.loads(content)["id"]
+        if resp.status == 308:
+            # Range 標頭為 Drive 已保存的範圍，未保存的資料留在 buffer 中重送
+            persisted = int(resp["range"].rsplit("-", 1)[1]) + 1 if "range" in resp else 0
+            if persisted > self.offset:
+                del self.buffer[:persisted - self.offset]
+                self.offset = persisted
+            return None
+        from googleapiclient.errors import HttpError
+        raise HttpError(resp, content, uri=self.session_uri)
+
+
+class PermissionBatcher:
+    """將短時間內的多個 permissions().create 請求合併成一次 batch HTTP 請求"""
+
+    def __init__(self, client, window=DRIVE_PERMISSION_BATCH_WINDOW, max_batch=100):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def grant(self, file_id):
+        future = Future()
+        with self._lock:
+            self._pending.append((file_id, future))
+            if len(self._pending) >= self.max_batch:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            threading.Thread(target=self._execute, args=(pending,), daemon=True).start()
+
+    def _execute(self, pending):
+        try:
+            service = self.client.service
+            if len(pending) == 1:
+                file_id, future = pending[0]
+                service.permissions().create(
+                    fileId=file_id, body={"type": "anyone", "role": "reader"}).execute(http=self.client.http)
+                future.set_result(file_id)
+                return
+
+            futures = {str(i): future for i, (_, future) in enumerate(pending)}
+
+            def callback(request_id, response, exception):
+                future = futures[request_id]
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(response)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for i, (file_id, _) in enumerate(pending):
+                batch.add(service.permissions().create(
+                    fileId=file_id, body={"type": "anyone", "role": "reader"}), request_id=str(i))
+            batch.execute(http=self.client.http)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+
+drive_client = DriveClient()
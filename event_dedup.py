@@ -0,0 +1,119 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from metrics import registry, Counter
+from repositories import webhook_event_repository
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+DUPLICATES_TOTAL = registry.register(Counter(
+    "linebot_webhook_duplicates_total", "略過的重複 webhook 事件數", ("source",)))
+
+
+def event_keys(event):
+    """事件的去重鍵：webhookEventId 與訊息 ID"""
+    keys = []
+    if getattr(event, "webhook_event_id", None):
+        keys.append(f"event:{event.webhook_event_id}")
+    message = getattr(event, "message", None)
+    if getattr(message, "id", None):
+        keys.append(f"message:{message.id}")
+    return keys
+
+
+def is_redelivery(event):
+    context = getattr(event, "delivery_context", None)
+    return bool(getattr(context, "is_redelivery", False))
+
+
+class EventDeduplicator:
+    """去除 LINE 重送的 webhook 事件，避免重複呼叫 OpenAI 與寫入對話紀錄
+
+    先查行程內的 LRU；未命中時以共用儲存後端的事件鍵為準，多個 worker 之間也只會處理一次。
+    一般事件只需寫入事件鍵，標記為重送的事件才以交易檢查。儲存後端失敗時照常處理事件。
+    """
+
+    def __init__(self, repository=None, ttl=86400, lru_size=10000, purge_every=1000):
+        self.repository = repository or webhook_event_repository
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self.purge_every = purge_every
+        self.duplicates = 0
+        self._seen = OrderedDict()
+        self._recorded = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """依環境變數建立 deduplicator"""
+        return cls(
+            ttl=int(os.getenv("WEBHOOK_DEDUP_TTL", "86400")),
+            lru_size=int(os.getenv("WEBHOOK_DEDUP_LRU_SIZE", "10000")),
+        )
+
+    def seen_locally(self, event):
+        """只查行程內的 LRU，不存取儲存後端；重複時回傳 True"""
+        keys = event_keys(event)
+        with self._lock:
+            for key in keys:
+                if key in self._seen:
+                    self._seen.move_to_end(key)
+                    self._duplicate("memory")
+                    return True
+        return False
+
+    def claim(self, event):
+        """記錄事件為已處理；已由本行程或其他 worker 處理過時回傳 False"""
+        keys = event_keys(event)
+        if not keys:
+            return True
+        with self._lock:
+            if any(key in self._seen for key in keys):
+                self._duplicate("memory")
+                return False
+            for key in keys:
+                self._remember(key)
+
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=self.ttl)
+        try:
+            if is_redelivery(event):
+                for key in keys:
+                    if not self.repository.claim(key, now, expires_at):
+                        self._duplicate("store")
+                        return False
+            else:
+                self.repository.record(keys, expires_at)
+        except Exception as e:
+            logger.error(f"記錄 webhook 事件失敗，照常處理：{e}")
+            return True
+        self._maybe_purge(now)
+        return True
+
+    def _remember(self, key):
+        self._seen[key] = True
+        if len(self._seen) > self.lru_size:
+            self._seen.popitem(last=False)
+
+    def _duplicate(self, source):
+        self.duplicates += 1
+        DUPLICATES_TOTAL.inc(source=source)
+
+    def _maybe_purge(self, now):
+        with self._lock:
+            self._recorded += 1
+            due = self.purge_every and self._recorded % self.purge_every == 0
+        if due:
+            try:
+                purged = self.repository.purge(now)
+                if purged:
+                    logger.info(f"已清除 {purged} 個過期的 webhook 事件鍵")
+            except Exception as e:
+                logger.warning(f"清除過期的 webhook 事件鍵失敗：{e}")
+
+    def stats(self):
+        return {"duplicates": self.duplicates, "cached": len(self._seen)}
@@ -1,9 +1,13 @@
 # firebase_utils.py
+import logging
 import firebase_admin
 from firebase_admin import credentials, firestore
 import os
 import json
 
+# 設定日誌
+logger = logging.getLogger(__name__)
+
 # 初始化 Firebase
 def initialize_firebase():
     if not firebase_admin._apps:  # 確保只初始化一次
@@ -13,9 +17,9 @@ def initialize_firebase():
                 raise ValueError("FIREBASE_CREDENTIALS 環境變數未設置或無效。")
             cred = credentials.Certificate(firebase_info)
             firebase_admin.initialize_app(cred)
-            print("Firebase 初始化成功")
+            logger.info("Firebase 初始化成功")
         except Exception as e:
-            print(f"Firebase 初始化失敗：{e}")
+            logger.error(f"Firebase 初始化失敗：{e}")
             raise
 
 # 確保 Firebase 已初始化並返回 Firestore 客戶端
@@ -1,200 +1,319 @@
+import os
+import re
+import logging
 from linebot.models import FlexSendMessage
-from flask import url_for, request
+from flask import url_for, has_request_context
 
+# 設定日誌
+logger = logging.getLogger(__name__)
 
-def create_upload_success_flex(file_name,year, subject, grade,price):
-    image_url = url_for('static', filename='images/Enote_Logo.png', _external=True)
+# 對外網址，例如 https://enote.example.com；背景執行緒產生訊息時使用
+APP_BASE_URL = os.getenv("APP_BASE_URL") or (f"https://{os.getenv('APP_HOST')}" if os.getenv("APP_HOST") else "")
+DEFAULT_BASE_URL = "https://yourdomain.com"
 
-    """建立 Flex Message 用於通知檔案上傳成功"""
-    return FlexSendMessage(
-        alt_text="檔案上傳成功通知",
-        contents={
-            "type": "bubble",
-            "hero": {
-                "type": "image",
-                "url": image_url,  # 使用生成的圖片 
-                "size": "full",
-                "aspectRatio": "20:10",
-                "aspectMode": "cover"
+FLEX_COMPONENT_REQUIRED = {
+    "bubble": (),
+    "box": ("layout", "contents"),
+    "text": ("text",),
+    "image": ("url",),
+    "button": ("action",),
+    "separator": (),
+    "filler": (),
+    "icon": ("url",),
+    "span": ("text",),
+}
+SLOT_RE = re.compile(r"\{(\w+)\}")
+
+
+def static_url(filename):
+    """取得靜態檔案的完整網址；有設定 APP_BASE_URL 時不需要 request context"""
+    if APP_BASE_URL:
+        return f"{APP_BASE_URL.rstrip('/')}/static/{filename}"
+    if has_request_context():
+        return url_for('static', filename=filename, _external=True)
+    logger.warning("未設定 APP_BASE_URL，背景產生的訊息將使用預設網址")
+    return f"{DEFAULT_BASE_URL}/static/{filename}"
+
+
+class RenderedFlexMessage(FlexSendMessage):
+    """由 FlexTemplate 產生的 Flex Message，送出時直接使用預先組好的 JSON，不建立 SDK 物件樹"""
+
+    def __init__(self, alt_text, contents, quick_reply=None, **kwargs):
+        self.type = "flex"
+        self.alt_text = alt_text
+        self.contents = contents
+        self.quick_reply = quick_reply
+
+    def as_json_dict(self):
+        data = {"type": self.type, "altText": self.alt_text, "contents": self.contents}
+        if self.quick_reply is not None:
+            data["quickReply"] = self.quick_reply.as_json_dict()
+        return data
+
+
+class FlexTemplate:
+    """預先編譯的 Flex bubble 模板
+
+    建立時驗證一次 bubble 結構，並為含有 {slot} 的節點建立填值函式；每次產生訊息只複製
+    含有欄位的節點，其餘靜態節點直接共用，可在 request 之外及大量產生時使用。
+    產生的 dict 與模板共用靜態節點，不可修改。
+    """
+
+    def __init__(self, alt_text, skeleton):
+        self.alt_text = alt_text
+        self._validate(skeleton)
+        slots = []
+        self._fill = self._compile(skeleton, slots)
+        self._skeleton = skeleton
+        self.slots = tuple(slots)
+
+    @classmethod
+    def _compile(cls, node, slots):
+        """回傳以欄位值產生該節點的函式；節點不含欄位時回傳 None"""
+        if isinstance(node, str):
+            pieces = SLOT_RE.split(node)
+            if len(pieces) == 1:
+                return None
+            static, names = pieces[0::2], pieces[1::2]
+            slots.extend(names)
+            if len(names) == 1 and not static[0] and not static[1]:
+                name = names[0]
+                return lambda values: str(values[name])
+            rest = tuple(zip(names, static[1:]))
+            return lambda values: static[0] + "".join(str(values[name]) + tail for name, tail in rest)
+        if isinstance(node, dict):
+            fills = [(key, fill) for key, child in node.items()
+                     if (fill := cls._compile(child, slots)) is not None]
+            if not fills:
+                return None
+            return lambda values: {**node, **{key: fill(values) for key, fill in fills}}
+        if isinstance(node, list):
+            children = [(child, cls._compile(child, slots)) for child in node]
+            if all(fill is None for _, fill in children):
+                return None
+            return lambda values: [child if fill is None else fill(values) for child, fill in children]
+        return None
+
+    @classmethod
+    def _validate(cls, component, path="contents"):
+        if isinstance(component, list):
+            for i, child in enumerate(component):
+                cls._validate(child, f"{path}[{i}]")
+            return
+        if not isinstance(component, dict):
+            return
+        kind = component.get("type")
+        if kind in FLEX_COMPONENT_REQUIRED:
+            missing = [key for key in FLEX_COMPONENT_REQUIRED[kind] if key not in component]
+            if missing:
+                raise ValueError(f"Flex 模板 {path} ({kind}) 缺少欄位：{', '.join(missing)}")
+        for key, value in component.items():
+            cls._validate(value, f"{path}.{key}")
+
+    def render_contents(self, **values):
+        """填入欄位值，回傳 bubble 的 dict"""
+        return self._skeleton if self._fill is None else self._fill(values)
+
+    def render(self, **values):
+        """產生可直接 push 的 Flex Message"""
+        return RenderedFlexMessage(self.alt_text, self.render_contents(**values))
+
+    def render_many(self, rows):
+        """批次產生多則訊息，rows 為欄位值 dict 的序列"""
+        return [self.render(**row) for row in rows]
+
+
+UPLOAD_SUCCESS_TEMPLATE = FlexTemplate("檔案上傳成功通知", {
+    "type": "bubble",
+    "hero": {
+        "type": "image",
+        "url": "{image_url}",  # 使用生成的圖片 
+        "size": "full",
+        "aspectRatio": "20:10",
+        "aspectMode": "cover"
+    },
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "檔案上傳成功！",
+                "weight": "bold",
+                "size": "xl",
+                "margin": "md",
+                "align": "center"
             },
-            "body": {
+            {
+                "type": "separator",
+                "margin": "md"
+            },
+            {
                 "type": "box",
                 "layout": "vertical",
+                "margin": "lg",
+                "spacing": "sm",
                 "contents": [
                     {
-                        "type": "text",
-                        "text": "檔案上傳成功！",
-                        "weight": "bold",
-                        "size": "xl",
-                        "margin": "md",
-                        "align": "center"
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "檔案名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{file_name}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
                     },
                     {
-                        "type": "separator",
-                        "margin": "md"
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "科目名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{subject}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
                     },
                     {
                         "type": "box",
-                        "layout": "vertical",
-                        "margin": "lg",
-                        "spacing": "sm",
+                        "layout": "baseline",
                         "contents": [
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "檔案名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": file_name, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "科目名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": subject, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": grade, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "筆記年份", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": year, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "期望定價", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": price, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "目前狀態", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": "審核中", "wrap": True, "color": "#FF6B6E", "size": "sm", "flex": 4}
-                                ]
-                            }
+                            {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{grade}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
                         ]
-                    }
-                ]
-            }
-        }
-    )
-
-
+                    },
 
+                    {
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "筆記年份", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{year}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
+                    },
 
+                    {
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "期望定價", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{price}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
+                    },
 
-#通知用戶已經成功上架
-def create_review_success_flex(file_name, subject, grade, price, file_url):
-    image_url = url_for('static', filename='images/Enote_Logo.png', _external=True)
+                    {
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "目前狀態", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "審核中", "wrap": True, "color": "#FF6B6E", "size": "sm", "flex": 4}
+                        ]
+                    }
+                ]
+            }
+        ]
+    }
+})
 
-    """建立 Flex Message 用於通知審核成功"""
-    return FlexSendMessage(
-        alt_text="審核成功通知",
-        contents={
-            "type": "bubble",
-            "hero": {
-                "type": "image",
-                "url": image_url,  # 使用生成的圖片 URL
-                "size": "full",
-                "aspectRatio": "20:10",
-                "aspectMode": "cover"
+REVIEW_SUCCESS_TEMPLATE = FlexTemplate("審核成功通知", {
+    "type": "bubble",
+    "hero": {
+        "type": "image",
+        "url": "{image_url}",  # 使用生成的圖片 URL
+        "size": "full",
+        "aspectRatio": "20:10",
+        "aspectMode": "cover"
+    },
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "審核成功！",
+                "weight": "bold",
+                "size": "xl",
+                "margin": "md",
+                "align": "center",
+                "color": "#1DB446"
+            },
+            {
+                "type": "text",
+                "text": "您的筆記已成功上架，感謝您的分享！",
+                "wrap": True,
+                "size": "md",
+                "margin": "md",
+                "color": "#666666"
+            },
+            {
+                "type": "separator",
+                "margin": "md"
             },
-            "body": {
+            {
                 "type": "box",
                 "layout": "vertical",
+                "margin": "lg",
+                "spacing": "sm",
                 "contents": [
                     {
-                        "type": "text",
-                        "text": "審核成功！",
-                        "weight": "bold",
-                        "size": "xl",
-                        "margin": "md",
-                        "align": "center",
-                        "color": "#1DB446"
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "檔案名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{file_name}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
                     },
                     {
-                        "type": "text",
-                        "text": "您的筆記已成功上架，感謝您的分享！",
-                        "wrap": True,
-                        "size": "md",
-                        "margin": "md",
-                        "color": "#666666"
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "科目名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{subject}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
                     },
                     {
-                        "type": "separator",
-                        "margin": "md"
+                        "type": "box",
+                        "layout": "baseline",
+                        "contents": [
+                            {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{grade}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
+                        ]
                     },
+
                     {
                         "type": "box",
-                        "layout": "vertical",
-                        "margin": "lg",
-                        "spacing": "sm",
+                        "layout": "baseline",
                         "contents": [
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "檔案名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": file_name, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "科目名稱", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": subject, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": grade, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-
-                            {
-                                "type": "box",
-                                "layout": "baseline",
-                                "contents": [
-                                    {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
-                                    {"type": "text", "text": price, "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
-                                ]
-                            },
-
-
-                            {
-                                "type": "button",
-                                "style": "primary",
-                                "action": {
-                                    "type": "uri",
-                                    "label": "查看筆記",
-                                    "uri": file_url
-                                }
-                            }
+                            {"type": "text", "text": "年級", "color": "#aaaaaa", "size": "sm", "flex": 2},
+                            {"type": "text", "text": "{price}", "wrap": True, "color": "#666666", "size": "sm", "flex": 4}
                         ]
+                    },
+
+
+                    {
+                        "type": "button",
+                        "style": "primary",
+                        "action": {
+                            "type": "uri",
+                            "label": "查看筆記",
+                            "uri": "{file_url}"
+                        }
                     }
                 ]
             }
-        }
+        ]
+    }
+})
+
+
+def create_upload_success_flex(file_name, year, subject, grade, price):
+    """建立 Flex Message 用於通知檔案上傳成功"""
+    return UPLOAD_SUCCESS_TEMPLATE.render(
+        image_url=static_url('images/Enote_Logo.png'),
+        file_name=file_name, year=year, subject=subject, grade=grade, price=price
+    )
+
+
+#通知用戶已經成功上架
+def create_review_success_flex(file_name, subject, grade, price, file_url):
+    """建立 Flex Message 用於通知審核成功"""
+    return REVIEW_SUCCESS_TEMPLATE.render(
+        image_url=static_url('images/Enote_Logo.png'),
+        file_name=file_name, subject=subject, grade=grade, price=price, file_url=file_url
     )
@@ -0,0 +1,55 @@
+"""付款截圖的縮圖與感知雜湊
+
+在 process pool 的子行程中執行，只依賴標準函式庫與 Pillow，子行程啟動時不必載入整個應用程式。
+Pillow 於第一次分析時才載入；未安裝時回傳錯誤，不影響截圖的保存。
+"""
+import os
+
+THUMBNAIL_SIZE = (320, 320)
+HASH_SIZE = 8  # 8x8 個位元，共 64 位元的雜湊
+
+
+def register_worker(pids):
+    """process pool 的 initializer：回報子行程的 PID，讓父行程能結束卡住的子行程"""
+    pids.put(os.getpid())
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """difference hash：縮成 (hash_size+1) x hash_size 的灰階圖，比較相鄰像素的亮度，回傳 16 進位字串
+
+    重新壓縮、縮放或輕微調整色彩後的截圖，雜湊只會相差幾個位元。
+    """
+    from PIL import Image
+
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = value << 1 | (left > right)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def analyze(file_path, thumbnail_path, size=THUMBNAIL_SIZE):
+    """產生 JPEG 縮圖並計算感知雜湊，回傳 {"phash", "width", "height"}；無法處理時回傳 {"error"}"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {"error": "未安裝 Pillow"}
+
+    try:
+        with Image.open(file_path) as image:
+            width, height = image.size
+            # JPEG 直接以接近縮圖的比例解碼，不必解碼完整解析度
+            image.draft("RGB", (size[0] * 2, size[1] * 2))
+            image = ImageOps.exif_transpose(image)
+            phash = dhash(image)
+            thumbnail = image.convert("RGB")
+            thumbnail.thumbnail(size)
+            thumbnail.save(thumbnail_path, "JPEG", quality=80, optimize=True)
+    except Exception as e:
+        # 不是圖片、檔案損毀或解壓縮炸彈 (DecompressionBombError)，重試也無法處理
+        return {"error": f"無法讀取圖片：{e}"}
+    return {"phash": phash, "width": width, "height": height}
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from structured_logging import correlation, current_correlation_id
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """佇列中的單一工作"""
+
+    def __init__(self, job_id, payload, attempts, enqueued_at):
+        self.id = job_id
+        self.payload = payload
+        self.attempts = attempts
+        self.enqueued_at = enqueued_at
+
+
+class JobQueue:
+    """以 SQLite 保存的持久化背景工作佇列
+
+    固定數量的工作執行緒處理工作，失敗時以指數退避重試，重啟後會繼續處理未完成的工作。
+    多個行程共用同一個資料庫檔案時，以 BEGIN IMMEDIATE 確保每個工作只被領取一次；
+    執行中的工作超過 lease 秒未完成（例如行程中途結束）會重新排入佇列。
+    完成超過 retention_days 天的工作會在領取工作時（每 purge_interval 秒最多一次）刪除，失敗的工作保留供人工處理。
+    """
+
+    def __init__(self, db_path, handler, workers=2, max_attempts=5, backoff=5, lease=600,
+                 on_failure=None, poll_interval=1.0,
+                 retention_days=int(os.getenv("JOB_RETENTION_DAYS", "7")), purge_interval=3600):
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.on_failure = on_failure
+        self.poll_interval = poll_interval
+        self.retention = retention_days * 86400
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._latencies = []
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run_at REAL NOT NULL,
+                enqueued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                last_error TEXT
+            )
+        """)
+        self._connect().execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_run_at)")
+
+    def start(self):
+        """啟動工作執行緒（只會啟動一次）"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, payload):
+        """新增工作並喚醒工作執行緒，回傳工作 ID；工作執行時沿用排入時的 correlation ID"""
+        if current_correlation_id() and "correlation_id" not in payload:
+            payload = {**payload, "correlation_id": current_correlation_id()}
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO jobs (payload, next_run_at, enqueued_at) VALUES (?, ?, ?)",
+            (json.dumps(payload, ensure_ascii=False), now, now))
+        with self._wakeup:
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    def checkpoint(self, job, **fields):
+        """保存工作的中間結果，重試時可略過已完成的步驟"""
+        job.payload.update(fields)
+        self._connect().execute("UPDATE jobs SET payload = ? WHERE id = ?",
+                                (json.dumps(job.payload, ensure_ascii=False), job.id))
+
+    def status(self, job_id):
+        row = self._connect().execute(
+            "SELECT status, attempts, last_error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def stats(self):
+        """佇列深度與處理延遲"""
+        rows = self._connect().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {row["status"]: row["n"] for row in rows}
+        oldest = self._connect().execute(
+            "SELECT MIN(enqueued_at) FROM jobs WHERE status = 'pending'").fetchone()[0]
+        latencies = sorted(self._latencies)
+        return {
+            "depth": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_pending_age": time.time() - oldest if oldest else 0.0,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
+
+    def _claim(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 執行逾時的工作視為中斷，重新排入佇列
+            conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running' AND started_at < ?",
+                         (now - self.lease,))
+            if now >= self._next_purge:
+                self._next_purge = now + self.purge_interval
+                purged = conn.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?",
+                                      (now - self.retention,)).rowcount
+                if purged:
+                    logger.info(f"已刪除 {purged} 筆完成超過 {self.retention / 86400:g} 天的工作")
+            row = conn.execute(
+                "SELECT id, payload, attempts, enqueued_at FROM jobs "
+                "WHERE status = 'pending' AND next_run_at <= ? ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?",
+                         (now, row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return Job(row["id"], json.loads(row["payload"]), row["attempts"] + 1, row["enqueued_at"])
+
+    def _complete(self, job):
+        now = time.time()
+        self._connect().execute(
+            "UPDATE jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ?", (now, job.id))
+        with self._lock:
+            self._latencies.append(now - job.enqueued_at)
+            self._latencies = self._latencies[-1000:]
+
+    def _fail(self, job, error):
+        if job.attempts < self.max_attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            self._connect().execute(
+                "UPDATE jobs SET status = 'pending', next_run_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, str(error), job.id))
+            logger.warning(f"工作 {job.id} 失敗，{delay} 秒後重試（第 {job.attempts} 次）：{error}")
+            return
+        self._connect().execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, last_error = ? WHERE id = ?",
+            (time.time(), str(error), job.id))
+        logger.error(f"工作 {job.id} 已達重試上限：{error}")
+        if self.on_failure:
+            try:
+                self.on_failure(job, error)
+            except Exception as e:
+                logger.error(f"工作 {job.id} 失敗處理發生錯誤：{e}")
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"領取工作失敗：{e}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            with correlation(job.payload.get("correlation_id") or f"job-{job.id}"):
+                try:
+                    self.handler(self, job)
+                    self._complete(job)
+                except Exception as e:
+                    self._fail(job, e)
@@ -0,0 +1,170 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from storage import DELETE
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class StorageLeaseStore:
+    """以儲存後端的文件保存租約，取得與續約都在交易中完成
+
+    到期時間使用各節點的時鐘，節點之間須以 NTP 校時；ttl 應遠大於可能的時鐘誤差。
+    Firestore 後端可透過 FIRESTORE_EMULATOR_HOST 連線到 emulator 測試。
+    """
+
+    def __init__(self, store, collection="leases"):
+        self.store = store
+        self.collection = collection
+
+    def try_acquire(self, name, holder, ttl, now=None):
+        """取得或續約租約，成功時回傳 True"""
+        now = time.time() if now is None else now
+
+        def acquire(lease):
+            if lease and lease.get("holder") != holder and lease.get("expires_at", 0) > now:
+                return None, False
+            renewing = lease is not None and lease.get("holder") == holder
+            return {
+                "holder": holder,
+                "expires_at": now + ttl,
+                "renewed_at": now,
+                "acquired_at": lease.get("acquired_at", now) if renewing else now
+            }, True
+
+        return self.store.transact(self.collection, name, acquire)
+
+    def release(self, name, holder):
+        """釋放自己持有的租約，讓其他行程立即接手"""
+        def release(lease):
+            if lease and lease.get("holder") == holder:
+                return DELETE, None
+            return None, None
+
+        self.store.transact(self.collection, name, release)
+
+
+class InMemoryLeaseStore:
+    """記憶體中的租約，用於單一行程部署與測試"""
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, name, holder, ttl, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            lease = self._leases.get(name)
+            if lease and lease["holder"] != holder and lease["expires_at"] > now:
+                return False
+            self._leases[name] = {"holder": holder, "expires_at": now + ttl}
+            return True
+
+    def release(self, name, holder):
+        with self._lock:
+            if self._leases.get(name, {}).get("holder") == holder:
+                del self._leases[name]
+
+    def holder(self, name):
+        lease = self._leases.get(name)
+        return lease["holder"] if lease else None
+
+
+class LeaderElector:
+    """以租約選出唯一的領導者執行單例工作
+
+    每 heartbeat 秒續約一次，租約 ttl 秒後到期；領導者失聯時其他行程最多約 ttl 秒內接手。
+    續約失敗時，會在租約可能被他人取得之前先停止工作。
+    """
+
+    def __init__(self, name, store, on_elected, on_revoked=None, ttl=10, heartbeat=None,
+                 holder=None, clock=time.time):
+        self.name = name
+        self.store = store
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 3
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.clock = clock
+        self.is_leader = False
+        self._last_renewed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, name, store, on_elected, on_revoked=None):
+        """依環境變數建立 elector"""
+        return cls(name, store, on_elected, on_revoked,
+                   ttl=float(os.getenv("LEADER_LEASE_TTL", "10")),
+                   heartbeat=float(os.getenv("LEADER_HEARTBEAT", "3")))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """停止選舉並釋放租約"""
+        self._stop.set()
+        if self.is_leader:
+            self._step_down()
+            try:
+                self.store.release(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"釋放租約失敗：{e}")
+
+    def step(self):
+        """執行一次取得或續約，回傳目前是否為領導者"""
+        now = self.clock()
+        try:
+            acquired = self.store.try_acquire(self.name, self.holder, self.ttl, now=now)
+            if acquired:
+                self._last_renewed = now
+        except Exception as e:
+            logger.warning(f"租約 {self.name} 續約失敗：{e}")
+            # 無法確認租約時，在可能被他人取得前先停止
+            acquired = self.is_leader and now - self._last_renewed < self.ttl - self.heartbeat
+
+        if acquired:
+            if not self.is_leader:
+                self._take_over()
+        elif self.is_leader:
+            self._step_down()
+        return self.is_leader
+
+    def _take_over(self):
+        # 單例工作啟動成功後才算是領導者；失敗時釋放租約，讓下一次 heartbeat（或其他行程）重試
+        try:
+            self.on_elected()
+        except Exception as e:
+            logger.error(f"{self.holder} 啟動 {self.name} 的單例工作失敗，釋放租約：{e}")
+            try:
+                self.store.release(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"釋放租約失敗：{e}")
+            return
+        self.is_leader = True
+        logger.info(f"{self.holder} 成為 {self.name} 的領導者")
+
+    def _step_down(self):
+        self.is_leader = False
+        logger.info(f"{self.holder} 不再是 {self.name} 的領導者")
+        if self.on_revoked:
+            try:
+                self.on_revoked()
+            except Exception as e:
+                logger.error(f"停止單例工作失敗：{e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"領導者選舉發生錯誤：{e}")
+            self._stop.wait(self.heartbeat)
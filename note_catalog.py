@@ -0,0 +1,204 @@
+import os
+import logging
+import threading
+import unicodedata
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+APPROVED_STATUS = "上架成功"
+
+# 尚未遷移到 notes 集合的舊筆記編號與價格；目錄中沒有該編號時使用
+NOTES_PRICING = {
+    "A01": 150,
+    "A02": 150,
+    "A03": 150,
+    "A04": 30,
+    "A05": 150,
+    "A06": 150,
+    "A07": 150,
+    "A08": 150,
+    "A09": 150,
+    "A10": 100,
+    "A11": 150,
+    "A12": 150
+}
+
+
+def normalize_text(text):
+    """全形轉半形、英文轉小寫並移除空白"""
+    return "".join(unicodedata.normalize("NFKC", str(text or "")).lower().split())
+
+
+def ngrams(text, n=2):
+    """字元 n-gram；中文沒有空白分詞，以相鄰兩字作為索引單位"""
+    text = normalize_text(text)
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def is_approved(note):
+    """上架成功的筆記；通知中、已通知的筆記以 claimed_status 判斷原本的審核結果"""
+    status = note.get("status")
+    if status == APPROVED_STATUS:
+        return True
+    return status in ("通知中", "已通知") and note.get("claimed_status") == APPROVED_STATUS
+
+
+class CatalogEntry:
+    __slots__ = ("id", "code", "file_name", "subject", "grade", "year", "price", "file_url")
+
+    def __init__(self, note_id, note):
+        self.id = note_id
+        self.code = (note.get("code") or "").upper() or None
+        self.file_name = note.get("file_name", "")
+        self.subject = note.get("subject", "")
+        self.grade = note.get("grade", "")
+        self.year = str(note.get("year", ""))
+        # 只使用審核時核定的價格，不直接採用上傳者填寫的價格
+        self.price = note.get("approved_price")
+        self.file_url = note.get("file_url")
+
+    @property
+    def grams(self):
+        return ngrams(self.subject) | ngrams(self.file_name)
+
+
+class NoteCatalog:
+    """已上架筆記的記憶體目錄
+
+    以筆記編號 (code) 查詢、依科目／年級／年份篩選，並以科目與檔名的字元 bigram 做中文全文搜尋。
+    由 notes 集合的 listener 逐筆更新，查詢時不存取儲存後端。
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._by_code = {}
+        self._grams = {}
+        self._facets = {"subject": {}, "grade": {}, "year": {}}
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._watch = None
+
+    def start_listener(self, repository):
+        """監聽 notes 集合（只啟動一次）；第一次回報的變更即為完整載入"""
+        if self._watch is not None:
+            return
+        if os.getenv("NOTE_CATALOG_LISTENER", "true").lower() not in ("1", "true", "yes"):
+            self._loaded.set()
+            return
+        try:
+            self._watch = repository.watch(self.on_changes)
+        except Exception as e:
+            logger.error(f"筆記目錄監聽啟動失敗：{e}")
+            self._loaded.set()
+
+    def on_changes(self, changes, read_time):
+        for change in changes:
+            document = change.document
+            if change.kind == "removed":
+                self.remove(document.id)
+            else:
+                self.upsert(document.id, document.data)
+        if not self._loaded.is_set():
+            logger.info(f"筆記目錄已載入：{len(self._entries)} 筆")
+            self._loaded.set()
+
+    def wait_loaded(self, timeout=None):
+        """等待第一次載入完成"""
+        return self._loaded.wait(timeout)
+
+    def upsert(self, note_id, note):
+        """新增或更新筆記；未上架的筆記自目錄移除"""
+        if not is_approved(note):
+            self.remove(note_id)
+            return
+        entry = CatalogEntry(note_id, note)
+        with self._lock:
+            self._remove(note_id)
+            self._entries[note_id] = entry
+            if entry.code and entry.price is not None:
+                self._by_code[entry.code] = entry
+            for gram in entry.grams:
+                self._grams.setdefault(gram, set()).add(note_id)
+            for field, index in self._facets.items():
+                index.setdefault(getattr(entry, field), set()).add(note_id)
+
+    def remove(self, note_id):
+        with self._lock:
+            self._remove(note_id)
+
+    def _remove(self, note_id):
+        entry = self._entries.pop(note_id, None)
+        if entry is None:
+            return
+        if entry.code and self._by_code.get(entry.code) is entry:
+            del self._by_code[entry.code]
+        for gram in entry.grams:
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(note_id)
+                if not ids:
+                    del self._grams[gram]
+        for field, index in self._facets.items():
+            ids = index.get(getattr(entry, field))
+            if ids is not None:
+                ids.discard(note_id)
+                if not ids:
+                    del index[getattr(entry, field)]
+
+    def get(self, code):
+        """以筆記編號查詢，目錄中沒有時查 NOTES_PRICING，都沒有則回傳 None"""
+        code = (code or "").upper()
+        entry = self._by_code.get(code)
+        if entry is None and code in NOTES_PRICING:
+            entry = CatalogEntry(None, {"code": code, "approved_price": NOTES_PRICING[code]})
+        return entry
+
+    def facets(self, field):
+        """某欄位目前所有的值，例如 facets("subject")"""
+        return sorted(self._facets[field])
+
+    def search(self, query="", subject=None, grade=None, year=None, limit=10):
+        """依關鍵字與篩選條件搜尋，結果依符合的 bigram 數排序"""
+        with self._lock:
+            candidates = None
+            for field, value in (("subject", subject), ("grade", grade), ("year", year)):
+                if value:
+                    ids = self._facets[field].get(str(value), set())
+                    candidates = ids if candidates is None else candidates & ids
+
+            grams = ngrams(query)
+            if grams:
+                scores = {}
+                for gram in grams:
+                    for note_id in self._grams.get(gram, ()):
+                        if candidates is None or note_id in candidates:
+                            scores[note_id] = scores.get(note_id, 0) + 1
+                # 至少要符合一半的 bigram，避免只有單一字相同的雜訊
+                threshold = max(1, len(grams) // 2)
+                ranked = sorted((n for n, s in scores.items() if s >= threshold),
+                                key=lambda n: (-scores[n], self._entries[n].code or "~", n))
+            else:
+                ids = self._entries if candidates is None else candidates
+                ranked = sorted(ids, key=lambda n: (self._entries[n].code or "~", n))
+            return [self._entries[n] for n in ranked[:limit]]
+
+    def parse_query(self, text):
+        """將「微積分 大一 112」拆成關鍵字與篩選條件，符合既有年級／年份的詞視為篩選"""
+        filters, words = {}, []
+        for token in (text or "").split():
+            for field in ("grade", "year"):
+                if field not in filters and token in self._facets[field]:
+                    filters[field] = token
+                    break
+            else:
+                words.append(token)
+        return " ".join(words), filters
+
+    def stats(self):
+        return {"notes": len(self._entries), "codes": len(self._by_code), "grams": len(self._grams)}
+
+
+note_catalog = NoteCatalog()
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import threading
+from repositories import note_repository
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class Fingerprint:
+    """邊接收邊計算檔案的 SHA-256 與大小"""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+    def wrap(self, chunks):
+        """包裝分段產生器，逐段計算指紋後原樣傳回"""
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    @classmethod
+    def of_file(cls, file_path, block_size=1024 * 1024):
+        fingerprint = cls()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                fingerprint.update(block)
+        return fingerprint
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+
+class FingerprintIndex:
+    """筆記內容指紋 (sha256, size) 到既有筆記的記憶體索引
+
+    第一次使用時從 notes 集合載入，之後由本行程新增的筆記即時更新；
+    記憶體未命中時再以 sha256 查詢儲存後端，涵蓋其他 worker 新增的筆記。
+    """
+
+    FIELDS = ["sha256", "size", "file_name", "file_url", "user_id"]
+
+    def __init__(self):
+        self._index = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                for doc in note_repository.list(self.FIELDS):
+                    note = doc.data
+                    if note.get("sha256"):
+                        self._index[(note["sha256"], note.get("size"))] = {"id": doc.id, **note}
+                logger.info(f"筆記指紋索引已載入：{len(self._index)} 筆")
+            except Exception as e:
+                logger.error(f"載入筆記指紋索引失敗：{e}")
+            self._loaded = True
+
+    def lookup(self, sha256, size):
+        """查詢相同內容的既有筆記，沒有則回傳 None"""
+        self._ensure_loaded()
+        note = self._index.get((sha256, size))
+        if note is not None:
+            return note
+        try:
+            for doc in note_repository.find_by_sha256(sha256):
+                if doc.data.get("size") == size:
+                    return self.add(doc.id, doc.data)
+        except Exception as e:
+            logger.error(f"查詢筆記指紋失敗：{e}")
+        return None
+
+    def add(self, note_id, note):
+        """加入新筆記的指紋"""
+        entry = {"id": note_id, **{k: note.get(k) for k in self.FIELDS}}
+        if entry.get("sha256"):
+            with self._lock:
+                self._index[(entry["sha256"], entry["size"])] = entry
+        return entry
+
+
+fingerprint_index = FingerprintIndex()
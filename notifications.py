@@ -1,62 +1,82 @@
-from linebot.models import FlexSendMessage
+import logging
+from linebot.models import TextSendMessage, QuickReply, QuickReplyButton, MessageAction
+from flexmessage import FlexTemplate, static_url
+from push_dispatcher import get_push_dispatcher
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# 審核通知模板，啟動時驗證並編譯一次
+REVIEW_SUCCESS_NOTICE = FlexTemplate("審核成功通知", {
+    "type": "bubble",
+    "hero": {"type": "image", "url": "{image_url}", "size": "full", "aspectRatio": "20:10", "aspectMode": "cover"},
+    "body": {"type": "box", "layout": "vertical", "contents": [
+        {"type": "text", "text": "審核成功！", "weight": "bold", "size": "xl", "align": "center", "color": "#1DB446"},
+        {"type": "text", "text": "您的筆記已成功上架，感謝您的分享！", "wrap": True, "size": "md", "margin": "md", "color": "#666666"},
+        {"type": "separator", "margin": "md"},
+        {"type": "text", "text": "檔案名稱: {file_name}", "wrap": True, "size": "sm", "color": "#666666"},
+        {"type": "text", "text": "科目名稱: {subject}", "wrap": True, "size": "sm", "color": "#666666"},
+        {"type": "text", "text": "年級: {grade}", "wrap": True, "size": "sm", "color": "#666666"},
+        {"type": "button", "style": "primary", "action": {"type": "uri", "label": "查看筆記", "uri": "{file_url}"}}
+    ]}
+})
+
+REVIEW_FAILURE_NOTICE = FlexTemplate("審核失敗通知", {
+    "type": "bubble",
+    "hero": {"type": "image", "url": "{image_url}", "size": "full", "aspectRatio": "20:10", "aspectMode": "cover"},
+    "body": {"type": "box", "layout": "vertical", "contents": [
+        {"type": "text", "text": "審核失敗", "weight": "bold", "size": "xl", "align": "center", "color": "#FF6B6E"},
+        {"type": "text", "text": "很抱歉，您的筆記未能通過審核。", "wrap": True, "size": "md", "margin": "md", "color": "#666666"},
+        {"type": "separator", "margin": "md"},
+        {"type": "text", "text": "檔案名稱: {file_name}", "wrap": True, "size": "sm", "color": "#666666"},
+        {"type": "text", "text": "失敗原因: {reason}", "wrap": True, "size": "sm", "color": "#FF6B6E"}
+    ]}
+})
 
 class NotificationHandler:
     """用於處理審核通知的類別"""
 
     @staticmethod
     def send_review_success_notification(line_bot_api, user_id, file_name, subject, grade, file_url):
-        """發送審核成功通知"""
+        """發送審核成功通知，回傳送達時完成的 future"""
         flex_message = NotificationHandler.create_review_success_flex(file_name, subject, grade, file_url)
-        try:
-            line_bot_api.push_message(user_id, flex_message)
-            print(f"審核成功通知已發送給用戶 {user_id}，檔案: {file_name}")
-        except Exception as e:
-            print(f"通知發送失敗: {e}")
+        # 交由 dispatcher 限流、重試並合併同一用戶的通知
+        future = get_push_dispatcher(line_bot_api).send(user_id, flex_message)
+        logger.info(f"審核成功通知已排入發送給用戶 {user_id}，檔案: {file_name}")
+        return future
 
     @staticmethod
     def send_review_failure_notification(line_bot_api, user_id, file_name, reason):
-        """發送審核失敗通知"""
+        """發送審核失敗通知，回傳送達時完成的 future"""
         flex_message = NotificationHandler.create_review_failure_flex(file_name, reason)
-        try:
-            line_bot_api.push_message(user_id, flex_message)
-            print(f"審核失敗通知已發送給用戶 {user_id}，檔案: {file_name}")
-        except Exception as e:
-            print(f"通知發送失敗: {e}")
+        # 交由 dispatcher 限流、重試並合併同一用戶的通知
+        future = get_push_dispatcher(line_bot_api).send(user_id, flex_message)
+        logger.info(f"審核失敗通知已排入發送給用戶 {user_id}，檔案: {file_name}")
+        return future
+
+    @staticmethod
+    def send_wish_fulfilled_notification(line_bot_api, user_ids, subject, file_name, code=None):
+        """通知許願該課程的用戶筆記已上架（一次 multicast）"""
+        text = f"購買筆記 {code}" if code else f"找筆記 {subject}"
+        message = TextSendMessage(
+            text=f"🎉 您許願的「{subject}」筆記上架囉！\n\n檔案名稱: {file_name}",
+            quick_reply=QuickReply(items=[QuickReplyButton(action=MessageAction(label=text[:20], text=text))])
+        )
+        get_push_dispatcher(line_bot_api).multicast(user_ids, message)
+        logger.info(f"許願通知已排入發送給 {len(user_ids)} 位用戶，科目: {subject}")
 
     @staticmethod
     def create_review_success_flex(file_name, subject, grade, file_url):
         """建立審核成功的 Flex Message"""
-        return FlexSendMessage(
-            alt_text="審核成功通知",
-            contents={
-                "type": "bubble",
-                "hero": {"type": "image", "url": "https://yourdomain.com/static/images/review_success.png", "size": "full", "aspectRatio": "20:10", "aspectMode": "cover"},
-                "body": {"type": "box", "layout": "vertical", "contents": [
-                    {"type": "text", "text": "審核成功！", "weight": "bold", "size": "xl", "align": "center", "color": "#1DB446"},
-                    {"type": "text", "text": "您的筆記已成功上架，感謝您的分享！", "wrap": True, "size": "md", "margin": "md", "color": "#666666"},
-                    {"type": "separator", "margin": "md"},
-                    {"type": "text", "text": f"檔案名稱: {file_name}", "wrap": True, "size": "sm", "color": "#666666"},
-                    {"type": "text", "text": f"科目名稱: {subject}", "wrap": True, "size": "sm", "color": "#666666"},
-                    {"type": "text", "text": f"年級: {grade}", "wrap": True, "size": "sm", "color": "#666666"},
-                    {"type": "button", "style": "primary", "action": {"type": "uri", "label": "查看筆記", "uri": file_url}}
-                ]}
-            }
+        return REVIEW_SUCCESS_NOTICE.render(
+            image_url=static_url("images/review_success.png"),
+            file_name=file_name, subject=subject, grade=grade, file_url=file_url
         )
 
     @staticmethod
     def create_review_failure_flex(file_name, reason):
         """建立審核失敗的 Flex Message"""
-        return FlexSendMessage(
-            alt_text="審核失敗通知",
-            contents={
-                "type": "bubble",
-                "hero": {"type": "image", "url": "https://yourdomain.com/static/images/review_failed.png", "size": "full", "aspectRatio": "20:10", "aspectMode": "cover"},
-                "body": {"type": "box", "layout": "vertical", "contents": [
-                    {"type": "text", "text": "審核失敗", "weight": "bold", "size": "xl", "align": "center", "color": "#FF6B6E"},
-                    {"type": "text", "text": "很抱歉，您的筆記未能通過審核。", "wrap": True, "size": "md", "margin": "md", "color": "#666666"},
-                    {"type": "separator", "margin": "md"},
-                    {"type": "text", "text": f"檔案名稱: {file_name}", "wrap": True, "size": "sm", "color": "#666666"},
-                    {"type": "text", "text": f"失敗原因: {reason}", "wrap": True, "size": "sm", "color": "#FF6B6E"}
-                ]}
-            }
+        return REVIEW_FAILURE_NOTICE.render(
+            image_url=static_url("images/review_failed.png"),
+            file_name=file_name, reason=reason
         )
@@ -0,0 +1,218 @@
+import os
+import signal
+import logging
+import mimetypes
+import threading
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import image_analysis
+from job_queue import JobQueue
+from drive_client import drive_client
+from note_index import Fingerprint
+from repositories import purchase_repository, payment_proof_repository
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# 從 LINE content API 讀取的分段大小，記憶體中最多保留一段與一個 Drive 上傳分段
+CONTENT_CHUNK_SIZE = int(os.getenv("PAYMENT_CONTENT_CHUNK_SIZE", str(64 * 1024)))
+PAYMENT_IMAGE_WORKERS = int(os.getenv("PAYMENT_IMAGE_WORKERS", "1"))
+PAYMENT_IMAGE_TIMEOUT = float(os.getenv("PAYMENT_IMAGE_TIMEOUT", "60"))
+
+
+class ImagePool:
+    """縮圖與感知雜湊用的 process pool，第一次使用時才建立
+
+    以 spawn 建立子行程，不複製 webhook 與背景執行緒的狀態；子行程異常結束時重新建立。
+    """
+
+    def __init__(self, workers=PAYMENT_IMAGE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._pids = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                # 子行程啟動時回報 PID，reset 時據以結束
+                self._pids = context.SimpleQueue()
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context,
+                                                     initializer=image_analysis.register_worker,
+                                                     initargs=(self._pids,))
+            return self._executor.submit(fn, *args)
+
+    def reset(self):
+        """結束目前的子行程（包含卡住的），下次使用時重新建立"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pids, self._pids = self._pids, None
+        if executor is None:
+            return
+        executor.shutdown(wait=False, cancel_futures=True)
+        # shutdown 不會中止執行中的工作，卡住的子行程需直接結束
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except OSError:
+                pass
+        pids.close()
+
+
+image_pool = ImagePool()
+
+
+class PaymentProofIngestor:
+    """保存用戶傳來的付款截圖並附加到待付款的購買
+
+    webhook 只排入工作；背景工作從 LINE content API 分段讀取截圖，同時串流上傳到 Google Drive
+    與寫入本地暫存檔，再交給 process pool 產生縮圖與感知雜湊。各步驟的結果以 checkpoint 保存，
+    重試時不會重複下載或分析。
+
+    sha256 相同的截圖標記購買的 suspected_reuse；感知雜湊相同的截圖只標記 phash_review，供人工核對。
+    """
+
+    def __init__(self, line_bot_api, folder_id, upload_folder=os.path.join("uploads", "payments")):
+        self.line_bot_api = line_bot_api
+        self.folder_id = folder_id
+        self.upload_folder = upload_folder
+        os.makedirs(self.upload_folder, exist_ok=True)
+
+        self.job_queue = JobQueue(
+            os.getenv("PAYMENT_QUEUE_DB", os.path.join(self.upload_folder, "jobs.db")),
+            handler=self.process,
+            workers=int(os.getenv("PAYMENT_WORKERS", "2")),
+            max_attempts=int(os.getenv("PAYMENT_MAX_ATTEMPTS", "5")),
+            on_failure=self.on_failure
+        )
+        self.job_queue.start()
+
+    def enqueue(self, user_id, message_id):
+        """排入付款截圖的保存工作，回傳工作 ID"""
+        return self.job_queue.enqueue({
+            "user_id": user_id,
+            "message_id": message_id,
+            "received_at": datetime.now(timezone.utc).isoformat()
+        })
+
+    def process(self, queue, job):
+        payload = job.payload
+        if not payload.get("drive_file_id"):
+            queue.checkpoint(job, **self.download(payload["message_id"]))
+        if "analysis" not in payload:
+            queue.checkpoint(job, analysis=self.analyze(payload))
+        self.attach(payload)
+        self.cleanup(payload)
+
+    def download(self, message_id):
+        """將訊息內容分段同時寫入 Google Drive 與本地暫存檔，回傳檔案資訊"""
+        content = self.line_bot_api.get_message_content(message_id)
+        mimetype = content.content_type or "image/jpeg"
+        extension = mimetypes.guess_extension(mimetype) or ".jpg"
+        file_name = f"payment_{message_id}{extension}"
+        file_path = os.path.join(self.upload_folder, file_name)
+
+        fingerprint = Fingerprint()
+        upload = drive_client.start_resumable_upload(file_name, self.folder_id, mimetype)
+        try:
+            with open(file_path, "wb") as f:
+                for chunk in fingerprint.wrap(content.iter_content(CONTENT_CHUNK_SIZE)):
+                    upload.write(chunk)
+                    f.write(chunk)
+            drive_file_id = upload.finish()
+        except Exception:
+            # 重試時會重新下載，放棄未完成的 session
+            upload.cancel()
+            raise
+        return {"drive_file_id": drive_file_id, "file_path": file_path, "mimetype": mimetype,
+                "sha256": fingerprint.sha256, "size": fingerprint.size}
+
+    def analyze(self, payload):
+        """在 process pool 中產生縮圖與感知雜湊，縮圖上傳到 Google Drive
+
+        分析是選用的：圖片無法處理、逾時或子行程異常時回傳 {"error"}，截圖仍會保存並附加到購買。
+        """
+        file_path = payload["file_path"]
+        if not os.path.exists(file_path):
+            return {"error": "本地暫存檔不存在"}
+        thumbnail_path = f"{os.path.splitext(file_path)[0]}_thumb.jpg"
+        try:
+            result = image_pool.submit(image_analysis.analyze, file_path, thumbnail_path).result(
+                timeout=PAYMENT_IMAGE_TIMEOUT)
+        except FutureTimeoutError:
+            # 卡住的子行程會佔住唯一的工作者，重建 pool
+            image_pool.reset()
+            result = {"error": f"分析超過 {PAYMENT_IMAGE_TIMEOUT} 秒"}
+        except BrokenProcessPool as e:
+            image_pool.reset()
+            result = {"error": f"分析子行程異常結束：{e}"}
+        except Exception as e:
+            result = {"error": f"分析失敗：{e}"}
+        if "error" in result:
+            logger.warning(f"付款截圖 {payload['message_id']} 無法產生縮圖與感知雜湊：{result['error']}")
+            self._remove(thumbnail_path)
+            return result
+
+        try:
+            result["thumbnail_file_id"] = drive_client.upload_file(
+                thumbnail_path, os.path.basename(thumbnail_path), self.folder_id)
+        except Exception as e:
+            logger.warning(f"付款截圖 {payload['message_id']} 的縮圖上傳失敗：{e}")
+        self._remove(thumbnail_path)
+        return result
+
+    def find_reuse(self, message_id, sha256, phash):
+        """回傳 (內容完全相同的截圖 ID, 感知雜湊相同的其他截圖 ID)"""
+        reused = {doc.id for doc in payment_proof_repository.find_by_sha256(sha256)} - {message_id}
+        similar = set()
+        if phash:
+            similar = {doc.id for doc in payment_proof_repository.find_by_phash(phash)} - reused - {message_id}
+        return sorted(reused), sorted(similar)
+
+    def attach(self, payload):
+        """保存付款證明並附加到用戶最近一筆待付款的購買"""
+        user_id, message_id = payload["user_id"], payload["message_id"]
+        analysis = payload.get("analysis") or {}
+        reused, similar = self.find_reuse(message_id, payload["sha256"], analysis.get("phash"))
+        if reused:
+            logger.warning(f"用戶 {user_id} 的付款截圖 {message_id} 與先前的截圖相同：{reused}")
+        elif similar:
+            logger.warning(f"用戶 {user_id} 的付款截圖 {message_id} 與先前的截圖感知雜湊相同，待人工核對：{similar}")
+
+        purchase = purchase_repository.find_pending(user_id)
+        payment_proof_repository.save(message_id, {
+            "user_id": user_id,
+            "purchase_id": purchase.id if purchase else None,
+            "drive_file_id": payload["drive_file_id"],
+            "thumbnail_file_id": analysis.get("thumbnail_file_id"),
+            "mimetype": payload["mimetype"],
+            "sha256": payload["sha256"],
+            "size": payload["size"],
+            "phash": analysis.get("phash"),
+            "width": analysis.get("width"),
+            "height": analysis.get("height"),
+            "reused_from": reused,
+            "phash_matches": similar,
+            "received_at": datetime.fromisoformat(payload["received_at"])
+        })
+        if purchase is None:
+            logger.warning(f"用戶 {user_id} 沒有待付款的購買，付款截圖 {message_id} 已保存待人工核對")
+        elif not purchase_repository.attach_proof(purchase.id, message_id, suspected_reuse=bool(reused),
+                                                     phash_review=bool(similar)):
+            logger.warning(f"購買 {purchase.id} 已不是待付款，付款截圖 {message_id} 已保存待人工核對")
+
+    def cleanup(self, payload):
+        self._remove(payload.get("file_path"))
+
+    @staticmethod
+    def _remove(path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def on_failure(self, job, error):
+        """重試用盡時保留本地暫存檔，供人工處理"""
+        logger.error(f"付款截圖 {job.payload.get('message_id')}（用戶 {job.payload.get('user_id')}）保存失敗：{error}")
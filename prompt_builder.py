@@ -0,0 +1,54 @@
+import os
+from functools import lru_cache
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:  # 未安裝 tiktoken 時改用估算
+    _encoding = None
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1800"))  # 每次送出的 prompt 上限
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "800"))  # 儲存的對話歷史上限
+MESSAGE_OVERHEAD_TOKENS = 4  # 每則訊息的 role 與格式開銷
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """計算文字的 token 數（結果會快取）"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # 估算：中日韓文字約 1.5 token / 字，其他約 4 字元 / token
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return int(cjk * 1.5 + (len(text) - cjk) / 4) + 1
+
+
+def message_tokens(message):
+    return count_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_to_budget(conversations, budget):
+    """從最新的訊息往回保留，直到超過 token 上限；回傳 (保留的訊息, 被移出的舊訊息)"""
+    used = 0
+    start = len(conversations)
+    for i in range(len(conversations) - 1, -1, -1):
+        used += message_tokens(conversations[i])
+        if used > budget:
+            break
+        start = i
+    return conversations[start:], conversations[:start]
+
+
+def build_prompt(system_message, conversations, user_message, summary=None, budget=None):
+    """組合送給 GPT 的訊息：系統提示、對話摘要、最近的對話與用戶最新訊息，總長度不超過 budget"""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    head = [system_message]
+    if summary:
+        head.append({"role": "system", "content": f"先前對話摘要：{summary}"})
+    tail = [{"role": "user", "content": user_message}]
+
+    remaining = budget - sum(message_tokens(m) for m in head + tail)
+    history = [m for m in conversations if m.get("role") != "system"]
+    recent, _ = fit_to_budget(history, max(remaining, 0))
+    return head + recent + tail
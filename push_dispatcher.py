@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from linebot.exceptions import LineBotApiError
+
+from metrics import stage
+from structured_logging import correlation, current_correlation_id
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGES_PER_PUSH = 5  # LINE 每次 push 最多 5 則訊息
+MULTICAST_LIMIT = 500  # LINE 每次 multicast 最多 500 位用戶
+
+
+class PushFailed(Exception):
+    """訊息重試後仍無法送達"""
+
+
+def _on_delivered(futures, parts):
+    """回傳分段送達時呼叫的 callback；parts 個分段都送達後完成 futures，任一分段失敗時以 PushFailed 完成"""
+    state = {"remaining": parts, "error": None}
+    lock = threading.Lock()
+
+    def done(error=None):
+        with lock:
+            state["remaining"] -= 1
+            state["error"] = state["error"] or error
+            if state["remaining"] > 0:
+                return
+        for future in futures:
+            if state["error"]:
+                future.set_exception(PushFailed(state["error"]))
+            else:
+                future.set_result(True)
+
+    return done
+
+
+class TokenBucket:
+    """令牌桶限流：平均每秒 rate 個請求，最多累積 capacity 個"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """取得一個令牌，不足時立即回傳 False"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """取得一個令牌，不足時等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class PushDispatcher:
+    """集中發送 push 訊息：限流、並行、429/5xx 重試，並合併同一用戶短時間內的通知
+
+    同一用戶在 window 秒內的訊息合併成一次 push（最多 5 則）；
+    同一批次中內容完全相同的訊息改用 multicast 一次發送給多位用戶。
+    send() 回傳的 future 在訊息送達後完成，重試用盡時以 PushFailed 完成，需要確認送達的呼叫端可等待。
+    """
+
+    def __init__(self, line_bot_api, rate=20, burst=20, concurrency=4, window=1.0, max_attempts=5):
+        self.line_bot_api = line_bot_api
+        self.window = window
+        self.max_attempts = max_attempts
+        self.bucket = TokenBucket(rate, burst)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="push")
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, line_bot_api):
+        """依環境變數建立 dispatcher"""
+        return cls(
+            line_bot_api,
+            rate=float(os.getenv("PUSH_RATE_LIMIT", "20")),
+            burst=int(os.getenv("PUSH_RATE_BURST", "20")),
+            concurrency=int(os.getenv("PUSH_CONCURRENCY", "4")),
+            window=float(os.getenv("PUSH_COALESCE_WINDOW", "1.0")),
+        )
+
+    def send(self, user_id, messages):
+        """排入要發送給用戶的訊息（不等待發送完成），回傳送達時完成的 future"""
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        future = Future()
+        self._ensure_started()
+        with self._cond:
+            if not self._pending:
+                # 沒有等待中的訊息時 flusher 不設逾時地等待，需喚醒它開始計算合併時間
+                self._cond.notify()
+            if user_id not in self._pending:
+                # 合併的訊息沿用第一則訊息的 correlation ID
+                self._pending[user_id] = (time.monotonic(), [], current_correlation_id(), [])
+            self._pending[user_id][1].extend(messages)
+            self._pending[user_id][3].append(future)
+            if len(self._pending[user_id][1]) >= MAX_MESSAGES_PER_PUSH:
+                self._cond.notify()
+        return future
+
+    def multicast(self, user_ids, messages, correlation_id=None):
+        """將相同內容發送給多位用戶"""
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        user_ids = list(dict.fromkeys(user_ids))
+        for i in range(0, len(user_ids), MULTICAST_LIMIT):
+            for j in range(0, len(messages), MAX_MESSAGES_PER_PUSH):
+                self._submit(user_ids[i:i + MULTICAST_LIMIT], messages[j:j + MAX_MESSAGES_PER_PUSH],
+                             correlation_id)
+
+    def flush(self):
+        """立即送出所有等待中的訊息"""
+        with self._cond:
+            batches = list(self._pending.items())
+            self._pending.clear()
+        self._dispatch([(user_id, *batch[1:]) for user_id, batch in batches])
+
+    def stats(self):
+        return {
+            "pending_users": len(self._pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flusher, name="push-flusher", daemon=True)
+                self._thread.start()
+
+    def _flusher(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [user_id for user_id, (first_at, messages, *_) in self._pending.items()
+                       if now - first_at >= self.window or len(messages) >= MAX_MESSAGES_PER_PUSH]
+                batches = [(user_id, *self._pending.pop(user_id)[1:]) for user_id in due]
+                if not batches:
+                    if self._pending:
+                        first_at = next(iter(self._pending.values()))[0]
+                        timeout = max(0.0, first_at + self.window - now)
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                    continue
+            self._dispatch(batches)
+
+    def _dispatch(self, batches):
+        # 內容相同的單批訊息合併成 multicast，其餘逐一 push
+        groups = OrderedDict()
+        members = {}
+        for user_id, messages, correlation_id, futures in batches:
+            parts = range(0, len(messages), MAX_MESSAGES_PER_PUSH)
+            done = _on_delivered(futures, len(parts))
+            for i in parts:
+                chunk = messages[i:i + MAX_MESSAGES_PER_PUSH]
+                key = [json.dumps([m.as_json_dict() for m in chunk], sort_keys=True, ensure_ascii=False), 0]
+                # 同一用戶有兩段內容相同的訊息時分到不同群組，兩段都會送出
+                while user_id in members.get(tuple(key), ()):
+                    key[1] += 1
+                key = tuple(key)
+                members.setdefault(key, set()).add(user_id)
+                group = groups.setdefault(key, (chunk, [], correlation_id, []))
+                group[1].append(user_id)
+                group[3].append(done)
+        for chunk, user_ids, correlation_id, callbacks in groups.values():
+            if len(user_ids) == 1:
+                self._submit(user_ids[0], chunk, correlation_id, callbacks)
+            else:
+                for i in range(0, len(user_ids), MULTICAST_LIMIT):
+                    # 每位用戶只會出現在一個分批中，callback 隨用戶一起分配
+                    self._submit(user_ids[i:i + MULTICAST_LIMIT], chunk, correlation_id,
+                                 callbacks[i:i + MULTICAST_LIMIT])
+
+    def _submit(self, to, messages, correlation_id=None, callbacks=()):
+        self._executor.submit(self._deliver, to, messages, correlation_id or current_correlation_id(), callbacks)
+
+    def _deliver(self, to, messages, correlation_id=None, callbacks=()):
+        with correlation(correlation_id):
+            error = self._send(to, messages)
+        for done in callbacks:
+            done(error)
+
+    def _send(self, to, messages):
+        """發送一次 push 或 multicast，失敗時回傳錯誤訊息"""
+        send = self.line_bot_api.multicast if isinstance(to, list) else self.line_bot_api.push_message
+        retry_key = str(uuid.uuid4())  # 重試時沿用同一個 key，LINE 不會重複發送
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            try:
+                with stage("push", state="background"):
+                    send(to, messages, retry_key=retry_key)
+                self.sent += 1
+                return None
+            except LineBotApiError as e:
+                if e.status_code == 409 and e.accepted_request_id:
+                    self.sent += 1
+                    return None
+                if (e.status_code == 429 or e.status_code >= 500) and attempt < self.max_attempts:
+                    self.retried += 1
+                    delay = min(2 ** (attempt - 1), 30) + random.random()
+                    logger.warning(f"推播失敗 ({e.status_code})，{delay:.1f} 秒後重試：{to}")
+                    time.sleep(delay)
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            logger.error(f"推播失敗：{to}，{error}")
+            self.failed += 1
+            return f"推播失敗：{error}"
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_push_dispatcher(line_bot_api):
+    """取得 line_bot_api 對應的共用 dispatcher"""
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(id(line_bot_api))
+        if dispatcher is None:
+            dispatcher = _dispatchers[id(line_bot_api)] = PushDispatcher.from_env(line_bot_api)
+        return dispatcher
@@ -0,0 +1,286 @@
+from datetime import datetime, timezone
+from storage import get_store, SERVER_TIMESTAMP
+
+BATCH_LIMIT = 500  # Firestore 每個 batch 最多 500 筆寫入
+
+
+class Repository:
+    """各集合的資料存取；store 未指定時使用 STORAGE_BACKEND 設定的共用後端"""
+
+    def __init__(self, store=None):
+        self._store = store
+
+    @property
+    def store(self):
+        return self._store or get_store()
+
+
+class SessionRepository(Repository):
+    """用戶狀態 (user_states) 與對話歷史 (chat_history)"""
+
+    STATES = "user_states"
+    HISTORY = "chat_history"
+
+    def load(self, user_id):
+        """一次讀取用戶狀態與對話歷史，回傳 (狀態文件, 歷史文件)，不存在的為 None"""
+        state, history = self.store.get_many([(self.STATES, user_id), (self.HISTORY, user_id)])
+        return state, history
+
+    def save(self, user_id, state=None, state_version=None, history=None, history_version=None):
+        """以一次 batch 寫入狀態及（或）對話歷史，回傳寫入後的 (狀態版本, 歷史版本)
+
+        版本為 None 時建立新文件，否則以版本為前置條件；不符時拋出 ConflictError。
+        """
+        batch = self.store.batch()
+        writes = []
+        if state is not None:
+            self._add_write(batch, self.STATES, user_id, {
+                "state": state,
+                "last_updated": SERVER_TIMESTAMP
+            }, state_version)
+            writes.append("state")
+        if history is not None:
+            self._add_write(batch, self.HISTORY, user_id, {
+                "conversations": history["conversations"],
+                "summary": history["summary"],
+                "last_updated": datetime.now(timezone.utc)
+            }, history_version)
+            writes.append("history")
+
+        versions = dict(zip(writes, batch.commit()))
+        return versions.get("state", state_version), versions.get("history", history_version)
+
+    @staticmethod
+    def _add_write(batch, collection, user_id, data, version):
+        if version is None:
+            batch.create(collection, user_id, data)
+        else:
+            batch.update(collection, user_id, data, version=version)
+
+    def watch(self, callback, since):
+        """監聽 since 之後變更的用戶資料，callback(collection, user_id, version)"""
+        watches = []
+        for collection in (self.STATES, self.HISTORY):
+            def on_changes(changes, read_time, collection=collection):
+                for change in changes:
+                    callback(collection, change.document.id, change.document.version)
+            watches.append(self.store.watch(collection, on_changes, where=[("last_updated", ">=", since)]))
+        return watches
+
+
+class NoteRepository(Repository):
+    """筆記 (notes)"""
+
+    COLLECTION = "notes"
+    CODE_COUNTER = ("system", "note_codes")
+
+    def add(self, note):
+        return self.store.add(self.COLLECTION, note)
+
+    def list(self, fields=None):
+        return self.store.query(self.COLLECTION, select=fields)
+
+    def find_by_sha256(self, sha256, limit=5):
+        return self.store.query(self.COLLECTION, where=[("sha256", "==", sha256)], limit=limit)
+
+    def find_by_status(self, status):
+        return self.store.query(self.COLLECTION, where=[("status", "==", status)])
+
+    def update(self, note_id, fields):
+        batch = self.store.batch()
+        batch.update(self.COLLECTION, note_id, fields)
+        batch.commit()
+
+    def watch(self, callback, statuses=None):
+        """監聽筆記變更，callback(changes, read_time)；statuses 限定監聽的狀態"""
+        where = [("status", "in", list(statuses))] if statuses else []
+        return self.store.watch(self.COLLECTION, callback, where=where)
+
+    def claim(self, note_id, statuses, claimed_status, now=None):
+        """以交易將狀態在 statuses 中的筆記改為 claimed_status，回傳原本的筆記；已被領取時回傳 None
+
+        指定 now 時，retry_after 晚於 now 的筆記（先前處理失敗、尚未到重試時間）也不領取。
+        """
+        def claim(note):
+            if not note or note.get("status") not in statuses:
+                return None, None
+            if now is not None and note.get("retry_after") and note["retry_after"] > now:
+                return None, None
+            return {**note, "status": claimed_status, "claimed_status": note["status"],
+                    "claimed_at": SERVER_TIMESTAMP}, note
+
+        return self.store.transact(self.COLLECTION, note_id, claim)
+
+    def mark(self, note_ids, status):
+        """以 batch 更新多筆筆記的狀態"""
+        for i in range(0, len(note_ids), BATCH_LIMIT):
+            batch = self.store.batch()
+            for note_id in note_ids[i:i + BATCH_LIMIT]:
+                batch.update(self.COLLECTION, note_id, {"status": status})
+            batch.commit()
+
+    def next_code_number(self, start=0):
+        """以交易遞增筆記編號計數器，回傳新的編號數字（大於 start）"""
+        def bump(counter):
+            number = max((counter or {}).get("last", 0), start) + 1
+            return {"last": number}, number
+
+        return self.store.transact(*self.CODE_COUNTER, bump)
+
+
+class WishlistRepository(Repository):
+    """筆記許願 (note_wishlist) 與各課程的需求統計 (wishlist_demand)"""
+
+    WISHES = "note_wishlist"
+    DEMAND = "wishlist_demand"
+
+    def add(self, user_id, course, description, course_key):
+        """新增許願，並以交易將用戶加入該課程的許願用戶；count 為許願的用戶數，同一用戶重複許願不重複計算"""
+        self.store.add(self.WISHES, {
+            "user_id": user_id,
+            "course": course,
+            "description": description,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+        def add_user(demand):
+            users = list((demand or {}).get("users", []))
+            if user_id not in users:
+                users.append(user_id)
+            return {**(demand or {}), "course": course, "users": users, "count": len(users),
+                    "updated_at": datetime.now(timezone.utc)}, None
+
+        self.store.transact(self.DEMAND, course_key, add_user)
+
+    def recent(self, limit=5):
+        return self.store.query(self.WISHES, order_by="created_at", descending=True, limit=limit)
+
+    def top(self, limit=5):
+        return self.store.query(self.DEMAND, order_by="count", descending=True, limit=limit)
+
+    def demands(self):
+        """所有課程的許願用戶，僅讀取比對所需的欄位"""
+        return self.store.query(self.DEMAND, select=["course", "users"])
+
+    def delete(self, user_id, course, course_key):
+        """以 batch 刪除用戶對某課程的許願，並以交易將用戶移出該課程的許願用戶"""
+        wishes = self.store.query(self.WISHES, where=[("user_id", "==", user_id), ("course", "==", course)])
+        for i in range(0, len(wishes), BATCH_LIMIT):
+            batch = self.store.batch()
+            for wish in wishes[i:i + BATCH_LIMIT]:
+                batch.delete(self.WISHES, wish.id)
+            batch.commit()
+
+        def remove_user(demand):
+            if demand is None or user_id not in demand.get("users", []):
+                return None, None
+            users = [u for u in demand["users"] if u != user_id]
+            return {**demand, "users": users, "count": len(users), "updated_at": datetime.now(timezone.utc)}, None
+
+        self.store.transact(self.DEMAND, course_key, remove_user)
+
+
+class WebhookEventRepository(Repository):
+    """已處理的 webhook 事件鍵 (webhook_events)，用於跨 worker 去除重複事件
+
+    expires_at 為 Timestamp，供 Firestore 的 TTL 政策自動刪除過期文件；expires_ts 為同一時間的 epoch 秒數，
+    SQLite 可以直接在 SQL 中比較，purge() 不必把整個集合讀進 Python。
+    """
+
+    COLLECTION = "webhook_events"
+
+    @staticmethod
+    def _fields(expires_at):
+        return {"expires_at": expires_at, "expires_ts": expires_at.timestamp()}
+
+    def record(self, keys, expires_at):
+        """以一次 batch 記錄事件鍵，不先讀取"""
+        batch = self.store.batch()
+        for key in keys:
+            batch.set(self.COLLECTION, key, self._fields(expires_at))
+        batch.commit()
+
+    def claim(self, key, now, expires_at):
+        """以交易記錄事件鍵；鍵已存在且尚未過期時回傳 False"""
+        def claim(record):
+            if record and record.get("expires_ts", 0) > now.timestamp():
+                return None, False
+            return self._fields(expires_at), True
+
+        return self.store.transact(self.COLLECTION, key, claim)
+
+    def purge(self, now, limit=BATCH_LIMIT):
+        """刪除已過期的事件鍵，回傳刪除數量"""
+        expired = self.store.query(self.COLLECTION, where=[("expires_ts", "<", now.timestamp())], limit=limit,
+                                   select=["expires_ts"])
+        if expired:
+            batch = self.store.batch()
+            for doc in expired:
+                batch.delete(self.COLLECTION, doc.id)
+            batch.commit()
+        return len(expired)
+
+
+class PurchaseRepository(Repository):
+    """筆記購買 (purchases)：選擇購買時建立待付款紀錄，收到付款截圖後附上付款證明"""
+
+    COLLECTION = "purchases"
+    PENDING = "待付款"
+    PROOF_RECEIVED = "待確認"
+
+    def create_pending(self, user_id, note_code, price):
+        return self.store.add(self.COLLECTION, {
+            "user_id": user_id,
+            "note_code": note_code,
+            "price": price,
+            "status": self.PENDING,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    def find_pending(self, user_id):
+        """用戶最近一筆待付款的購買，沒有時回傳 None"""
+        # 只用等值條件查詢，Firestore 不需要複合索引；用戶的待付款紀錄不多，於本地排序
+        pending = self.store.query(self.COLLECTION, where=[("user_id", "==", user_id),
+                                                           ("status", "==", self.PENDING)])
+        return max(pending, key=lambda doc: doc.data.get("created_at") or datetime.min.replace(tzinfo=timezone.utc),
+                   default=None)
+
+    def attach_proof(self, purchase_id, proof_id, suspected_reuse=False, phash_review=False):
+        """以交易將待付款的購買附上付款證明並改為待確認；已不是待付款時回傳 False
+
+        suspected_reuse：截圖與先前的截圖內容完全相同；phash_review：感知雜湊相同，需人工核對
+        """
+        def attach(purchase):
+            if not purchase or purchase.get("status") != self.PENDING:
+                return None, False
+            return {**purchase, "status": self.PROOF_RECEIVED, "payment_proof_id": proof_id,
+                    "suspected_reuse": suspected_reuse, "phash_review": phash_review,
+                    "proof_received_at": SERVER_TIMESTAMP}, True
+
+        return self.store.transact(self.COLLECTION, purchase_id, attach)
+
+
+class PaymentProofRepository(Repository):
+    """付款截圖 (payment_proofs)，文件 ID 為 LINE 訊息 ID，重試時覆寫同一筆"""
+
+    COLLECTION = "payment_proofs"
+
+    def save(self, message_id, proof):
+        batch = self.store.batch()
+        batch.set(self.COLLECTION, message_id, proof)
+        batch.commit()
+
+    def find_by_sha256(self, sha256, limit=5):
+        return self.store.query(self.COLLECTION, where=[("sha256", "==", sha256)], limit=limit)
+
+    def find_by_phash(self, phash, limit=20):
+        """感知雜湊相同的截圖，供人工核對時參考"""
+        return self.store.query(self.COLLECTION, where=[("phash", "==", phash)], limit=limit)
+
+
+session_repository = SessionRepository()
+note_repository = NoteRepository()
+wishlist_repository = WishlistRepository()
+webhook_event_repository = WebhookEventRepository()
+purchase_repository = PurchaseRepository()
+payment_proof_repository = PaymentProofRepository()
@@ -0,0 +1,106 @@
+import os
+import random
+import logging
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text):
+    """正規化訊息文字作為快取鍵：全半形統一、去除空白"""
+    return "".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+class ResponsePool:
+    """熱門固定問題的預先生成回應池
+
+    每個問題保留數個不同版本的回應，輪流回覆；每個版本使用 max_uses 次後淘汰，
+    並由背景執行緒補充新版本，命中時完全不需呼叫 OpenAI。
+    """
+
+    def __init__(self, prompts, generate, size=5, max_uses=20, workers=2):
+        self.prompts = {normalize_prompt(p): p for p in prompts}
+        self.generate = generate
+        self.size = size
+        self.max_uses = max_uses
+        self.hits = 0
+        self.misses = 0
+        self._pools = {key: [] for key in self.prompts}
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="response-pool")
+
+    @classmethod
+    def from_env(cls, prompts, generate):
+        """依環境變數建立回應池"""
+        return cls(
+            prompts,
+            generate,
+            size=int(os.getenv("RESPONSE_POOL_SIZE", "5")),
+            max_uses=int(os.getenv("RESPONSE_POOL_MAX_USES", "20")),
+        )
+
+    def is_hot(self, text):
+        return normalize_prompt(text) in self.prompts
+
+    def get(self, text):
+        """取得預先生成的回應；不是熱門問題或回應池為空時回傳 None"""
+        key = normalize_prompt(text)
+        if key not in self.prompts:
+            return None
+        with self._lock:
+            pool = self._pools[key]
+            if not pool:
+                self.misses += 1
+                self._schedule_refill(key)
+                return None
+            variant = random.choice(pool)
+            variant[1] += 1
+            if variant[1] >= self.max_uses:
+                pool.remove(variant)
+            if len(pool) < self.size:
+                self._schedule_refill(key)
+            self.hits += 1
+            return variant[0]
+
+    def warm(self):
+        """背景預先填滿所有問題的回應池（可重複呼叫）"""
+        with self._lock:
+            for key, pool in self._pools.items():
+                if len(pool) < self.size:
+                    self._schedule_refill(key)
+
+    def stats(self):
+        """回應池統計"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "pools": {self.prompts[key]: len(pool) for key, pool in self._pools.items()},
+        }
+
+    def _schedule_refill(self, key):
+        # 呼叫時需持有 self._lock
+        if key in self._refilling:
+            return
+        self._refilling.add(key)
+        self._executor.submit(self._refill, key)
+
+    def _refill(self, key):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._pools[key]) >= self.size:
+                        return
+                text = self.generate(self.prompts[key])
+                with self._lock:
+                    self._pools[key].append([text, 0])
+        except Exception as e:
+            logger.error(f"預先生成回應失敗：{e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
@@ -1,35 +1,219 @@
-from firebase_admin import firestore
-from linebot.models import FlexSendMessage
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
 from notifications import NotificationHandler
-from firebase_utils import db  # 引入 Firestore 客戶端
+from repositories import note_repository
+from note_catalog import NOTES_PRICING
+from wishlist import get_wishing_users
+from structured_logging import correlation
 
-def monitor_review_status(line_bot_api):
-    """監聽 Firebase 中的筆記審核狀態變更"""
-    notes_ref = db.collection("notes")
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+NOTIFY_STATUSES = ["上架成功", "審核失敗"]
+CLAIMED_STATUS = "通知中"
+NOTIFIED_STATUS = "已通知"
+FLUSH_SIZE = int(os.getenv("REVIEW_MONITOR_FLUSH_SIZE", "20"))
+FLUSH_INTERVAL = float(os.getenv("REVIEW_MONITOR_FLUSH_INTERVAL", "2"))
+CLAIM_TIMEOUT = int(os.getenv("REVIEW_MONITOR_CLAIM_TIMEOUT", "600"))
+SWEEP_INTERVAL = float(os.getenv("REVIEW_MONITOR_SWEEP_INTERVAL", "60"))
+# 處理失敗後第一次重試的等待秒數，之後每次加倍，最多 RETRY_MAX_DELAY 秒
+RETRY_BASE_DELAY = float(os.getenv("REVIEW_MONITOR_RETRY_DELAY", "60"))
+RETRY_MAX_DELAY = float(os.getenv("REVIEW_MONITOR_RETRY_MAX_DELAY", "3600"))
+# 審核者未填寫 approved_price 時，上傳者的定價須為不超過此金額的整數才會上架販售
+NOTE_MAX_PRICE = int(os.getenv("NOTE_MAX_PRICE", "300"))
+NOTE_CODE_PREFIX = "A"
+
+
+def approved_price(note):
+    """審核者填寫的 approved_price 優先，否則檢查上傳者的定價；不合理時回傳 None（不開放購買）"""
+    price = note.get("approved_price", note.get("price"))
+    try:
+        price = int(str(price).strip())
+    except (TypeError, ValueError):
+        return None
+    return price if 0 <= price <= NOTE_MAX_PRICE else None
+
+
+class ReviewMonitor:
+    """監聽審核結果並通知上傳者
+
+    只監聽狀態為「上架成功」或「審核失敗」的筆記；發送前以交易領取，
+    多個行程同時監聽或變更重播時也只會通知一次，通知送達後才批次寫入「已通知」。
+    上架或發送失敗時恢復原狀態並寫入 retry_after（指數退避），listener 與領取都會略過未到期的筆記，
+    由每 SWEEP_INTERVAL 秒的檢查在到期後重試，並恢復逾時的「通知中」領取。
+    """
+
+    def __init__(self, line_bot_api):
+        self.line_bot_api = line_bot_api
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._watch = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.release_stale_claims()
+        self._watch = note_repository.watch(self.on_changes, statuses=NOTIFY_STATUSES)
+        threading.Thread(target=self._sweep_loop, name="review-monitor-sweep", daemon=True).start()
+        logger.info("審核狀態監聽已啟動")
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch is not None:
+            self._watch.unsubscribe()
+        self.flush()
+
+    def _sweep_loop(self):
+        while not self._stopped.wait(SWEEP_INTERVAL):
+            self.sweep()
 
-    # 設置監聽器
-    def on_snapshot(docs, changes, read_time):
+    def sweep(self):
+        """重試仍停在審核結果的筆記（先前處理失敗），並恢復逾時的領取"""
+        self.release_stale_claims()
+        try:
+            for status in NOTIFY_STATUSES:
+                for document in note_repository.find_by_status(status):
+                    self._process_logged(document)
+        except Exception as e:
+            logger.error(f"查詢待通知的筆記失敗：{e}")
+
+    def release_stale_claims(self):
+        """行程在發送途中結束時，逾時的「通知中」筆記恢復原狀態以便重新通知"""
+        try:
+            now = datetime.now(timezone.utc)
+            for doc in note_repository.find_by_status(CLAIMED_STATUS):
+                claimed_at = doc.data.get("claimed_at")
+                if claimed_at and (now - claimed_at).total_seconds() > CLAIM_TIMEOUT:
+                    note_repository.update(doc.id, {"status": doc.data.get("claimed_status", NOTIFY_STATUSES[0])})
+        except Exception as e:
+            logger.error(f"恢復逾時的通知領取失敗：{e}")
+
+    def on_changes(self, changes, read_time):
+        # 重播的變更由 process() 的交易領取去重，不以版本略過
         for change in changes:
-            if change.type.name == "MODIFIED":  # 當資料被修改時觸發
-                note = change.document.to_dict()
-                print(f"更新的文件內容：{note}")
+            if change.kind in ("added", "modified"):
+                self._process_logged(change.document)
+
+    def _process_logged(self, document):
+        try:
+            # 每個筆記變更使用自己的 correlation ID，串起後續的通知發送
+            with correlation(f"note-{document.id}"):
+                self.process(document)
+        except Exception as e:
+            logger.error(f"處理審核通知失敗（{document.id}），到重試時間後由定期檢查重試：{e}")
+
+    def process(self, document):
+        # 以交易將筆記由審核結果改為「通知中」，只有成功領取的行程會發送通知；未到重試時間的筆記不領取
+        note = note_repository.claim(document.id, NOTIFY_STATUSES, CLAIMED_STATUS, now=datetime.now(timezone.utc))
+        if note is None:
+            return  # 已由其他行程處理或尚未到重試時間
+
+        user_id = note.get("user_id")
+        file_name = note.get("file_name")
+        try:
+            if note["status"] == "上架成功":
+                note = self.publish(document.id, note)
+                future = NotificationHandler.send_review_success_notification(
+                    self.line_bot_api, user_id, file_name,
+                    note.get("subject", "未知科目"), note.get("grade", "未知年級"), note.get("file_url"))
+            else:
+                future = NotificationHandler.send_review_failure_notification(
+                    self.line_bot_api, user_id, file_name, note.get("reason", "未提供原因"))
+        except Exception:
+            self.release(document.id, note)
+            raise
+        future.add_done_callback(lambda f: self._delivered(document.id, note, f))
 
-                user_id = note.get("user_id")
-                file_name = note.get("file_name")
-                subject = note.get("subject", "未知科目")
-                grade = note.get("grade", "未知年級")
-                status = note.get("status")
-                print(f"更新的文件內容：{note}")
+    def _delivered(self, note_id, note, future):
+        """通知送達後才記為「已通知」並通知許願者；dispatcher 放棄時釋放領取，到期後重試"""
+        with correlation(f"note-{note_id}"):
+            if future.exception() is not None:
+                logger.error(f"筆記 {note_id} 的審核通知未送達：{future.exception()}")
+                self.release(note_id, note)
+                return
+            if note["status"] == "上架成功":
+                try:
+                    self.notify_wishers(note)
+                except Exception as e:
+                    logger.error(f"通知許願用戶失敗（{note_id}）：{e}")
 
-                reason = note.get("reason", "未提供原因")
+        with self._lock:
+            self._pending.append(note_id)
+            full = len(self._pending) >= FLUSH_SIZE
+        if full:
+            self.flush()
+        else:
+            self._schedule_flush()
 
+    def release(self, note_id, note):
+        """恢復原狀態並寫入下次重試的時間；寫入失敗時由 release_stale_claims 於 CLAIM_TIMEOUT 後恢復"""
+        attempts = note.get("notify_attempts", 0) + 1
+        delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+        try:
+            note_repository.update(note_id, {
+                "status": note["status"],
+                "notify_attempts": attempts,
+                "retry_after": datetime.now(timezone.utc) + timedelta(seconds=delay)
+            })
+            logger.warning(f"筆記 {note_id} 第 {attempts} 次處理失敗，{delay:.0f} 秒後重試")
+        except Exception as e:
+            logger.error(f"釋放筆記 {note_id} 的通知領取失敗，將於領取逾時後重試：{e}")
 
-                if status == "上架成功":
-                    NotificationHandler.send_review_success_notification(line_bot_api, user_id, file_name, subject, grade, note.get("file_url"))
-                    notes_ref.document(change.document.id).update({"status": "已通知"})
-                elif status == "審核失敗":
-                    NotificationHandler.send_review_failure_notification(line_bot_api, user_id, file_name, reason)
-                    notes_ref.document(change.document.id).update({"status": "已通知"})
+    def publish(self, note_id, note):
+        """上架時指派唯一的筆記編號並寫入核定價格，目錄與購買指令以此為準"""
+        fields = {}
+        if not note.get("code"):
+            # 新編號接在舊的 NOTES_PRICING 之後，不會與舊編號重複
+            start = max(int(code[len(NOTE_CODE_PREFIX):]) for code in NOTES_PRICING)
+            fields["code"] = f"{NOTE_CODE_PREFIX}{note_repository.next_code_number(start):02d}"
+        price = approved_price(note)
+        if price is None:
+            logger.warning(f"筆記 {note_id} 的價格 {note.get('price')!r} 無效，需由審核者填寫 approved_price 才會開放購買")
+        elif note.get("approved_price") != price:
+            fields["approved_price"] = price
+        if fields:
+            note_repository.update(note_id, fields)
+        return {**note, **fields}
 
-    # 啟用監聽器
-    notes_ref.on_snapshot(on_snapshot)
+    def notify_wishers(self, note):
+        """筆記上架時通知許願該課程的用戶（上傳者除外）"""
+        subject = note.get("subject")
+        if not subject:
+            return
+        user_ids = [u for u in get_wishing_users(subject) if u != note.get("user_id")]
+        if user_ids:
+            NotificationHandler.send_wish_fulfilled_notification(
+                self.line_bot_api, user_ids, subject, note.get("file_name"), note.get("code"))
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """批次寫入「已通知」狀態"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            note_ids, self._pending = self._pending, []
+        if not note_ids:
+            return
+        try:
+            note_repository.mark(note_ids, NOTIFIED_STATUS)
+        except Exception as e:
+            logger.error(f"批次更新通知狀態失敗：{e}")
+            with self._lock:
+                self._pending = note_ids + self._pending
+            self._schedule_flush()
+
+
+def monitor_review_status(line_bot_api):
+    """監聽筆記審核狀態變更"""
+    monitor = ReviewMonitor(line_bot_api)
+    monitor.start()
+    return monitor
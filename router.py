@@ -0,0 +1,167 @@
+import re
+import logging
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# 轉送到其他狀態的最大次數，避免狀態之間互相轉送形成迴圈
+MAX_FORWARDS = 3
+
+
+class Context:
+    """一則訊息的路由結果；state 為目前路由所在的狀態，handler 以 goto() 設定下一個狀態"""
+
+    __slots__ = ("event", "user_id", "text", "state", "match", "next_state", "reply")
+
+    def __init__(self, event, user_id, text, state):
+        self.event = event
+        self.user_id = user_id
+        self.text = text
+        self.state = state
+        self.match = None
+        self.next_state = state
+        self.reply = None
+
+    def goto(self, state):
+        self.next_state = state
+
+
+class State:
+    """一個用戶狀態的指令表
+
+    完全相符的指令放在 dict 中；前綴、包含與正規表示式的路由依註冊順序合併成一個預先編譯的 regex，
+    每則訊息只需一次查表與一次比對。都不符合時交給 fallback。
+    """
+
+    def __init__(self, name, quick_reply=None):
+        self.name = name
+        self.quick_reply = quick_reply
+        self._exact = {}
+        self._routes = []
+        self._compiled = None
+        self._fallback = None
+
+    def command(self, *texts):
+        """註冊完全相符的指令"""
+        def register(handler):
+            for text in texts:
+                self._exact[text] = handler
+            return handler
+        return register
+
+    def prefix(self, prefix):
+        """註冊以 prefix 開頭的訊息"""
+        return self.pattern(re.escape(prefix))
+
+    def contains(self, text):
+        """註冊包含 text 的訊息"""
+        return self.pattern(".*?" + re.escape(text))
+
+    def pattern(self, regex):
+        """註冊由開頭符合 regex 的訊息；handler 可由 ctx.match 取得群組（不可使用具名群組）"""
+        def register(handler):
+            self._routes.append((re.compile(regex, re.DOTALL), handler))
+            self._compiled = None
+            return handler
+        return register
+
+    def fallback(self, handler):
+        """註冊沒有任何指令符合時的處理"""
+        self._fallback = handler
+        return handler
+
+    def reply(self, texts, message, next_state=None):
+        """註冊固定的回覆；回覆物件只建立一次，所有用戶共用"""
+        def handler(ctx):
+            if next_state:
+                ctx.goto(next_state)
+            return message
+        self.command(*([texts] if isinstance(texts, str) else texts))(handler)
+
+    def forward(self, route, to):
+        """將符合 route（prefix、contains 等的註冊函數）的訊息切換到狀態 to 後重新路由"""
+        def handler(ctx):
+            ctx.goto(to)
+            return Forward(to)
+        route(handler)
+
+    def _compile(self):
+        if self._compiled is None:
+            # 每個路由各自成為具名群組；match.lastgroup 即為第一個符合的路由
+            alternatives = "|".join(f"(?P<r{i}>{pattern.pattern})" for i, (pattern, _) in enumerate(self._routes))
+            self._compiled = re.compile(alternatives, re.DOTALL) if alternatives else None
+        return self._compiled
+
+    def route(self, text):
+        """回傳 (handler, match)；沒有符合的路由時回傳 (fallback, None)"""
+        handler = self._exact.get(text)
+        if handler is not None:
+            return handler, None
+        compiled = self._compile()
+        if compiled is not None:
+            match = compiled.match(text)
+            if match:
+                pattern, handler = self._routes[int(match.lastgroup[1:])]
+                # 重新以路由自己的 regex 比對，群組編號才與註冊時相同
+                return handler, pattern.match(text)
+        return self._fallback, None
+
+    def handles(self, text):
+        """是否有指令（而非 fallback）符合此訊息"""
+        handler, _ = self.route(text)
+        return handler is not None and handler is not self._fallback
+
+
+class Forward:
+    """handler 回傳此物件時，以同一則訊息在另一個狀態重新路由"""
+
+    __slots__ = ("state",)
+
+    def __init__(self, state):
+        self.state = state
+
+
+class StateMachine:
+    """用戶狀態與指令的路由表；新增狀態只需註冊，不必修改分派邏輯"""
+
+    def __init__(self, default_state="default"):
+        self.default_state = default_state
+        self._states = {}
+
+    def state(self, name, quick_reply=None):
+        """取得或建立狀態"""
+        state = self._states.get(name)
+        if state is None:
+            state = self._states[name] = State(name, quick_reply)
+        elif quick_reply is not None:
+            state.quick_reply = quick_reply
+        return state
+
+    def quick_reply(self, name):
+        """狀態的快速回覆；未設定時使用預設狀態的"""
+        state = self._states.get(name) or self._states.get(self.default_state)
+        if state is not None and state.quick_reply is not None:
+            return state.quick_reply
+        default = self._states.get(self.default_state)
+        return default.quick_reply if default else None
+
+    def dispatch(self, event, user_id, text, state):
+        """依用戶狀態路由訊息並執行 handler，回傳 Context（reply 為 None 時不需回覆）"""
+        ctx = Context(event, user_id, text, state)
+        for _ in range(MAX_FORWARDS + 1):
+            current = self._states.get(ctx.next_state)
+            if current is None:
+                logger.warning(f"未知的用戶狀態 {ctx.next_state}，改用 {self.default_state}")
+                ctx.next_state = self.default_state
+                current = self._states[self.default_state]
+            ctx.state = current.name
+            handler, ctx.match = current.route(text)
+            if handler is None:
+                return ctx
+            result = handler(ctx)
+            if not isinstance(result, Forward):
+                ctx.reply = result
+                return ctx
+        # 訊息內容只記錄長度
+        logger.error(f"訊息在狀態之間轉送超過 {MAX_FORWARDS} 次（最後的狀態 {ctx.state}）", extra={"user_content": text})
+        return ctx
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class CachedSession:
+    """快取中的用戶資料快照，版本為儲存後端的文件更新時間"""
+
+    __slots__ = ("state", "conversations", "summary", "state_version", "history_version", "size", "expires_at")
+
+    def __init__(self, state, conversations, summary, state_version, history_version, size, expires_at):
+        self.state = state
+        self.conversations = conversations
+        self.summary = summary
+        self.state_version = state_version
+        self.history_version = history_version
+        self.size = size
+        self.expires_at = expires_at
+
+
+class SessionCache:
+    """行程內的用戶狀態與對話歷史 LRU+TTL 快取
+
+    以筆數與估計位元組數雙重限制容量。跨 worker 的一致性由兩個機制保證：
+    寫入時以文件版本作為前置條件（版本不符即重新讀取），以及
+    監聽 user_states / chat_history 近期變更的 snapshot listener，其他行程寫入時立即失效本地快取。
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=8 * 1024 * 1024, ttl=300, enabled=True):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.conflicts = 0
+        self.skipped_writes = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._watches = None
+
+    @classmethod
+    def from_env(cls):
+        """依環境變數建立快取"""
+        return cls(
+            max_entries=int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "1000")),
+            max_bytes=int(os.getenv("SESSION_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", "300")),
+            enabled=os.getenv("SESSION_CACHE", "true").lower() in ("1", "true", "yes"),
+        )
+
+    def get(self, user_id):
+        """取得快取的用戶資料，過期或不存在時回傳 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.expires_at < time.monotonic():
+                if entry is not None:
+                    self._remove(user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id, state, conversations, state_version, history_version, summary=""):
+        """寫入快取並依容量限制淘汰最久未使用的項目"""
+        if not self.enabled:
+            return
+        size = len(user_id) + len(state or "") + len(summary or "") * 3 + len(
+            json.dumps(conversations, ensure_ascii=False, default=str).encode("utf-8"))
+        if size > self.max_bytes:
+            self.invalidate(user_id)
+            return
+        entry = CachedSession(state, list(conversations), summary, state_version, history_version,
+                              size, time.monotonic() + self.ttl)
+        with self._lock:
+            if user_id in self._entries:
+                self._remove(user_id)
+            self._entries[user_id] = entry
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if user_id in self._entries:
+                self._remove(user_id)
+                self.invalidations += 1
+
+    def invalidate_if_newer(self, collection, user_id, update_time):
+        """其他行程寫入時失效快取；自己寫入的版本不會觸發失效"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            version = entry.state_version if collection == "user_states" else entry.history_version
+            if version is None or update_time is None or update_time > version:
+                self._remove(user_id)
+                self.invalidations += 1
+
+    def record_conflict(self, user_id):
+        self.conflicts += 1
+        self.invalidate(user_id)
+
+    def record_skipped_write(self):
+        self.skipped_writes += 1
+
+    def start_listener(self, repository):
+        """監聽本行程啟動後變更的用戶資料（只啟動一次）"""
+        if not self.enabled or self._watches is not None:
+            return
+        if os.getenv("SESSION_CACHE_LISTENER", "true").lower() not in ("1", "true", "yes"):
+            self._watches = []
+            return
+        with self._lock:
+            if self._watches is not None:
+                return
+            self._watches = []
+        try:
+            self._watches = repository.watch(self.invalidate_if_newer, since=datetime.now(timezone.utc))
+        except Exception as e:
+            logger.error(f"快取失效監聽啟動失敗：{e}")
+
+    def stats(self):
+        """快取統計"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "conflicts": self.conflicts,
+            "skipped_writes": self.skipped_writes,
+        }
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id)
+        self._bytes -= entry.size
+
+
+session_cache = SessionCache.from_env()
@@ -0,0 +1,179 @@
+import time
+import zlib
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+
+class _Shard:
+    def __init__(self, index, queue_size):
+        self.index = index
+        self.queue_size = queue_size
+        self.ready = queue.Queue()  # 有工作可執行的 key，每個 key 同時最多一個
+        self.pending = 0  # 已提交、尚未開始執行的工作數
+        self.unfinished = 0  # 已提交、尚未完成的工作數
+        self.generation = 0
+        self.stalled = 0  # 被接手後仍在執行超時工作的舊工作執行緒數
+        self.current = None  # 目前工作者執行中工作的 (key, 開始時間)
+
+
+class ShardedExecutor:
+    """依 key 分片的執行緒池
+
+    同一個 key 固定分配到同一個分片，依提交順序逐一執行；不同分片的工作並行執行。
+    每個 key 的工作放在各自的 FIFO 中，分片佇列只放「有工作可執行」的 key，
+    前一個工作完成後才由完成它的執行緒將 key 重新排入，同一 key 的工作不會並行或亂序。
+    工作執行超過 timeout 秒時，該分片改由新的工作執行緒接手，同分片其他 key 的工作不會被拖住；
+    每個分片最多保留 max_stalled 個仍在執行超時工作的舊執行緒，超過時不再接手。
+    """
+
+    def __init__(self, shards=4, queue_size=100, timeout=None, name="shard", max_stalled=4):
+        self.timeout = timeout
+        self.name = name
+        self.max_stalled = max_stalled
+        self.timeouts = 0
+        self._shards = [_Shard(i, queue_size) for i in range(shards)]
+        self._keys = {}  # key -> 尚未完成工作的 deque，第一個為執行中或即將執行的工作
+        self._cond = threading.Condition()
+        self._started = False
+
+    def start(self):
+        """啟動各分片的工作執行緒與逾時監看（只會啟動一次）"""
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            for shard in self._shards:
+                self._spawn(shard)
+            if self.timeout:
+                threading.Thread(target=self._watchdog, name=f"{self.name}-watchdog", daemon=True).start()
+
+    def shard_for(self, key):
+        # crc32 在各行程間穩定，不受 hash 隨機化影響
+        return self._shards[zlib.crc32(str(key or "").encode()) % len(self._shards)]
+
+    def submit(self, key, fn, *args, block_timeout=None):
+        """將工作排入 key 所屬的分片，回傳 Future；分片已滿且等待 block_timeout 秒後拋出 queue.Full"""
+        self.start()
+        shard = self.shard_for(key)
+        future = Future()
+        with self._cond:
+            if not self._cond.wait_for(lambda: shard.pending < shard.queue_size, timeout=block_timeout):
+                raise queue.Full
+            shard.pending += 1
+            shard.unfinished += 1
+            items = self._keys.get(key)
+            if items is None:
+                self._keys[key] = deque([(fn, args, future)])
+                shard.ready.put(key)
+            else:
+                items.append((fn, args, future))
+        return future
+
+    def take_queued(self, key, predicate):
+        """取出 key 排在執行中工作之後、連續符合 predicate(args) 且尚未開始的工作，回傳其 args 列表
+
+        取出的工作不會再執行，其 Future 以 None 完成，由呼叫端合併處理；遇到第一個不符合的工作即停止，不改變順序。
+        """
+        taken = []
+        with self._cond:
+            items = self._keys.get(key)
+            if not items:
+                return taken
+            shard = self.shard_for(key)
+            while len(items) > 1 and predicate(items[1][1]):
+                fn, args, future = items[1]
+                del items[1]
+                shard.pending -= 1
+                shard.unfinished -= 1
+                taken.append((args, future))
+            if taken:
+                self._cond.notify_all()
+        for args, future in taken:
+            if future.set_running_or_notify_cancel():
+                future.set_result(None)
+        return [args for args, _ in taken]
+
+    def depth(self):
+        """所有分片中等待執行的工作數"""
+        return sum(shard.pending for shard in self._shards)
+
+    def join(self):
+        """等待目前排入的工作全部完成"""
+        with self._cond:
+            self._cond.wait_for(lambda: all(shard.unfinished == 0 for shard in self._shards))
+
+    def stats(self):
+        return {
+            "shards": len(self._shards),
+            "depths": [shard.pending for shard in self._shards],
+            "capacity": sum(shard.queue_size for shard in self._shards),
+            "timeouts": self.timeouts,
+            "stalled": sum(shard.stalled for shard in self._shards),
+        }
+
+    def _spawn(self, shard):
+        shard.generation += 1
+        shard.current = None
+        thread = threading.Thread(target=self._worker, args=(shard, shard.generation),
+                                  name=f"{self.name}-{shard.index}-{shard.generation}", daemon=True)
+        thread.start()
+
+    def _worker(self, shard, generation):
+        while shard.generation == generation:
+            self._run(shard, generation, shard.ready.get())
+        # 已被新的工作執行緒接手：完成超時的工作後結束
+        with self._cond:
+            shard.stalled -= 1
+
+    def _run(self, shard, generation, key):
+        with self._cond:
+            fn, args, future = self._keys[key][0]
+            shard.pending -= 1
+            # 與監看在同一個鎖內設定，監看看到的 current 一定是執行中的工作
+            if shard.generation == generation:
+                shard.current = (key, time.monotonic())
+            self._cond.notify_all()
+
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            with self._cond:
+                items = self._keys[key]
+                items.popleft()
+                if items:
+                    # 同一 key 的下一個工作排到分片佇列尾端，與其他 key 輪流執行
+                    shard.ready.put(key)
+                else:
+                    del self._keys[key]
+                shard.unfinished -= 1
+                if shard.generation == generation:
+                    shard.current = None
+                self._cond.notify_all()
+
+    def _watchdog(self):
+        interval = max(self.timeout / 4, 0.05)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._cond:
+                for shard in self._shards:
+                    current = shard.current
+                    if current is None or now - current[1] <= self.timeout:
+                        continue
+                    if shard.stalled >= self.max_stalled:
+                        continue
+                    self.timeouts += 1
+                    shard.stalled += 1
+                    logger.warning(f"{self.name} 分片 {shard.index} 的工作（{current[0]}）執行超過 "
+                                   f"{self.timeout} 秒，改由新的工作執行緒接手")
+                    self._spawn(shard)
@@ -0,0 +1,689 @@
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class ConflictError(Exception):
+    """寫入的前置條件不成立：文件已存在，或版本已被其他寫入更新"""
+
+
+class Increment:
+    """欄位數值累加"""
+
+    def __init__(self, amount):
+        self.amount = amount
+
+
+class ArrayUnion:
+    """加入陣列中尚未存在的值"""
+
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class ArrayRemove:
+    """自陣列移除指定的值"""
+
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")  # 寫入時由後端填入目前時間
+DELETE = _Sentinel("DELETE")  # transact() 的函數回傳此值時刪除文件
+
+
+class Document:
+    """讀取到的文件；version 為最後更新時間（datetime），作為寫入的前置條件"""
+
+    __slots__ = ("id", "data", "version")
+
+    def __init__(self, doc_id, data, version):
+        self.id = doc_id
+        self.data = data
+        self.version = version
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class Change:
+    """watch() 回報的變更；kind 為 added、modified 或 removed"""
+
+    __slots__ = ("kind", "document")
+
+    def __init__(self, kind, document):
+        self.kind = kind
+        self.document = document
+
+
+class Batch:
+    """多筆寫入，commit() 時一次原子寫入並回傳各筆寫入後的版本"""
+
+    def __init__(self, store):
+        self._store = store
+        self.writes = []
+
+    def create(self, collection, doc_id, data):
+        """建立新文件，doc_id 為 None 時自動產生，回傳文件 ID"""
+        doc_id = doc_id or uuid.uuid4().hex[:20]
+        self.writes.append(("create", collection, doc_id, data, None, False))
+        return doc_id
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.writes.append(("set", collection, doc_id, data, None, merge))
+
+    def update(self, collection, doc_id, data, version=None):
+        """更新既有文件；指定 version 時，文件版本不符即拋出 ConflictError"""
+        self.writes.append(("update", collection, doc_id, data, version, True))
+
+    def delete(self, collection, doc_id):
+        self.writes.append(("delete", collection, doc_id, None, None, False))
+
+    def __len__(self):
+        return len(self.writes)
+
+    def commit(self):
+        return self._store.commit(self.writes) if self.writes else []
+
+
+def _matches(data, where):
+    for field, op, value in where:
+        actual = data.get(field)
+        if op == "==":
+            ok = actual == value
+        elif op == "!=":
+            ok = actual != value
+        elif op == "in":
+            ok = actual in value
+        elif op == "array_contains":
+            ok = isinstance(actual, list) and value in actual
+        elif actual is None:
+            ok = False
+        elif op == ">=":
+            ok = actual >= value
+        elif op == ">":
+            ok = actual > value
+        elif op == "<=":
+            ok = actual <= value
+        elif op == "<":
+            ok = actual < value
+        else:
+            raise ValueError(f"不支援的查詢條件：{op}")
+        if not ok:
+            return False
+    return True
+
+
+def _apply_write(current, data, merge):
+    """將寫入內容（含 Increment 等欄位轉換）套用到既有文件，回傳新的文件內容"""
+    result = dict(current) if merge and current else {}
+    for key, value in data.items():
+        if isinstance(value, Increment):
+            result[key] = (result.get(key) or 0) + value.amount
+        elif isinstance(value, ArrayUnion):
+            existing = list(result.get(key) or [])
+            result[key] = existing + [v for v in value.values if v not in existing]
+        elif isinstance(value, ArrayRemove):
+            result[key] = [v for v in result.get(key) or [] if v not in value.values]
+        elif value is SERVER_TIMESTAMP:
+            result[key] = datetime.now(timezone.utc)
+        else:
+            result[key] = value
+    return result
+
+
+def _sort_documents(documents, order_by, descending):
+    # 缺少排序欄位的文件排在最後（Firestore 則是不回傳）
+    present = [d for d in documents if d.data.get(order_by) is not None]
+    return sorted(present, key=lambda d: d.data[order_by], reverse=descending)
+
+
+def _to_version(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _from_version(version):
+    return (version - EPOCH) // timedelta(microseconds=1)
+
+
+class FirestoreStore:
+    """Cloud Firestore 後端；firebase_admin 在第一次使用時才載入並初始化"""
+
+    def __init__(self, db=None):
+        self._db = db
+
+    @property
+    def db(self):
+        if self._db is None:
+            from firebase_utils import db
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _firestore():
+        from firebase_admin import firestore
+        return firestore
+
+    def _encode(self, data):
+        firestore = self._firestore()
+        encoded = {}
+        for key, value in data.items():
+            if isinstance(value, Increment):
+                value = firestore.Increment(value.amount)
+            elif isinstance(value, ArrayUnion):
+                value = firestore.ArrayUnion(value.values)
+            elif isinstance(value, ArrayRemove):
+                value = firestore.ArrayRemove(value.values)
+            elif value is SERVER_TIMESTAMP:
+                value = firestore.SERVER_TIMESTAMP
+            encoded[key] = value
+        return encoded
+
+    def _ref(self, collection, doc_id):
+        return self.db.collection(collection).document(doc_id)
+
+    @staticmethod
+    def _document(snapshot):
+        if not snapshot.exists:
+            return None
+        return Document(snapshot.id, snapshot.to_dict() or {}, snapshot.update_time)
+
+    def get(self, collection, doc_id):
+        return self._document(self._ref(collection, doc_id).get())
+
+    def get_many(self, keys):
+        """以一次 get_all 讀取多個 (collection, doc_id)，依 keys 順序回傳（不存在為 None）"""
+        snapshots = self.db.get_all([self._ref(c, d) for c, d in keys])
+        found = {(s.reference.parent.id, s.id): self._document(s) for s in snapshots}
+        return [found.get(tuple(key)) for key in keys]
+
+    def _query(self, collection, where, select=None):
+        query = self.db.collection(collection)
+        if select:
+            query = query.select(select)
+        for field, op, value in where:
+            query = query.where(field, op, value)
+        return query
+
+    def query(self, collection, where=(), order_by=None, descending=False, limit=None, select=None):
+        query = self._query(collection, where, select)
+        if order_by:
+            firestore = self._firestore()
+            direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+            query = query.order_by(order_by, direction=direction)
+        if limit:
+            query = query.limit(limit)
+        return [self._document(s) for s in query.stream()]
+
+    def add(self, collection, data):
+        _, ref = self.db.collection(collection).add(self._encode(data))
+        return ref.id
+
+    def batch(self):
+        return Batch(self)
+
+    def commit(self, writes):
+        from google.api_core.exceptions import Conflict, FailedPrecondition
+        batch = self.db.batch()
+        for op, collection, doc_id, data, version, merge in writes:
+            ref = self._ref(collection, doc_id)
+            if op == "create":
+                batch.create(ref, self._encode(data))
+            elif op == "set":
+                batch.set(ref, self._encode(data), merge=merge)
+            elif op == "update":
+                option = self.db.write_option(last_update_time=version) if version is not None else None
+                batch.update(ref, self._encode(data), option=option)
+            else:
+                batch.delete(ref)
+        try:
+            return [result.update_time for result in batch.commit()]
+        except (Conflict, FailedPrecondition) as e:
+            raise ConflictError(str(e)) from e
+
+    def transact(self, collection, doc_id, fn):
+        """在交易中讀取文件並以 fn(目前內容或 None) 回傳的 (新內容, 結果) 寫回；新內容為 None 時不寫入"""
+        ref = self._ref(collection, doc_id)
+
+        @self._firestore().transactional
+        def run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            data, result = fn(snapshot.to_dict() if snapshot.exists else None)
+            if data is DELETE:
+                transaction.delete(ref)
+            elif data is not None:
+                transaction.set(ref, self._encode(data))
+            return result
+
+        return run(self.db.transaction())
+
+    def watch(self, collection, callback, where=()):
+        """監聽符合條件的文件變更，callback(changes, read_time)；回傳具有 unsubscribe() 的物件"""
+        kinds = {"ADDED": "added", "MODIFIED": "modified", "REMOVED": "removed"}
+
+        def on_snapshot(docs, changes, read_time):
+            callback([Change(kinds[c.type.name], Document(c.document.id, c.document.to_dict() or {},
+                                                         c.document.update_time))
+                      for c in changes], read_time)
+
+        return self._query(collection, where).on_snapshot(on_snapshot)
+
+
+class _Watch:
+    """單一查詢的監聽；callback 在此 watch 專屬的背景執行緒依序呼叫，寫入端與其他 watch 不會被阻塞"""
+
+    def __init__(self, store, collection, where, callback):
+        self.store = store
+        self.collection = collection
+        self.where = list(where)
+        self.callback = callback
+        self.matching = set()
+        self.active = True
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def unsubscribe(self):
+        self.active = False
+        if self._thread is not None:
+            self._queue.put(None)
+
+    def changes(self, doc_id, data, version):
+        """文件寫入後對此 watch 的變更，不相關時回傳 None"""
+        matched = data is not None and _matches(data, self.where)
+        if matched:
+            kind = "modified" if doc_id in self.matching else "added"
+            self.matching.add(doc_id)
+            return Change(kind, Document(doc_id, data, version))
+        if doc_id in self.matching:
+            self.matching.discard(doc_id)
+            return Change("removed", Document(doc_id, data or {}, version))
+        return None
+
+    def notify(self, changes, read_time):
+        """排入一批變更；read_time 為此批變更涵蓋到的文件版本，與 Firestore 的 read_time 意義相同"""
+        changes = [c for c in changes if c is not None]
+        if not changes or not self.active:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"storage-watch-{self.collection}",
+                                                daemon=True)
+                self._thread.start()
+        self._queue.put((changes, read_time))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None or not self.active:
+                return
+            changes, read_time = item
+            try:
+                self.callback(changes, read_time)
+            except Exception as e:
+                logger.error(f"watch callback 發生錯誤：{e}")
+
+
+class MemoryStore:
+    """行程內的記憶體後端，用於本地測試；資料不會保存"""
+
+    def __init__(self):
+        self._docs = {}
+        self._last_version = 0
+        self._lock = threading.RLock()
+        self._watches = []
+
+    def _next_version(self):
+        self._last_version = max(self._last_version + 1, int(time.time() * 1_000_000))
+        return self._last_version
+
+    def _read(self, collection, doc_id):
+        entry = self._docs.get((collection, doc_id))
+        return Document(doc_id, dict(entry[0]), _to_version(entry[1])) if entry else None
+
+    def get(self, collection, doc_id):
+        with self._lock:
+            return self._read(collection, doc_id)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._read(c, d) for c, d in keys]
+
+    def query(self, collection, where=(), order_by=None, descending=False, limit=None, select=None):
+        with self._lock:
+            documents = [Document(doc_id, dict(data), _to_version(version))
+                         for (c, doc_id), (data, version) in self._docs.items()
+                         if c == collection and _matches(data, where)]
+        if order_by:
+            documents = _sort_documents(documents, order_by, descending)
+        return documents[:limit] if limit else documents
+
+    def add(self, collection, data):
+        doc_id = uuid.uuid4().hex[:20]
+        self.commit([("create", collection, doc_id, data, None, False)])
+        return doc_id
+
+    def batch(self):
+        return Batch(self)
+
+    def commit(self, writes):
+        with self._lock:
+            for op, collection, doc_id, data, version, merge in writes:
+                current = self._docs.get((collection, doc_id))
+                if op == "create" and current is not None:
+                    raise ConflictError(f"文件已存在：{collection}/{doc_id}")
+                if op == "update" and (current is None or version is not None and _from_version(version) != current[1]):
+                    raise ConflictError(f"文件版本不符：{collection}/{doc_id}")
+            versions, changed = [], []
+            for op, collection, doc_id, data, version, merge in writes:
+                new_version = self._next_version()
+                if op == "delete":
+                    self._docs.pop((collection, doc_id), None)
+                    changed.append((collection, doc_id, None, new_version))
+                else:
+                    current = self._docs.get((collection, doc_id), (None, 0))[0]
+                    new_data = _apply_write(current, data, merge)
+                    self._docs[(collection, doc_id)] = (new_data, new_version)
+                    changed.append((collection, doc_id, dict(new_data), new_version))
+                versions.append(_to_version(new_version))
+            self._publish(changed)
+        return versions
+
+    def transact(self, collection, doc_id, fn):
+        with self._lock:
+            current = self._docs.get((collection, doc_id))
+            data, result = fn(dict(current[0]) if current else None)
+            if data is DELETE:
+                self.commit([("delete", collection, doc_id, None, None, False)])
+            elif data is not None:
+                self.commit([("set", collection, doc_id, data, None, False)])
+            return result
+
+    def watch(self, collection, callback, where=()):
+        watch = _Watch(self, collection, where, callback)
+        with self._lock:
+            self._watches.append(watch)
+            initial = [watch.changes(doc_id, dict(data), _to_version(version))
+                       for (c, doc_id), (data, version) in self._docs.items() if c == collection]
+            watch.notify(initial, _to_version(self._last_version))
+        return watch
+
+    def _publish(self, changed):
+        self._watches = [w for w in self._watches if w.active]
+        read_time = _to_version(max((version for *_, version in changed), default=self._last_version))
+        for watch in self._watches:
+            changes = [watch.changes(doc_id, data, _to_version(version))
+                       for collection, doc_id, data, version in changed if collection == watch.collection]
+            watch.notify(changes, read_time)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"無法序列化的欄位值：{value!r}")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+class SQLiteStore:
+    """單機部署用的 SQLite 後端
+
+    所有集合存放在同一張表，文件內容為 JSON；以 WAL 模式讓讀取不被寫入阻塞，
+    寫入以 BEGIN IMMEDIATE 序列化，同一台機器上的多個 worker 可共用同一個檔案。
+    所有 SQL 皆為固定字串加參數，由 sqlite3 的 statement cache 重用編譯結果。
+    刪除的文件保留為 data 為 NULL 的紀錄，watch 以輪詢版本號取得其他行程的變更；
+    超過 tombstone_retention 秒且本行程所有 watch 都已讀過的刪除紀錄，會在之後的刪除時一併清除。
+    """
+
+    def __init__(self, path, poll_interval=1.0, tombstone_retention=3600):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.tombstone_retention = tombstone_retention
+        self._next_reclaim = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._watches = []
+        self._poller = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                id TEXT NOT NULL,
+                data TEXT,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (collection, id)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS documents_version ON documents (version)")
+        conn.execute("CREATE INDEX IF NOT EXISTS documents_collection_version ON documents (collection, version)")
+
+    @staticmethod
+    def _dumps(data):
+        return json.dumps(data, ensure_ascii=False, default=_json_default)
+
+    @staticmethod
+    def _loads(text):
+        return json.loads(text, object_hook=_json_object_hook)
+
+    def _read(self, conn, collection, doc_id):
+        return conn.execute("SELECT data, version FROM documents WHERE collection = ? AND id = ?",
+                            (collection, doc_id)).fetchone()
+
+    def get(self, collection, doc_id):
+        return self.get_many([(collection, doc_id)])[0]
+
+    def get_many(self, keys):
+        conn = self._connect()
+        documents = []
+        for collection, doc_id in keys:
+            row = self._read(conn, collection, doc_id)
+            documents.append(Document(doc_id, self._loads(row[0]), _to_version(row[1]))
+                             if row and row[0] is not None else None)
+        return documents
+
+    def query(self, collection, where=(), order_by=None, descending=False, limit=None, select=None):
+        # 純量條件交由 SQLite 以 json_extract 過濾，其餘條件（例如 datetime）讀出後再比對
+        sql = ["SELECT id, data, version FROM documents WHERE collection = ? AND data IS NOT NULL"]
+        params = [collection]
+        remaining = []
+        for field, op, value in where:
+            path = f'$."{field}"'
+            if op in ("==", ">=", ">", "<=", "<") and isinstance(value, (str, int, float)):
+                sql.append(f"AND json_extract(data, ?) {'=' if op == '==' else op} ?")
+                params += [path, value]
+            elif op == "in" and value and all(isinstance(v, (str, int, float)) for v in value):
+                sql.append(f"AND json_extract(data, ?) IN ({', '.join('?' * len(value))})")
+                params += [path, *value]
+            else:
+                remaining.append((field, op, value))
+        if order_by:
+            sql.append(f"AND json_extract(data, ?) IS NOT NULL ORDER BY json_extract(data, ?) "
+                       f"{'DESC' if descending else 'ASC'}")
+            params += [f'$."{order_by}"'] * 2
+        if limit and not remaining:
+            sql.append("LIMIT ?")
+            params.append(limit)
+        rows = self._connect().execute(" ".join(sql), params).fetchall()
+        documents = [Document(doc_id, self._loads(data), _to_version(version)) for doc_id, data, version in rows]
+        if remaining:
+            documents = [d for d in documents if _matches(d.data, remaining)]
+            documents = documents[:limit] if limit else documents
+        return documents
+
+    def add(self, collection, data):
+        doc_id = uuid.uuid4().hex[:20]
+        self.commit([("create", collection, doc_id, data, None, False)])
+        return doc_id
+
+    def batch(self):
+        return Batch(self)
+
+    def _next_version(self, conn):
+        # 在 BEGIN IMMEDIATE 中取得，跨行程也嚴格遞增，watch 才不會漏掉變更
+        latest = conn.execute("SELECT MAX(version) FROM documents").fetchone()[0] or 0
+        return max(latest + 1, int(time.time() * 1_000_000))
+
+    def _write(self, conn, collection, doc_id, data, version):
+        conn.execute("INSERT OR REPLACE INTO documents (collection, id, data, version) VALUES (?, ?, ?, ?)",
+                     (collection, doc_id, self._dumps(data) if data is not None else None, version))
+
+    def commit(self, writes):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            versions = []
+            for op, collection, doc_id, data, version, merge in writes:
+                row = self._read(conn, collection, doc_id)
+                current = self._loads(row[0]) if row and row[0] is not None else None
+                if op == "create" and current is not None:
+                    raise ConflictError(f"文件已存在：{collection}/{doc_id}")
+                if op == "update" and (current is None or version is not None and _from_version(version) != row[1]):
+                    raise ConflictError(f"文件版本不符：{collection}/{doc_id}")
+                new_version = self._next_version(conn)
+                self._write(conn, collection, doc_id,
+                            None if op == "delete" else _apply_write(current, data, merge), new_version)
+                versions.append(_to_version(new_version))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if any(write[0] == "delete" for write in writes):
+            self._reclaim(conn)
+        return versions
+
+    def transact(self, collection, doc_id, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._read(conn, collection, doc_id)
+            data, result = fn(self._loads(row[0]) if row and row[0] is not None else None)
+            if data is DELETE:
+                self._write(conn, collection, doc_id, None, self._next_version(conn))
+            elif data is not None:
+                self._write(conn, collection, doc_id, _apply_write(None, data, False), self._next_version(conn))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if data is DELETE:
+            self._reclaim(conn)
+        return result
+
+    def _reclaim(self, conn):
+        """實際刪除舊的刪除紀錄，每 tombstone_retention 的十分之一最多執行一次
+
+        只刪除早於保留期限（其他行程的 watch 需在期限內讀到）且早於本行程最慢的 watch 已讀到的版本。
+        """
+        now = time.time()
+        with self._lock:
+            if now < self._next_reclaim:
+                return
+            self._next_reclaim = now + self.tombstone_retention / 10
+            cutoff = min([int((now - self.tombstone_retention) * 1_000_000)]
+                         + [w.since for w in self._watches if w.active])
+        try:
+            deleted = conn.execute("DELETE FROM documents WHERE data IS NULL AND version < ?", (cutoff,)).rowcount
+            if deleted:
+                logger.info(f"已清除 {deleted} 筆刪除紀錄")
+        except sqlite3.Error as e:
+            logger.warning(f"清除刪除紀錄失敗：{e}")
+
+    def watch(self, collection, callback, where=()):
+        watch = _Watch(self, collection, where, callback)
+        conn = self._connect()
+        watch.since = conn.execute("SELECT MAX(version) FROM documents").fetchone()[0] or 0
+        initial = [watch.changes(doc.id, doc.data, doc.version) for doc in self.query(collection, where)]
+        watch.notify(initial, _to_version(watch.since))
+        with self._lock:
+            self._watches.append(watch)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="sqlite-watch", daemon=True)
+                self._poller.start()
+        return watch
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                self._watches = [w for w in self._watches if w.active]
+                watches = list(self._watches)
+            for watch in watches:
+                try:
+                    rows = self._connect().execute(
+                        "SELECT id, data, version FROM documents WHERE collection = ? AND version > ? ORDER BY version",
+                        (watch.collection, watch.since)).fetchall()
+                    changes = []
+                    for doc_id, data, version in rows:
+                        watch.since = version
+                        change = watch.changes(doc_id, self._loads(data) if data is not None else None,
+                                               _to_version(version))
+                        if change is not None:
+                            changes.append(change)
+                    watch.notify(changes, _to_version(watch.since))
+                except Exception as e:
+                    logger.error(f"SQLite watch 輪詢失敗：{e}")
+
+
+def create_store(backend=None):
+    """依 STORAGE_BACKEND（firestore、sqlite、memory）建立儲存後端"""
+    backend = (backend or os.getenv("STORAGE_BACKEND", "firestore")).lower()
+    if backend == "firestore":
+        return FirestoreStore()
+    if backend == "sqlite":
+        return SQLiteStore(os.getenv("SQLITE_STORAGE_PATH", os.path.join("data", "enote.db")),
+                           poll_interval=float(os.getenv("SQLITE_WATCH_INTERVAL", "1.0")),
+                           tombstone_retention=float(os.getenv("SQLITE_TOMBSTONE_RETENTION", "3600")))
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError(f"不支援的儲存後端：{backend}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """取得共用的儲存後端"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store()
+    return _store
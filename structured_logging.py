@@ -0,0 +1,219 @@
+import os
+import re
+import sys
+import copy
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+_context = threading.local()
+
+# LogRecord 內建的屬性，其餘屬性視為 extra 欄位輸出
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "correlation_id"}
+
+# 用戶內容：webhook JSON 中的訊息文字與 token，以及 LINE 用戶 ID
+_REDACTIONS = [
+    (re.compile(r'("(?:text|replyToken|quoteToken|description)"\s*:\s*)"(?:[^"\\]|\\.)*"'), r'\1"[REDACTED]"'),
+    (re.compile(r"\bU[0-9a-f]{32}\b"), lambda m: f"{m.group(0)[:5]}…{m.group(0)[-4:]}"),
+]
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:16]
+
+
+def bind_correlation_id(correlation_id):
+    """設定目前執行緒的 correlation ID，之後的日誌都會帶上"""
+    _context.correlation_id = correlation_id
+
+
+def current_correlation_id():
+    return getattr(_context, "correlation_id", None)
+
+
+@contextmanager
+def correlation(correlation_id=None):
+    """在區塊內使用指定（或新產生）的 correlation ID，結束時恢復原本的"""
+    previous = current_correlation_id()
+    correlation_id = correlation_id or new_correlation_id()
+    bind_correlation_id(correlation_id)
+    try:
+        yield correlation_id
+    finally:
+        bind_correlation_id(previous)
+
+
+def redact(text):
+    """遮蔽用戶訊息內容、token 與完整的用戶 ID"""
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _extras(record):
+    fields = {}
+    for key, value in vars(record).items():
+        if key in _RECORD_ATTRS or key == "sample" or key.startswith("_"):
+            continue
+        if key == "user_content":
+            # 用戶輸入的內容只保留長度
+            fields[key] = f"[REDACTED {len(value or '')} chars]"
+        elif isinstance(value, str):
+            fields[key] = redact(value)
+        else:
+            fields[key] = value
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """每筆日誌輸出為一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": redact(record.getMessage()),
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        entry.update(_extras(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地開發用的單行文字格式，同樣會遮蔽用戶內容"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s")
+
+    def format(self, record):
+        record = copy.copy(record)
+        record.msg, record.args = redact(record.getMessage()), None
+        record.correlation_id = getattr(record, "correlation_id", None) or "-"
+        line = super().format(record)
+        extras = _extras(record)
+        if extras:
+            line += " " + " ".join(f"{key}={value}" for key, value in extras.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """依 extra={"sample": 類別} 抽樣大量的日誌，例如 webhook 請求內容"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        category = getattr(record, "sample", None)
+        if category is None:
+            return True
+        rate = self.rates.get(category, 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+class ContextFilter(logging.Filter):
+    """在呼叫端執行緒記下 correlation ID，背景輸出時才不會遺失"""
+
+    def filter(self, record):
+        record.correlation_id = current_correlation_id()
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """放入有界佇列，佇列已滿時丟棄日誌而不阻塞呼叫端"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 只在呼叫端合併訊息參數與例外內容，JSON 格式化與遮蔽交給背景執行緒
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _StderrHandler(logging.StreamHandler):
+    # 每次寫入時才取得 sys.stderr，重新導向 stderr 時也會跟著改變
+    def __init__(self):
+        super().__init__(sys.stderr)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def parse_rates(text):
+    """解析 "request_body=0.01,other=0.5" 格式的抽樣比例"""
+    rates = {}
+    for item in (text or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+_handler = None
+_lock = threading.Lock()
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """將 root logger 改為經由有界佇列、由背景執行緒輸出（只會設定一次）
+
+    LOG_LEVEL 設定等級，LOG_FORMAT 為 json（預設）或 text，LOG_QUEUE_SIZE 為佇列上限，
+    LOG_SAMPLE_RATES 設定各抽樣類別保留的比例。回傳佇列 handler。
+    """
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return _handler
+        output = logging.StreamHandler(stream) if stream is not None else _StderrHandler()
+        fmt = (fmt or os.getenv("LOG_FORMAT", "json")).lower()
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+        log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(SamplingFilter(parse_rates(os.getenv("LOG_SAMPLE_RATES", "request_body=0.01"))))
+        handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
+
+        listener = QueueListener(log_queue, output)
+        listener.start()
+        atexit.register(listener.stop)
+        _handler = handler
+        return handler
+
+
+def stats():
+    return {"dropped": _handler.dropped if _handler else 0,
+            "queued": _handler.queue.qsize() if _handler else 0}
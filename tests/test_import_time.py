@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "import_time.py")
+
+
+def run_check(*args):
+    return subprocess.run([sys.executable, SCRIPT, "--no-profile", *args],
+                          capture_output=True, text=True, timeout=120)
+
+
+def test_import_app_within_budget_without_heavy_modules():
+    """import app 不超過預算（IMPORT_TIME_BUDGET，預設 1 秒），且不載入重量級套件"""
+    proc = run_check()
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    assert "超過 import 時間預算" not in proc.stdout
+    assert "應延遲載入的套件" not in proc.stdout
+
+
+def test_check_fails_when_forbidden_module_loaded():
+    """檢查本身有效：app 會載入的模組列為禁止時以非零狀態結束"""
+    proc = run_check("--runs", "1", "--forbid", "flask")
+    assert proc.returncode == 1
+    assert "flask" in proc.stdout
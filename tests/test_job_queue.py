@@ -0,0 +1,19 @@
+from job_queue import JobQueue
+
+
+def test_claim_purges_done_jobs_past_retention(tmp_path):
+    """領取工作時刪除完成超過保留天數的工作，保留較新的完成工作與失敗的工作"""
+    queue = JobQueue(str(tmp_path / "jobs.db"), handler=lambda queue, job: None,
+                     retention_days=1, purge_interval=0)
+    for _ in range(3):
+        queue.enqueue({})
+    for status in ("done", "done", "failed"):
+        job = queue._claim()
+        queue._connect().execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?",
+                                 (status, job.enqueued_at - 2 * 86400, job.id))
+    queue.enqueue({})
+    queue._complete(queue._claim())
+
+    assert queue._claim() is None
+    stats = queue.stats()
+    assert (stats["done"], stats["failed"]) == (1, 1)
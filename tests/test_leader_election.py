@@ -0,0 +1,63 @@
+from leader_election import LeaderElector, InMemoryLeaseStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_failed_on_elected_releases_lease_and_retries():
+    """on_elected 失敗時不成為領導者、釋放租約，下一次 heartbeat 重試"""
+    store = InMemoryLeaseStore()
+    clock = FakeClock()
+    calls = []
+
+    def on_elected():
+        calls.append(clock.now)
+        if len(calls) == 1:
+            raise RuntimeError("啟動失敗")
+
+    elector = LeaderElector("job", store, on_elected, ttl=10, heartbeat=3, holder="a", clock=clock)
+    assert elector.step() is False
+    assert elector.is_leader is False
+    assert store.holder("job") is None
+
+    clock.now += 3
+    assert elector.step() is True
+    assert elector.is_leader is True
+    assert store.holder("job") == "a"
+    assert len(calls) == 2
+
+
+def test_other_node_takes_over_after_failed_start():
+    store = InMemoryLeaseStore()
+    clock = FakeClock()
+
+    def broken():
+        raise RuntimeError("啟動失敗")
+
+    a = LeaderElector("job", store, broken, ttl=10, holder="a", clock=clock)
+    b = LeaderElector("job", store, lambda: None, ttl=10, holder="b", clock=clock)
+    assert a.step() is False
+    # 不必等租約到期，其他節點立即可以接手
+    assert b.step() is True
+    assert store.holder("job") == "b"
+
+
+def test_leader_steps_down_when_lease_taken():
+    store = InMemoryLeaseStore()
+    clock = FakeClock()
+    revoked = []
+    a = LeaderElector("job", store, lambda: None, on_revoked=lambda: revoked.append("a"),
+                      ttl=10, holder="a", clock=clock)
+    b = LeaderElector("job", store, lambda: None, ttl=10, holder="b", clock=clock)
+    assert a.step() is True
+    assert b.step() is False
+
+    clock.now += 11
+    assert b.step() is True
+    assert a.step() is False
+    assert revoked == ["a"]
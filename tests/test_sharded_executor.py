@@ -0,0 +1,90 @@
+import time
+import threading
+import queue
+
+import pytest
+
+from sharded_executor import ShardedExecutor
+
+
+def test_same_key_runs_in_order_after_takeovers():
+    """超時工作被接手多次後，同一 key 後續的工作仍依提交順序執行"""
+    for _ in range(5):
+        executor = ShardedExecutor(shards=1, queue_size=100, timeout=0.1)
+        order = []
+        lock = threading.Lock()
+
+        def job(i, delay):
+            time.sleep(delay)
+            with lock:
+                order.append(i)
+
+        futures = [executor.submit("user", job, 0, 0.5)]
+        futures += [executor.submit("user", job, i, 0.15) for i in range(1, 6)]
+        for future in futures:
+            future.result(timeout=10)
+        assert order == [0, 1, 2, 3, 4, 5]
+
+
+def test_other_keys_not_blocked_by_timed_out_job():
+    executor = ShardedExecutor(shards=1, queue_size=100, timeout=0.1)
+    release = threading.Event()
+    slow = executor.submit("slow", release.wait, 5)
+    started = time.monotonic()
+    executor.submit("fast", lambda: None).result(timeout=2)
+    assert time.monotonic() - started < 1
+    release.set()
+    slow.result(timeout=2)
+    executor.join()
+    assert executor.stats()["timeouts"] >= 1
+
+
+def test_stalled_workers_are_bounded():
+    executor = ShardedExecutor(shards=1, queue_size=100, timeout=0.05, max_stalled=2)
+    release = threading.Event()
+    futures = [executor.submit(f"key-{i}", release.wait, 5) for i in range(5)]
+    time.sleep(0.5)
+    assert executor.stats()["stalled"] == 2
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    executor.join()
+    time.sleep(0.1)
+    assert executor.stats()["stalled"] == 0
+
+
+def test_submit_raises_when_shard_full():
+    executor = ShardedExecutor(shards=1, queue_size=1)
+    release = threading.Event()
+    executor.submit("a", release.wait, 5)
+    time.sleep(0.05)  # 第一個工作開始執行後不再佔用佇列
+    executor.submit("b", lambda: None)
+    with pytest.raises(queue.Full):
+        executor.submit("c", lambda: None, block_timeout=0.05)
+    release.set()
+    executor.join()
+
+
+def test_take_queued_removes_consecutive_matching_jobs():
+    """取出同一 key 排在執行中工作之後、連續符合條件的工作，其餘工作照原順序執行"""
+    executor = ShardedExecutor(shards=1, queue_size=100)
+    release = threading.Event()
+    order = []
+
+    def job(kind, i):
+        if kind == "block":
+            release.wait(5)
+        order.append(i)
+
+    first = executor.submit("user", job, "block", 0)
+    queued = [executor.submit("user", job, kind, i)
+              for i, kind in enumerate(["text", "text", "other", "text"], start=1)]
+    taken = executor.take_queued("user", lambda args: args[0] == "text")
+    release.set()
+    executor.join()
+
+    assert [args[1] for args in taken] == [1, 2]
+    assert queued[0].result(timeout=1) is None and queued[1].result(timeout=1) is None
+    assert order == [0, 3, 4]
+    assert first.done()
+    assert executor.depth() == 0
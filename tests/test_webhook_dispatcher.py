@@ -0,0 +1,38 @@
+import threading
+from types import SimpleNamespace
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+class FakeEvent:
+    def __init__(self, user_id):
+        self.source = SimpleNamespace(user_id=user_id)
+
+
+def make_handler(events, func):
+    parser = SimpleNamespace(parse=lambda body, signature, as_payload=True:
+                             SimpleNamespace(events=events, destination="bot"))
+    return SimpleNamespace(parser=parser, _handlers={"FakeEvent": func}, _default=None)
+
+
+def test_handle_reports_dropped_events_when_queue_full():
+    """同步模式分片佇列已滿時回傳丟棄數量，呼叫端才能回應 503 讓 LINE 重送"""
+    release = threading.Event()
+    handler = make_handler([FakeEvent("U1") for _ in range(5)], lambda event: release.wait(2))
+    dispatcher = WebhookDispatcher(handler, shards=1, queue_size=1, put_timeout=0.01, event_timeout=0.1)
+    dispatcher.start()
+    try:
+        dropped = dispatcher.handle("{}", "signature")
+    finally:
+        release.set()
+    assert dropped > 0
+    assert dispatcher.stats()["dropped"] == dropped
+
+
+def test_handle_returns_zero_when_all_events_accepted():
+    handled = []
+    handler = make_handler([FakeEvent("U1"), FakeEvent("U2")], handled.append)
+    dispatcher = WebhookDispatcher(handler, shards=2, queue_size=10, event_timeout=1)
+    dispatcher.start()
+    assert dispatcher.handle("{}", "signature") == 0
+    assert len(handled) == 2
@@ -0,0 +1,44 @@
+import pytest
+
+import repositories
+import storage
+import wishlist
+from notifications import NotificationHandler
+from review_monitor import ReviewMonitor
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = storage.MemoryStore()
+    monkeypatch.setattr(repositories.wishlist_repository, "_store", store)
+    return store
+
+
+def test_wish_notified_when_matching_subject_published(store, monkeypatch):
+    """許願「統計學」的用戶在「統計學_機率」上架時收到通知，上傳者與無關課程不通知"""
+    sent = []
+    monkeypatch.setattr(NotificationHandler, "send_wish_fulfilled_notification",
+                        lambda api, user_ids, subject, file_name, code: sent.append((user_ids, subject, code)))
+    wishlist.submit_wishlist("U1", "統計學", "")
+    wishlist.submit_wishlist("U2", "統計 學", "")
+    wishlist.submit_wishlist("Uuploader", "統計學", "")
+    wishlist.submit_wishlist("U3", "微積分", "")
+
+    ReviewMonitor(None).notify_wishers(
+        {"subject": "統計學_機率", "user_id": "Uuploader", "file_name": "a.pdf", "code": "A13"})
+
+    assert len(sent) == 1
+    user_ids, subject, code = sent[0]
+    assert sorted(user_ids) == ["U1", "U2"]
+    assert (subject, code) == ("統計學_機率", "A13")
+
+
+def test_repeat_wish_counted_once(store):
+    wishlist.submit_wishlist("U1", "統計學", "a")
+    wishlist.submit_wishlist("U1", "統計學", "b")
+    wishlist.submit_wishlist("U2", "統計學", "")
+    assert wishlist.get_top_wishes() == [{"course": "統計學", "count": 2}]
+
+    wishlist.delete_user_wishlist("U1", "統計學")
+    assert wishlist.get_top_wishes() == [{"course": "統計學", "count": 1}]
+    assert wishlist.get_wishing_users("統計學") == ["U2"]
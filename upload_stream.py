@@ -0,0 +1,58 @@
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+READ_SIZE = 64 * 1024
+
+
+class MultipartStream:
+    """逐段解析 multipart/form-data 請求，不將整個檔案讀入記憶體或寫入磁碟
+
+    表單欄位須出現在檔案之前（upload.html 的欄位順序即是如此），
+    read_fields() 讀取到檔案開頭為止，之後以 iter_file() 逐段取得檔案內容。
+    """
+
+    def __init__(self, stream, boundary, read_size=READ_SIZE, max_form_memory_size=500 * 1024):
+        self.stream = stream
+        self.read_size = read_size
+        self.decoder = MultipartDecoder(boundary.encode(), max_form_memory_size)
+        self._events = self._iter_events()
+
+    def _iter_events(self):
+        while True:
+            event = self.decoder.next_event()
+            if isinstance(event, NeedData):
+                data = self.stream.read(self.read_size)
+                self.decoder.receive_data(data or None)
+                continue
+            yield event
+            if isinstance(event, Epilogue):
+                return
+
+    def read_fields(self):
+        """讀取檔案之前的表單欄位，回傳 (欄位, 檔名, 檔案 content-type)；沒有檔案時檔名為 None"""
+        fields = {}
+        name, value = None, bytearray()
+        for event in self._events:
+            if isinstance(event, Field):
+                name, value = event.name, bytearray()
+            elif isinstance(event, Data) and name is not None:
+                value += event.data
+                if not event.more_data:
+                    fields[name] = value.decode("utf-8")
+                    name = None
+            elif isinstance(event, File):
+                return fields, event.filename, event.headers.get("content-type")
+        return fields, None, None
+
+    def iter_file(self):
+        """逐段產生目前檔案的內容"""
+        for event in self._events:
+            if isinstance(event, Data):
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    return
+
+    def drain(self):
+        """讀完剩餘的請求內容"""
+        for _ in self._events:
+            pass
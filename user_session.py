@@ -0,0 +1,164 @@
+import logging
+import threading
+from contextlib import contextmanager
+from repositories import session_repository
+from session_cache import session_cache
+from storage import ConflictError
+from metrics import stage
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# 每個執行緒目前處理中的用戶 session
+_local = threading.local()
+
+# 版本衝突時重新讀取並重試的次數
+COMMIT_RETRIES = 3
+
+
+class UserSession:
+    """單一 webhook 事件期間的用戶資料：狀態與對話歷史
+
+    事件開始時一次讀取（優先使用快取），過程中的修改只保留在記憶體，事件結束時以一次 batch 寫回。
+    寫入以讀取時的版本為前置條件，其他 worker 已修改時會重新讀取並重新套用本次的變更。
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.state = "default"
+        self.conversations = []
+        self.summary = ""
+        self.state_version = None
+        self.history_version = None
+        self._state_dirty = False
+        self._summary_dirty = False
+        self._pending_messages = []
+        self._trim = None
+
+    def load(self, use_cache=True):
+        """讀取用戶狀態與對話歷史；快取未命中時以一次讀取同時取得"""
+        session_cache.start_listener(session_repository)
+        cached = session_cache.get(self.user_id) if use_cache else None
+        if cached is not None:
+            self.state = cached.state
+            self.conversations = list(cached.conversations)
+            self.summary = cached.summary
+            self.state_version = cached.state_version
+            self.history_version = cached.history_version
+            return self
+
+        self.state, self.conversations, self.summary = "default", [], ""
+        self.state_version = self.history_version = None
+        try:
+            with stage("storage_read"):
+                state, history = session_repository.load(self.user_id)
+            if state is not None:
+                self.state = state.data.get("state", "default")
+                self.state_version = state.version
+            if history is not None:
+                self.conversations = history.data.get("conversations", [])
+                self.summary = history.data.get("summary", "")
+                self.history_version = history.version
+            self._cache()
+        except Exception as e:
+            logger.error(f"Error loading user session: {e}")
+        return self
+
+    def set_state(self, state):
+        if state == self.state:
+            session_cache.record_skipped_write()
+            return
+        self.state = state
+        self._state_dirty = True
+
+    def append_message(self, message, trim=None):
+        """加入一則對話，trim 為修剪對話歷史的函數"""
+        self._pending_messages.append(message)
+        self._trim = trim
+        conversations = self.conversations + [message]
+        self.conversations = trim(conversations) if trim else conversations
+
+    def set_summary(self, summary):
+        """更新對話摘要（由背景摘要工作呼叫）"""
+        self.summary = summary
+        self._summary_dirty = True
+
+    @property
+    def history_dirty(self):
+        return bool(self._pending_messages) or self._summary_dirty
+
+    @property
+    def dirty(self):
+        return self._state_dirty or self.history_dirty
+
+    def commit(self):
+        """將修改過的欄位以一次 batch 寫回"""
+        if not self.dirty:
+            return
+        for _ in range(COMMIT_RETRIES):
+            try:
+                self._write()
+                return
+            except ConflictError:
+                # 其他 worker 已更新，重新讀取後再套用本次變更
+                session_cache.record_conflict(self.user_id)
+                self._reload_and_replay()
+            except Exception as e:
+                session_cache.invalidate(self.user_id)
+                logger.error(f"Error committing user session: {e}")
+                return
+        logger.error(f"Error committing user session: 版本衝突重試次數已用盡 ({self.user_id})")
+
+    def _write(self):
+        history = {"conversations": self.conversations, "summary": self.summary} if self.history_dirty else None
+        with stage("storage_write"):
+            self.state_version, self.history_version = session_repository.save(
+                self.user_id,
+                state=self.state if self._state_dirty else None, state_version=self.state_version,
+                history=history, history_version=self.history_version)
+        self._state_dirty = self._summary_dirty = False
+        self._pending_messages = []
+        self._cache()
+
+    def _reload_and_replay(self):
+        state, state_dirty = self.state, self._state_dirty
+        summary, summary_dirty = self.summary, self._summary_dirty
+        pending = self._pending_messages
+        self.load(use_cache=False)
+        self._state_dirty = state_dirty and state != self.state
+        self.state = state if state_dirty else self.state
+        if summary_dirty:
+            self.set_summary(summary)
+        self._pending_messages = []
+        for message in pending:
+            self.append_message(message, self._trim)
+
+    def _cache(self):
+        session_cache.put(self.user_id, self.state, self.conversations,
+                          self.state_version, self.history_version, self.summary)
+
+
+def current_session(user_id):
+    """取得目前執行緒中該用戶的 session，沒有則回傳 None"""
+    session = getattr(_local, "session", None)
+    if session is not None and session.user_id == user_id:
+        return session
+    return None
+
+
+@contextmanager
+def open_session(user_id):
+    """在事件處理期間開啟用戶 session，結束時統一寫回；已有 session 時直接沿用"""
+    session = current_session(user_id)
+    if session is not None:
+        yield session
+        return
+
+    session = UserSession(user_id).load()
+    previous = getattr(_local, "session", None)
+    _local.session = session
+    try:
+        yield session
+    finally:
+        _local.session = previous
+        session.commit()
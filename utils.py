@@ -1,7 +1,11 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
 from linebot.models import TextSendMessage
+from flexmessage import RenderedFlexMessage
+from drive_client import drive_client
+from note_index import fingerprint_index
+from repositories import note_repository
+from push_dispatcher import get_push_dispatcher
+from structured_logging import current_correlation_id
+from metrics import stage
 import os
 import json
 import logging
@@ -9,11 +13,15 @@ from datetime import datetime
 
 # 設定日誌
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+# 重送通知的工作等待推播送達的上限，逾時視為失敗並由工作重試
+UPLOAD_NOTIFY_TIMEOUT = float(os.getenv("UPLOAD_NOTIFY_TIMEOUT", "60"))
 
 def check_environment_variables():
     """檢查必要的環境變數是否已設置"""
-    required_env_vars = ["GOOGLE_DRIVE_CREDENTIALS", "FIREBASE_CREDENTIALS", "CHANNEL_ACCESS_TOKEN", "CHANNEL_SECRET"]
+    required_env_vars = ["GOOGLE_DRIVE_CREDENTIALS", "CHANNEL_ACCESS_TOKEN", "CHANNEL_SECRET"]
+    if os.getenv("STORAGE_BACKEND", "firestore") == "firestore":
+        required_env_vars.append("FIREBASE_CREDENTIALS")
     missing_vars = [var for var in required_env_vars if not os.getenv(var)]
     if missing_vars:
         raise EnvironmentError(f"缺少以下環境變數：{', '.join(missing_vars)}")
@@ -23,31 +31,23 @@ def check_environment_variables():
 def upload_file_to_google_drive(file_path, file_name, folder_id):
     """將檔案上傳到 Google Drive，並返回下載連結"""
     try:
-        credentials_info = json.loads(os.getenv("GOOGLE_DRIVE_CREDENTIALS"))
-        creds = service_account.Credentials.from_service_account_info(credentials_info)
-        service = build("drive", "v3", credentials=creds)
-
-        # 構建文件元數據
-        file_metadata = {"name": file_name, "parents": [folder_id]}
-        media = MediaFileUpload(file_path, resumable=True)
-        file = service.files().create(body=file_metadata, media_body=media, fields="id").execute()
-        file_id = file.get("id")
-
-        # 設置檔案為公開可讀
-        service.permissions().create(fileId=file_id, body={"type": "anyone", "role": "reader"}).execute()
-
-        # 返回下載連結
-        return f"https://drive.google.com/uc?id={file_id}&export=download"
+        # 使用共用的 Drive 客戶端分段上傳
+        file_id = drive_client.upload_file(file_path, file_name, folder_id)
+        return publish_drive_file(file_id)
     except Exception as e:
         logger.error(f"Google Drive 上傳失敗：{e}")
         raise Exception(f"Google Drive 上傳失敗：{e}")
 
-def save_file_metadata(user_id, file_name, file_url, upload_time, subject="", grade="", year="", price=""):
-    """儲存文件元數據到 Firebase Firestore"""
+def publish_drive_file(file_id):
+    """將 Drive 檔案設為公開可讀，並返回下載連結"""
+    drive_client.make_public(file_id)
+    return f"https://drive.google.com/uc?id={file_id}&export=download"
+
+def save_file_metadata(user_id, file_name, file_url, upload_time, subject="", grade="", year="", price="",
+                       sha256=None, size=None):
+    """儲存文件元數據到 notes 集合"""
     try:
-        from firebase_admin import firestore
-        db = firestore.client()
-        db.collection("notes").add({
+        note = {
             "user_id": user_id,
             "file_name": file_name,
             "file_url": file_url,
@@ -56,44 +56,128 @@ def save_file_metadata(user_id, file_name, file_url, upload_time, subject="", gr
             "year": year,
             "price": price,
             "upload_time": upload_time,
-            "status": "審核中"
-        })
+            "status": "審核中",
+            "sha256": sha256,
+            "size": size
+        }
+        note_id = note_repository.add(note)
+        fingerprint_index.add(note_id, note)
         logger.info(f"文件元數據已成功儲存：{file_name}")
     except Exception as e:
         logger.error(f"儲存文件元數據失敗：{e}")
         raise Exception(f"儲存文件元數據失敗：{e}")
 
-def background_upload_and_save(user_id, year, file_name, file_path, subject, grade, price, upload_time, folder_id, line_bot_api):
-    """後台處理文件上傳到 Google Drive 並儲存元數據到 Firestore"""
-    try:
-        logger.info(f"開始處理文件：{file_name}，用戶：{user_id}")
+def _message_from_json(data):
+    if data["type"] == "flex":
+        return RenderedFlexMessage(data["altText"], data["contents"])
+    return TextSendMessage(text=data["text"])
 
-        # 上傳到 Google Drive
-        file_url = upload_file_to_google_drive(file_path, file_name, folder_id)
+def push_notification(job_queue, user_id, message, line_bot_api):
+    """經由 push dispatcher 發送通知，不等待送達
 
-        # 儲存元數據到 Firestore
-        save_file_metadata(user_id, file_name, file_url, upload_time, subject, grade, year, price)
+    dispatcher 重試用盡仍無法送達時，將訊息另排為佇列中的通知工作，由工作的重試機制繼續發送，通知不會因此遺失。
+    """
+    correlation_id = current_correlation_id()
 
-        # 通知用戶上傳成功
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(
-                text="✅ 您的檔案已成功上傳！ 🎉\n"
-                     "📬 我們會在有最新進展時通知您，筆記審核通過後將由 Enote 上架！✨\n"
-                     "📢 上架成功後我們也會再次通知您！ 📚"
-            )
-        )
-        logger.info(f"文件處理成功：{file_name}，下載連結：{file_url}")
+    def on_done(future):
+        if future.exception() is None:
+            return
+        logger.warning(f"通知用戶 {user_id} 失敗，改由工作佇列重送：{future.exception()}")
+        try:
+            job_queue.enqueue({"user_id": user_id, "notify": message.as_json_dict(),
+                               "correlation_id": correlation_id})
+        except Exception as e:
+            logger.error(f"排入重送通知失敗：{e}")
 
-    except Exception as e:
-        logger.error(f"文件處理失敗：{e}")
-        # 通知用戶處理失敗
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text="❌ 文件處理失敗，請稍後再試。")
-        )
-    finally:
-        # 刪除本地文件
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"已刪除本地文件：{file_path}")
+    get_push_dispatcher(line_bot_api).send(user_id, message).add_done_callback(on_done)
+
+def process_note_upload(job_queue, job, line_bot_api):
+    """處理筆記上傳工作：上傳到 Google Drive、儲存元數據並通知用戶
+
+    每個步驟完成後都會保存進度，重試時略過已完成的步驟；本地文件只在全部成功後刪除。
+    """
+    data = job.payload
+    user_id = data["user_id"]
+
+    # 重送未送達的通知：等待送達，失敗時由工作重試
+    if data.get("notify"):
+        get_push_dispatcher(line_bot_api).send(user_id, _message_from_json(data["notify"])).result(
+            timeout=UPLOAD_NOTIFY_TIMEOUT)
+        return
+
+    file_name = data["file_name"]
+    file_path = data["file_path"]
+    logger.info(f"開始處理文件：{file_name}，用戶：{user_id}（第 {job.attempts} 次）")
+
+    # 重複上傳的檔案不再上傳與審核，只通知用戶
+    if data.get("duplicate_of"):
+        notify_duplicate_upload(job_queue, user_id, file_name, data["duplicate_of"], line_bot_api)
+        return
+
+    # 通知用戶已收到檔案
+    if data.get("received_message") and not data.get("received_notified"):
+        received = data["received_message"]
+        push_notification(job_queue, user_id, RenderedFlexMessage(received["altText"], received["contents"]),
+                          line_bot_api)
+        job_queue.checkpoint(job, received_notified=True)
+
+    # 上傳到 Google Drive（串流上傳已完成或中斷時，僅需公開或續傳）
+    if not data.get("file_url"):
+        with stage("drive_upload", state="upload"):
+            if not data.get("drive_file_id") and data.get("upload_session"):
+                session = data["upload_session"]
+                file_id = drive_client.resume_upload(session["uri"], session["offset"], file_path)
+                job_queue.checkpoint(job, drive_file_id=file_id)
+            if data.get("drive_file_id"):
+                file_url = publish_drive_file(data["drive_file_id"])
+            else:
+                file_url = upload_file_to_google_drive(file_path, file_name, data["folder_id"])
+        job_queue.checkpoint(job, file_url=file_url)
+
+    # 儲存元數據
+    if not data.get("metadata_saved"):
+        with stage("metadata_save", state="upload"):
+            save_file_metadata(user_id, file_name, data["file_url"], data["upload_time"],
+                               data["subject"], data["grade"], data["year"], data["price"],
+                               data.get("sha256"), data.get("size"))
+        job_queue.checkpoint(job, metadata_saved=True)
+
+    # 通知用戶上傳成功
+    push_notification(
+        job_queue,
+        user_id,
+        TextSendMessage(
+            text="✅ 您的檔案已成功上傳！ 🎉\n"
+                 "📬 我們會在有最新進展時通知您，筆記審核通過後將由 Enote 上架！✨\n"
+                 "📢 上架成功後我們也會再次通知您！ 📚"
+        ),
+        line_bot_api
+    )
+    logger.info(f"文件處理成功：{file_name}，下載連結：{data['file_url']}")
+
+    # 刪除本地文件
+    if file_path and os.path.exists(file_path):
+        os.remove(file_path)
+        logger.info(f"已刪除本地文件：{file_path}")
+
+def notify_duplicate_upload(job_queue, user_id, file_name, existing, line_bot_api):
+    """通知用戶此檔案已上傳過；只有上傳者本人的既有筆記才提供檔名與連結"""
+    if existing.get("own", existing.get("user_id") == user_id):
+        text = f"📄 「{file_name}」與您先前上傳的筆記「{existing.get('file_name')}」內容相同，不需重複上傳喔！"
+        if existing.get("file_url"):
+            text += f"\n🔗 您先前上傳的檔案：{existing['file_url']}"
+    else:
+        text = f"📄 「{file_name}」與已上傳的筆記內容相同，不需重複上傳喔！"
+    push_notification(job_queue, user_id, TextSendMessage(text=text), line_bot_api)
+    logger.info(f"重複上傳已略過：{file_name}，既有筆記：{existing.get('id')}")
+
+def notify_upload_failure(job, error, line_bot_api):
+    """上傳工作重試失敗後通知用戶；本地文件保留以便人工處理"""
+    if job.payload.get("notify"):
+        logger.error(f"通知用戶 {job.payload['user_id']} 重試用盡仍失敗：{error}")
+        return
+    logger.error(f"文件處理失敗：{error}，保留本地文件：{job.payload.get('file_path')}")
+    get_push_dispatcher(line_bot_api).send(
+        job.payload["user_id"],
+        TextSendMessage(text="❌ 文件處理失敗，請稍後再試。")
+    )
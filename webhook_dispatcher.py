@@ -0,0 +1,219 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import wait
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import MessageEvent
+
+from metrics import stage, event as track_event
+from sharded_executor import ShardedExecutor
+from event_dedup import EventDeduplicator
+from structured_logging import correlation, current_correlation_id
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# reply token 的有效時間（秒），超過後改用 push_message
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+
+
+def reply_or_push(line_bot_api, event, messages):
+    """以 reply token 回覆訊息；若 token 已過期則改用 push_message 發送"""
+    user_id = getattr(event.source, "user_id", None)
+    age = time.time() - event.timestamp / 1000 if getattr(event, "timestamp", None) else 0
+
+    if age < REPLY_TOKEN_TTL or not user_id:
+        try:
+            with stage("reply"):
+                line_bot_api.reply_message(event.reply_token, messages)
+            return
+        except LineBotApiError as e:
+            message = getattr(e.error, "message", "") or ""
+            if e.status_code != 400 or "reply token" not in message.lower() or not user_id:
+                raise
+            logger.warning(f"reply token 已失效，改用 push_message：{user_id}")
+    else:
+        logger.info(f"事件已延遲 {age:.1f} 秒，直接使用 push_message：{user_id}")
+
+    with stage("push"):
+        line_bot_api.push_message(user_id, messages)
+
+
+class WebhookDispatcher:
+    """驗證簽名後將事件依用戶分片交給背景執行緒處理
+
+    同一 webhook 中不同用戶的事件並行處理，同一用戶的事件依到達順序處理；
+    每個分片有各自的有界佇列，單一事件執行超過 event_timeout 秒時不會拖住同分片的其他用戶。
+    指定 deduplicator 時，LINE 重送的事件在讀取用戶資料與呼叫 OpenAI 之前就會被略過。
+    """
+
+    def __init__(self, handler, shards=16, queue_size=100, put_timeout=0.5, event_timeout=10.0, app=None,
+                 deduplicator=None):
+        self.handler = handler
+        self.deduplicator = deduplicator
+        self.put_timeout = put_timeout
+        self.event_timeout = event_timeout
+        self.app = app
+        # 總容量約為 queue_size，平均分給各分片
+        self.executor = ShardedExecutor(shards, queue_size=max(1, -(-queue_size // shards)),
+                                        timeout=event_timeout, name="webhook")
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls, handler, app=None):
+        """依環境變數建立 dispatcher"""
+        return cls(
+            handler,
+            shards=int(os.getenv("WEBHOOK_SHARDS") or os.getenv("WEBHOOK_WORKERS") or "16"),
+            queue_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "100")),
+            put_timeout=float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", "0.5")),
+            event_timeout=float(os.getenv("WEBHOOK_EVENT_TIMEOUT", "10")),
+            app=app,
+            deduplicator=EventDeduplicator.from_env()
+            if os.getenv("WEBHOOK_DEDUP", "true").lower() in ("1", "true", "yes") else None,
+        )
+
+    def start(self):
+        """啟動分片執行緒（只會啟動一次，於第一次收到事件時呼叫）"""
+        self.executor.start()
+
+    @staticmethod
+    def shard_key(event):
+        """分片依據：用戶 ID，沒有時使用群組或聊天室 ID"""
+        source = getattr(event, "source", None)
+        return (getattr(source, "user_id", None) or getattr(source, "group_id", None)
+                or getattr(source, "room_id", None))
+
+    def _enqueue(self, payload, host):
+        # 事件在工作執行緒中沿用收到 webhook 的請求的 correlation ID
+        correlation_id = current_correlation_id()
+        futures, dropped = [], 0
+        for event in payload.events:
+            # 同一行程已處理過的重送事件不必排入佇列
+            if self.deduplicator is not None and self.deduplicator.seen_locally(event):
+                continue
+            try:
+                futures.append(self.executor.submit(self.shard_key(event), self._process, event,
+                                                    payload.destination, host, correlation_id,
+                                                    block_timeout=self.put_timeout))
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            with self._lock:
+                self.dropped += dropped
+            logger.warning(f"Webhook 佇列已滿，丟棄 {dropped} 個事件")
+        return futures, dropped
+
+    def submit(self, body, signature, host=None):
+        """驗證簽名並將事件依用戶分片排入佇列，回傳 (接收數量, 丟棄數量)
+
+        簽名錯誤時拋出 InvalidSignatureError。分片佇列已滿時最多等待 put_timeout 秒，
+        之後丟棄該事件。
+        """
+        with stage("signature"):
+            payload = self.handler.parser.parse(body, signature, as_payload=True)
+        futures, dropped = self._enqueue(payload, host)
+        return len(futures), dropped
+
+    def handle(self, body, signature, host=None):
+        """同步模式：驗證簽名後並行處理事件，最多等待 event_timeout 秒，回傳丟棄數量；簽名錯誤時拋出 InvalidSignatureError
+
+        超過等待時間的事件會在背景繼續處理，回覆 token 過期時改以 push 發送。
+        分片佇列已滿而丟棄的事件與 submit() 相同計入回傳值，呼叫端應回應 503 讓 LINE 重送。
+        """
+        with stage("signature"):
+            payload = self.handler.parser.parse(body, signature, as_payload=True)
+        futures, dropped = self._enqueue(payload, host)
+        done, pending = wait(futures, timeout=self.event_timeout)
+        if pending:
+            logger.warning(f"{len(pending)} 個事件在 {self.event_timeout} 秒內未完成，於背景繼續處理")
+        return dropped
+
+    def take_following(self, event, predicate):
+        """取出同一用戶排在 event 之後、連續符合 predicate 且尚未處理的事件，由呼叫端一併處理
+
+        取出的事件同樣經過去重，已處理過的重送事件不會回傳。
+        """
+        events = [args[0] for args in self.executor.take_queued(self.shard_key(event),
+                                                                lambda args: predicate(args[0]))]
+        if self.deduplicator is not None:
+            events = [e for e in events if self.deduplicator.claim(e)]
+        if events:
+            with self._lock:
+                self.processed += len(events)
+        return events
+
+    def depth(self):
+        """目前各分片佇列中等待處理的事件數"""
+        return self.executor.depth()
+
+    def join(self):
+        """等待目前佇列中的事件全部處理完成"""
+        self.executor.join()
+
+    def stats(self):
+        """佇列狀態"""
+        executor = self.executor.stats()
+        return {
+            "depth": self.depth(),
+            "capacity": executor["capacity"],
+            "shards": executor["shards"],
+            "shard_depths": executor["depths"],
+            "timeouts": executor["timeouts"],
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "duplicates": self.deduplicator.duplicates if self.deduplicator is not None else 0,
+        }
+
+    def current_host(self):
+        """目前工作執行緒處理中事件的請求 host"""
+        return getattr(self._local, "host", None)
+
+    def dispatch(self, event, destination=None):
+        """依事件類型找到 WebhookHandler 註冊的處理函數並執行"""
+        func = None
+        if isinstance(event, MessageEvent):
+            key = f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+            func = self.handler._handlers.get(key)
+        if func is None:
+            func = self.handler._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self.handler._default
+        if func is None:
+            logger.info(f"沒有對應 {event.__class__.__name__} 的處理函數")
+            return
+
+        with track_event(event.__class__.__name__):
+            if self.app is not None:
+                with self.app.app_context():
+                    func(event)
+            else:
+                func(event)
+
+    def _process(self, event, destination, host, correlation_id=None):
+        with correlation(correlation_id):
+            self._process_event(event, destination, host)
+
+    def _process_event(self, event, destination, host):
+        if self.deduplicator is not None and not self.deduplicator.claim(event):
+            logger.info(f"略過重複的 webhook 事件：{getattr(event, 'webhook_event_id', None)}")
+            return
+        self._local.host = host
+        try:
+            self.dispatch(event, destination)
+            with self._lock:
+                self.processed += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.error(f"Webhook 事件處理失敗：{e}")
+        finally:
+            self._local.host = None
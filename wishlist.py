@@ -1,40 +1,67 @@
-from flask import request
-from datetime import datetime
-from firebase_admin import firestore
+import logging
+from note_catalog import ngrams, normalize_text
+from repositories import wishlist_repository
 
-# 初始化 Firebase
-db = firestore.client()
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+def course_key(course):
+    """課程名稱正規化後作為需求統計的文件 ID"""
+    return normalize_text(course).replace("/", "_") or "_"
 
 def submit_wishlist(user_id, course, description):
-    """用戶提交筆記許願"""
+    """用戶提交筆記許願，同時累加該課程的需求數並記錄許願用戶"""
     try:
-        db.collection('note_wishlist').add({
-            'user_id': user_id,
-            'course': course,
-            'description': description,
-            'created_at': datetime.utcnow()
-        })
+        wishlist_repository.add(user_id, course, description, course_key(course))
         return True
     except Exception as e:
-        print(f"Error submitting wishlist: {e}")
+        logger.error(f"Error submitting wishlist: {e}")
         return False
 
 def get_wishlist(limit=5):
-    """從 Firebase 獲取最近的許願"""
+    """獲取最近的許願"""
+    try:
+        wishes = wishlist_repository.recent(limit)
+        return [{"course": w.data.get("course"), "description": w.data.get("description")} for w in wishes]
+    except Exception as e:
+        logger.error(f"Error fetching wishlist: {e}")
+        return []
+
+def get_top_wishes(limit=5):
+    """獲取許願數最多的課程"""
+    try:
+        docs = wishlist_repository.top(limit)
+        return [{"course": d.data.get("course"), "count": d.data.get("count", 0)} for d in docs]
+    except Exception as e:
+        logger.error(f"Error fetching wishlist demand: {e}")
+        return []
+
+def matches_course(course, subject):
+    """許願課程是否符合上架筆記的科目：正規化後為科目的一部分（如「統計學」對「統計學_機率」），
+    或課程的 bigram 皆出現在科目中（詞序不同時）"""
+    if not normalize_text(course):
+        return False
+    if course_key(course) in course_key(subject):
+        return True
+    return ngrams(course) <= ngrams(subject)
+
+def get_wishing_users(subject):
+    """獲取許願課程符合某科目的用戶（去重）"""
     try:
-        wishes = db.collection('note_wishlist').order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit).stream()
-        return [{"course": w.to_dict().get("course"), "description": w.to_dict().get("description")} for w in wishes]
+        users = []
+        for demand in wishlist_repository.demands():
+            if matches_course(demand.data.get("course") or demand.id, subject):
+                users.extend(u for u in demand.data.get("users", []) if u not in users)
+        return users
     except Exception as e:
-        print(f"Error fetching wishlist: {e}")
+        logger.error(f"Error fetching wishing users: {e}")
         return []
 
 def delete_user_wishlist(user_id, course):
-    """刪除用戶的特定許願"""
+    """刪除用戶的特定許願，並扣除該課程的需求數"""
     try:
-        wishes = db.collection('note_wishlist').where('user_id', '==', user_id).where('course', '==', course).stream()
-        for wish in wishes:
-            db.collection('note_wishlist').document(wish.id).delete()
+        wishlist_repository.delete(user_id, course, course_key(course))
         return True
     except Exception as e:
-        print(f"Error deleting wishlist: {e}")
+        logger.error(f"Error deleting wishlist: {e}")
         return False